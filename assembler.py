@@ -31,7 +31,7 @@ def assemble_one(op, args):
         assert len(args) == 1
         mode, addr, immed = parse_address(args[0])
         rv.append(0x1000 | format_one[op] << 7 | int(byte_op) << 6 | mode << 4 | addr)
-        if immed:
+        if immed is not None:
             rv.append(immed)
     elif op in format_two:
         assert len(args) == 2
@@ -40,13 +40,63 @@ def assemble_one(op, args):
         src_mode, src_addr, src_immed = parse_address(args[0])
         rv.append(format_two[op] << 12 | src_addr << 8 | dest_mode << 7 | \
                 int(byte_op) << 6 | src_mode << 4 | dest_addr)
-        if src_immed: rv.append(src_immed)
-        if dest_immed: rv.append(dest_immed)
+        if src_immed is not None: rv.append(src_immed)
+        if dest_immed is not None: rv.append(dest_immed)
     else:
         raise Exception('nyi')
 
     return map(swpb, rv)
 
+def assemble_rom(lines, origin=0x4400, data=()):
+    """Assembles a program into a 64K ROM image, as a string, with the reset
+    vector pointing at `origin`. Besides what assemble() takes, a line can
+    be a label ('loop:'), jumps and #/& operands can name labels, 'ret' is
+    understood and ';' starts a comment. `data` is a list of (address or
+    label, string) to place in the image."""
+    program = []
+    for line in lines:
+        line = line.partition(';')[0].strip()
+        if len(line) == 0:
+            continue
+        if line[-1] == ':':
+            program.append((line[:-1], None))
+            continue
+        op, sep, args = line.partition(' ')
+        args = [a.strip() for a in args.split(',')] if args else []
+        if op == 'ret':
+            op, args = 'mov', ['@r1+', 'r0']
+        program.append((op, args))
+    names = set(op for op, args in program if args is None)
+
+    def resolve(op, arg, pc, labels):
+        if op[0] == 'j' and arg in names:
+            return '$%+#x' % (labels.get(arg, pc + 2) - pc)
+        if arg[0] in '#&' and arg[1:] in names:
+            # before the labels are known, any address will do for sizing
+            return '%s%x' % (arg[0], labels.get(arg[1:], 0x1234))
+        return arg
+
+    labels = {}
+    for i in xrange(2): # the first pass only finds the labels
+        pc = origin
+        image = bytearray(0x10000)
+        for op, args in program:
+            if args is None:
+                labels[op] = pc
+                continue
+            words = assemble_one(op, [resolve(op, arg, pc, labels)
+                    for arg in args])
+            for w in words:
+                image[pc] = w >> 8
+                image[pc + 1] = w & 0xff
+                pc += 2
+    for addr, s in data:
+        addr = labels.get(addr, addr)
+        image[addr:addr + len(s)] = s
+    image[0xfffe] = origin & 0xff
+    image[0xffff] = origin >> 8
+    return str(image)
+
 def swpb(word):
     return ((word >> 8) & 0xff) | ((word << 8) & 0xff00)
 
@@ -0,0 +1,558 @@
+import numpy as np
+from decoder import Decoder, Address
+from emulator import Machine, RunResult, CALLGATE
+
+PC, SP, SR, CG = range(4)
+
+# what each lane is doing, and the stop reasons they stand for
+RUNNING, CPUOFF, UNLOCKED, MAX_INSNS, EOF, CRASH = range(6)
+STOP_REASONS = [None, 'cpuoff', 'unlocked', 'max_insns', 'eof', 'crash']
+
+class Row(object):
+    """One lane's memory, as Decoder reads it: a word at a time."""
+
+    def __init__(self, row):
+        self.row = row
+
+    def __getitem__(self, addr):
+        return int(self.row[addr]) | int(self.row[addr + 1]) << 8
+
+class Batch(object):
+    """Runs a machine from where it is now on many inputs at once, each in
+    a lane of its own, for brute force: every lane's registers are a
+    column of a 16 x N array and its memory a row of an N x 64K one. Lanes
+    at the same pc (and sp) run each insn together, the do_* methods below
+    doing for all of them what Machine's do for one; where the lanes may
+    have written the insn themselves, only those with the same bytes
+    there do. Lanes that branch differently are run a group at a time,
+    deepest stack and then lowest pc first, so that they meet again where
+    the paths join.
+
+    Results are those Machine.run would give with the interp engine: the
+    same stop reasons and insn counts, output and final registers. Only
+    the default callgates are known, and the first getsn of each lane is
+    answered with its input; a second one stops the lane as 'eof'."""
+
+    def __init__(self, machine, max_insns=None, hex_input=False):
+        if machine.functions or \
+                machine.callgates != Machine.default_callgates:
+            raise Exception('The batch engine only knows the default '
+                    'callgates.')
+        machine.registers.flush()
+        self.start_regs = np.array(machine.registers.regs, np.int64)
+        self.start_mem = np.frombuffer(machine.mem.read(0, 0x10000),
+                np.uint8)
+        self.start_insn_count = machine.insn_count
+        self.start_unlocked = machine.door_unlocked
+        self.max_insns = max_insns
+        self.hex_input = hex_input
+        self.decoder = Decoder(self)
+        self.decoder.hooks[CALLGATE] = self.callgate_insn()
+        # pc -> decoded insn, for insns in bytes no lane has written, which
+        # are the same in every lane and every run
+        self.cache = {}
+        # bytes some lane may have written since the run started
+        self.dirty = np.zeros(0x10000, bool)
+        # kept from one run to the next, as faulting in 64K a lane is
+        # much of what setting up a run costs
+        self.mem = None
+        self.operand_bytes = 2
+
+    @property
+    def lanes(self):
+        """The lanes running the current insn."""
+        return self._lanes
+
+    @lanes.setter
+    def lanes(self, lanes):
+        self._lanes = lanes
+        # where their rows start in self.flat
+        self.rows = lanes << 16
+
+    def run(self, inputs):
+        """Runs every input from the start, until each lane stops. Returns
+        a RunResult for each. A lane that Machine.run would have raised an
+        exception for stops as 'crash', with the error for its output."""
+        self.load(inputs)
+        while self.step():
+            pass
+        regs = self.regs.T.tolist()
+        insn_counts = self.insn_count.tolist()
+        rv = []
+        for i in xrange(len(inputs)):
+            if self.state[i] == CRASH:
+                output = self.errors[i]
+            else:
+                output = ''.join(self.outputs[i])
+            rv.append(RunResult(bool(self.unlocked[i]), insn_counts[i],
+                    output, tuple(regs[i]), STOP_REASONS[self.state[i]]))
+        return rv
+
+    def load(self, inputs):
+        n = len(inputs)
+        if self.mem is None or len(self.mem) != n:
+            self.mem = np.empty((n, 0x10000), np.uint8)
+            self.flat = self.mem.reshape(-1)
+        self.mem[:] = self.start_mem
+        self.regs = np.repeat(self.start_regs[:, np.newaxis], n, axis=1)
+        self.insn_count = np.full(n, self.start_insn_count, np.int64)
+        self.state = np.zeros(n, np.int8)
+        self.unlocked = np.full(n, self.start_unlocked, bool)
+        self.errors = {}
+        self.inputs = list(inputs)
+        self.answered = np.zeros(n, bool)
+        self.outputs = [[] for i in xrange(n)]
+        self.dirty[:] = False
+
+    def step(self):
+        """Runs one insn on the next group of lanes. Returns whether any
+        lane is still running."""
+        active = np.flatnonzero(self.state == RUNNING)
+        if not len(active):
+            return False
+        regs = self.regs
+        key = regs[SP][active] << 16 | regs[PC][active]
+        low = key.min()
+        if low == key.max():
+            lanes = active
+        else:
+            lanes = active[key == low]
+        pc = int(low & 0xffff)
+
+        window = slice(max(pc - 2, 0), pc + 6)
+        if len(lanes) > 1 and self.dirty[window].any():
+            # the lanes may have written different code here (or at the insn
+            # before, for the peephole): only those with the same bytes as
+            # the first can run it together
+            code = self.mem[lanes, window]
+            lanes = lanes[(code == code[0]).all(axis=1)]
+        self.lanes = lanes
+        self.insn_count[lanes] += 1
+        try:
+            handler, is_byte_insn, args, size = self.decode(pc)
+            if handler is None:
+                raise Exception('Failed to decode instruction at pc %x.' % pc)
+        except Exception as e:
+            self.fault(lanes, str(e))
+            return True
+        self.faulted = np.zeros(len(lanes), bool)
+        self.operand_bytes = 1 if is_byte_insn else 2
+        self.next_pc = pc + size
+        regs[PC][lanes] = pc + 2
+
+        if not self.peephole_execute(handler, args):
+            handler(*args)
+
+        lanes = self.lanes
+        stay = regs[PC][lanes] == pc + 2
+        regs[PC][lanes[stay]] = self.next_pc
+
+        state = self.state
+        if self.faulted.any():
+            state[lanes[self.faulted]] = CRASH
+        lanes = lanes[state[lanes] == RUNNING]
+        if self.max_insns is not None:
+            state[lanes[self.insn_count[lanes] >= self.max_insns]] = MAX_INSNS
+            lanes = lanes[state[lanes] == RUNNING]
+        halted = (regs[SR][lanes] & 0x10 != 0) | self.unlocked[lanes]
+        state[lanes[halted]] = np.where(self.unlocked[lanes[halted]],
+                UNLOCKED, CPUOFF)
+        return True
+
+    def decode(self, pc):
+        """Decodes the insn at pc, from the first of self.lanes."""
+        # an insn is at most 6 bytes
+        dirty = self.dirty[pc:pc + 6].any()
+        if not dirty:
+            try:
+                return self.cache[pc]
+            except KeyError:
+                pass
+        rv = self.decoder.hooks.get(pc)
+        if rv is None:
+            rv = self.decoder.decode_uncached(pc,
+                    Row(self.mem[self.lanes[0]]))
+        if not dirty:
+            self.cache[pc] = rv
+        return rv
+
+    def fault(self, which, message):
+        """Stops lanes where Machine.run would have raised an exception.
+        `which` is either lanes or a mask of self.lanes."""
+        if which.dtype == bool:
+            self.faulted |= which
+            which = self.lanes[which]
+        else:
+            self.state[which] = CRASH
+        for lane in which.tolist():
+            self.errors.setdefault(lane, message)
+
+    def only(self, subset, f, *args):
+        """Calls f(*args) with self.lanes cut down to self.lanes[subset]."""
+        lanes, faulted = self.lanes, self.faulted
+        self.lanes = lanes[subset]
+        self.faulted = np.zeros(len(self.lanes), bool)
+        try:
+            f(*args)
+        finally:
+            faulted[subset] |= self.faulted
+            self.lanes, self.faulted = lanes, faulted
+
+    # Operands, for all of self.lanes at once. Values are int64 arrays, or
+    # plain ints where every lane has the same.
+
+    def read(self, addrs, operand_bytes):
+        addrs = self.in_memory(addrs, operand_bytes)
+        flat = self.flat
+        v = flat[self.rows + addrs].astype(np.int64)
+        if operand_bytes == 2:
+            v |= flat[self.rows + (addrs + 1 & 0xffff)].astype(np.int64) << 8
+        return v
+
+    def write(self, addrs, v, operand_bytes):
+        addrs = self.in_memory(addrs, operand_bytes)
+        ends = [(addrs, v & 0xff)]
+        if operand_bytes == 2:
+            ends.append((addrs + 1 & 0xffff, v >> 8 & 0xff))
+        flat = self.flat
+        for a, b in ends:
+            if isinstance(b, np.ndarray):
+                # much faster stored than converted on the way in
+                b = b.astype(np.uint8)
+            flat[self.rows + a] = b
+            self.dirty[a] = True
+
+    def wrote(self, addr, n):
+        """Notes that a lane may have changed n bytes at addr."""
+        self.dirty[addr:addr + n] = True
+
+    def in_memory(self, addrs, operand_bytes):
+        """Returns addresses as indices into memory. As with Memory, those
+        below 0 wrap around and those past the end fault."""
+        bad = np.asarray(addrs + operand_bytes - 1 > 0xffff)
+        if bad.any():
+            self.fault(np.broadcast_to(bad, self.lanes.shape).copy(),
+                    'Memory access out of range.')
+            addrs = np.where(bad, 0, addrs)
+        return addrs & 0xffff
+
+    def set_register(self, n, v):
+        bad = np.asarray((v < 0) | (v > 0xffff))
+        if bad.any():
+            self.fault(np.broadcast_to(bad, self.lanes.shape).copy(),
+                    'Register value out of range.')
+            v = v & 0xffff
+        self.regs[n][self.lanes] = v
+
+    def get_addr(self, addr, operand_bytes=None, inc=True):
+        if operand_bytes is None:
+            operand_bytes = self.operand_bytes
+
+        if addr.loc == 2:
+            if addr.mode == 1:
+                return self.read(addr.data, operand_bytes)
+            elif addr.mode >= 2:
+                return 1 << addr.mode
+        elif addr.loc == 3:
+            if addr.mode == 3:
+                return (1 << self.operand_bytes * 8) - 1 # -1
+            else:
+                return addr.mode
+        elif addr.loc == 0 and addr.mode == 3:
+            return addr.data
+
+        reg = self.regs[addr.loc][self.lanes]
+        if addr.mode == 0:
+            mask = (1 << (8 * self.operand_bytes)) - 1
+            return reg & mask
+        else:
+            if addr.mode == 1:
+                index = addr.data
+            else:
+                index = 0
+            rv = self.read(reg + index, operand_bytes)
+            if addr.mode == 3 and inc:
+                self.set_register(addr.loc, reg + 2)
+            return rv
+
+    def set_addr(self, addr, v, operand_bytes=None):
+        if operand_bytes is None:
+            operand_bytes = self.operand_bytes
+
+        reg = self.regs[addr.loc]
+        if addr.mode == 0:
+            mask = (1 << (8 * self.operand_bytes)) - 1
+            reg[self.lanes] = v & mask
+        else:
+            if addr.loc == 2 and addr.mode == 1:
+                dest = addr.data
+            elif addr.mode == 1:
+                dest = reg[self.lanes] + addr.data
+            else:
+                dest = reg[self.lanes]
+            self.write(dest, v, operand_bytes)
+
+    # The status bits, worked out at once as Registers.flush() would.
+
+    def set_sr(self, p):
+        self.regs[SR][self.lanes] = p >> 16 | ((p & 0xffff) == 0) << 1 | \
+                (p >> 15 & 1) << 2
+
+    def set_status_result_bits(self, v):
+        if self.operand_bytes == 1:
+            self.set_sr(v & 0x100ff)
+        else:
+            self.set_sr(v & 0x1ffff)
+
+    def set_logic_result_bits(self, v):
+        r = v & ((1 << self.operand_bytes * 8) - 1)
+        self.set_sr(r | (r != 0) << 16)
+
+    def flag(self, bit):
+        return self.regs[SR][self.lanes] >> bit & 1
+
+    # Insns, as Machine has them.
+
+    def do_mov(self, src, dest):
+        self.set_addr(dest, self.get_addr(src))
+
+    def do_add(self, src, dest):
+        v = self.get_addr(dest) + self.get_addr(src)
+        self.set_status_result_bits(v)
+        self.set_addr(dest, v)
+
+    def do_addc(self, src, dest):
+        v = self.get_addr(dest) + self.get_addr(src)
+        v = v + self.flag(0)
+        self.set_status_result_bits(v)
+        self.set_addr(dest, v)
+
+    def do_sub(self, src, dest):
+        v = self.get_addr(dest) + (~self.get_addr(src) & 0xffff) + 1
+        self.set_status_result_bits(v)
+        self.set_addr(dest, v)
+
+    def do_cmp(self, src, dest):
+        v = self.get_addr(dest) + (~self.get_addr(src) & 0xffff) + 1
+        self.set_status_result_bits(v)
+
+    def do_bit(self, src, dest):
+        v = self.get_addr(dest) & self.get_addr(src)
+        self.set_status_result_bits(v)
+
+    def do_bic(self, src, dest):
+        v = self.get_addr(dest) & ~self.get_addr(src)
+        self.set_addr(dest, v)
+
+    def do_bis(self, src, dest):
+        v = self.get_addr(dest) | self.get_addr(src)
+        self.set_addr(dest, v)
+
+    def do_xor(self, src, dest):
+        v = self.get_addr(dest) ^ self.get_addr(src)
+        self.set_logic_result_bits(v)
+        self.set_addr(dest, v)
+
+    def do_and(self, src, dest):
+        v = self.get_addr(dest) & self.get_addr(src)
+        self.set_logic_result_bits(v)
+        self.set_addr(dest, v)
+
+    def do_push(self, src):
+        sp = self.regs[SP]
+        self.set_register(SP, sp[self.lanes] - 2)
+        v = self.get_addr(src)
+        self.write(sp[self.lanes], v, 2)
+
+    def do_call(self, dest):
+        sp = self.regs[SP]
+        self.set_register(SP, sp[self.lanes] - 2)
+        self.write(sp[self.lanes], self.next_pc, 2)
+        self.set_register(PC, self.get_addr(dest))
+
+    def jump(self, offset, taken):
+        taken = np.asarray(taken, bool)
+        if taken.all():
+            self.set_register(PC, self.regs[PC][self.lanes] + offset - 2)
+        elif taken.any():
+            self.only(taken, self.jump, offset, True)
+
+    def do_jeq(self, offset):
+        self.jump(offset, self.flag(1) == 1)
+
+    def do_jnz(self, offset):
+        self.jump(offset, self.flag(1) == 0)
+
+    def do_jc(self, offset):
+        self.jump(offset, self.flag(0) == 1)
+
+    def do_jnc(self, offset):
+        self.jump(offset, self.flag(0) == 0)
+
+    def do_jge(self, offset):
+        self.jump(offset, self.flag(2) ^ self.flag(8) == 0)
+
+    def do_jl(self, offset):
+        self.jump(offset, self.flag(2) ^ self.flag(8) == 1)
+
+    def do_jmp(self, offset):
+        self.jump(offset, True)
+
+    def do_swpb(self, dest):
+        v = self.get_addr(dest)
+        v = v >> 8 | (v << 8 & 0xff00)
+        self.set_addr(dest, v)
+
+    def do_sxt(self, dest):
+        v = self.get_addr(dest)
+        v = (v ^ 0x80) - 0x80 # as_signed(v, 8)
+        self.set_logic_result_bits(v)
+        self.set_addr(dest, v)
+
+    def do_rrc(self, dest):
+        v = self.get_addr(dest)
+        new_carry = v & 1
+        bit_count = self.operand_bytes * 8
+        mask = (1 << bit_count) - 1
+        v = ((v >> 1) | (self.flag(0) << bit_count - 1)) & mask
+        sr = self.regs[SR][self.lanes]
+        sr = np.where(v & 0x8000, sr | 4, sr)
+        sr = np.where(v != 0, sr & ~2, sr)
+        self.regs[SR][self.lanes] = sr & ~1 | new_carry
+        self.set_addr(dest, v)
+
+    def do_rra(self, dest):
+        bit_count = self.operand_bytes * 8
+        mask = (1 << bit_count) - 1
+        sign = 1 << bit_count - 1
+        v = self.get_addr(dest)
+        v = (((v ^ sign) - sign) >> 1) & mask # as_signed(v, bit_count)
+        sr = self.regs[SR][self.lanes] & ~2
+        self.regs[SR][self.lanes] = np.where(v & 0x8000, sr | 4, sr)
+        self.set_addr(dest, v)
+
+    def do_dadd(self, src, dest):
+        s = self.get_addr(src)
+        d = self.get_addr(dest)
+        carry = 0
+        negative = 0
+        v = 0
+        for i in xrange(0, self.operand_bytes * 2):
+            src_nibble = (s >> i * 4) & 0xf
+            dest_nibble = (d >> i * 4) & 0xf
+            n = src_nibble + dest_nibble + carry
+            negative = (n >> 3) & 1
+            carry = n >= 10
+            n = np.where(carry, n - 10, n)
+            v = v | (n & 0xf) << i * 4
+        sr = self.regs[SR][self.lanes] & ~1 | carry
+        self.regs[SR][self.lanes] = np.where(negative, sr | 4, sr)
+        self.set_addr(dest, v)
+
+    def peephole_execute(self, handler, args):
+        """Machine.peephole_execute: `add #-1, x; jnz $-2` runs at once."""
+        if not (handler.__name__ == 'do_jnz' and args[0] == -2):
+            return False
+        pc = self.next_pc - 2
+        prev_handler, prev_is_byte_insn, prev_args, prev_size = \
+                self.decode(pc - 2)
+        if prev_handler is None:
+            self.fault(self.lanes, 'Failed to decode instruction at pc %x.'
+                    % (pc - 2))
+            return True
+        if not (prev_handler.__name__[3:] == 'add' and \
+                prev_args[0] == Address(3, 3, None) and \
+                isinstance(prev_args[1], Address) and
+                not prev_args[1].loc == 0):
+            return False
+
+        self.operand_bytes = 1 if prev_is_byte_insn else 2
+        self.set_addr(prev_args[1], 0)
+        self.regs[PC][self.lanes] = self.next_pc
+        self.regs[SR][self.lanes] = self.regs[SR][self.lanes] & ~7 | 3
+        return True
+
+    # The callgate, with the handlers of Machine.default_callgates.
+
+    def callgate_insn(self):
+        """Returns the insn for 0x10, as Machine.callgate_insn: a ret, run
+        after the callgate's handler."""
+        def do_mov(src, dest): # named for the insn it stands in for
+            lanes = self.lanes
+            sr = self.regs[SR][lanes]
+            called = sr >> 15 & 1 == 1
+            interrupts = sr >> 8 & 0x7f
+            for interrupt in np.unique(interrupts[called]).tolist():
+                subset = called & (interrupts == interrupt)
+                handler = self.callgates.get(interrupt)
+                if handler is None:
+                    self.fault(subset, 'NYI: Interrupt %x' % interrupt)
+                else:
+                    self.only(subset, handler, self)
+            # lanes left waiting for input stop here, as run() leaves them
+            waiting = self.state[lanes] == EOF
+            if waiting.any():
+                self.regs[PC][lanes[waiting]] = CALLGATE
+                self.insn_count[lanes[waiting]] -= 1
+                self.lanes = lanes[~waiting]
+                self.faulted = self.faulted[~waiting]
+            self.write(CALLGATE, 0x4130, 2) # ret
+            self.do_mov(src, dest)
+        return (do_mov, False, [Address(3, SP, None), Address(0, PC, None)],
+                2)
+
+    def argument(self, offset):
+        return self.read(self.regs[SP][self.lanes] + offset, 2)
+
+    def callgate_putchar(self):
+        chars = self.read(self.regs[SP][self.lanes] + 8, 1)
+        for lane, c in zip(self.lanes.tolist(), chars.tolist()):
+            self.outputs[lane].append(chr(c))
+
+    def callgate_getsn(self):
+        for lane, addr, max_len in zip(self.lanes.tolist(),
+                self.argument(8).tolist(), self.argument(10).tolist()):
+            if self.answered[lane]:
+                self.state[lane] = EOF
+                continue
+            self.answered[lane] = True
+            s = self.inputs[lane]
+            row = self.mem[lane]
+            if self.hex_input:
+                # any error asks for input again, and there is none
+                s = s.replace(' ', '')
+                if len(s) % 2 != 0:
+                    self.state[lane] = EOF
+                    continue
+                try:
+                    for i in xrange(0, min(len(s) / 2, max_len)):
+                        row[addr + i] = int(s[i*2:(i+1)*2], 16)
+                        self.wrote(addr + i, 1)
+                except Exception:
+                    self.state[lane] = EOF
+            else:
+                s = s[:max_len] + '\0'
+                if addr + len(s) > 0x10000:
+                    self.state[lane] = CRASH
+                    self.errors.setdefault(lane, 'Input out of memory.')
+                    continue
+                row[addr:addr + len(s)] = np.frombuffer(s, np.uint8)
+                self.wrote(addr, len(s))
+
+    def callgate_rand(self):
+        self.regs[15][self.lanes] = 0 # not actually random
+
+    def callgate_check(self):
+        """HSM-1: is the password correct?"""
+        self.write(self.argument(10), 0, 2) # always false
+
+    def callgate_check_hsm(self):
+        """HSM-2: unlocks the door itself if the password is correct."""
+        self.write(15, 0, 2) # always false
+
+    def callgate_unlock(self):
+        self.unlocked[self.lanes] = True
+
+    callgates = {0: callgate_putchar, 2: callgate_getsn,
+            0x20: callgate_rand, 0x7d: callgate_check,
+            0x7e: callgate_check_hsm, 0x7f: callgate_unlock}
@@ -0,0 +1,274 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from assembler import assemble_rom
+from emulator import Machine
+from tracer import Tracer, BinaryTracer
+
+# Synthetic workloads, each a program that runs to CPUOFF without input.
+# Immediates are hex, as assembler.py takes them.
+WORKLOADS = {
+    'loop': ("""
+        mov #4400, r1
+        mov #40, r10
+    outer:
+        mov #400, r13
+    inner:
+        add #1, r15
+        sub #1, r13
+        jnz inner
+        sub #1, r10
+        jnz outer
+        bis #10, r2
+    """, []),
+
+    'memcpy': ("""
+        mov #4400, r1
+        mov #80, r10
+    again:
+        mov #2400, r14
+        mov #2600, r15
+        mov #100, r13
+    copy:
+        mov @r14+, 0(r15)
+        add #2, r15
+        sub #1, r13
+        jnz copy
+        sub #1, r10
+        jnz again
+        bis #10, r2
+    """, [(0x2400, ''.join(chr(i) for i in xrange(256)) * 2)]),
+
+    'strcmp': ("""
+        mov #4400, r1
+        mov #40, r10
+    again:
+        mov #2400, r14
+        mov #2600, r15
+    next:
+        mov.b @r14, r12
+        cmp.b @r15, r12
+        jnz done
+        add #1, r14
+        add #1, r15
+        cmp.b #0, r12
+        jnz next
+    done:
+        sub #1, r10
+        jnz again
+        bis #10, r2
+    """, [(0x2400, 'x' * 0xff + '\0'), (0x2600, 'x' * 0xff + '\0')]),
+
+    'recursion': ("""
+        mov #4400, r1
+        mov #14, r15
+        call #fib
+        bis #10, r2
+    fib:
+        cmp #2, r15
+        jl leaf
+        push r15
+        add #-1, r15
+        call #fib
+        mov @r1+, r14
+        push r15
+        mov r14, r15
+        sub #2, r15
+        call #fib
+        add @r1+, r15
+    leaf:
+        ret
+    """, []),
+
+    'byteops': ("""
+        mov #4400, r1
+        mov #40, r10
+    again:
+        mov #2400, r14
+        mov #100, r13
+    next:
+        mov.b @r14, r12
+        xor.b #5a, r12
+        and.b #7f, r12
+        rra.b r12
+        swpb r12
+        sxt r12
+        mov.b r12, 0(r14)
+        add #1, r14
+        sub #1, r13
+        jnz next
+        sub #1, r10
+        jnz again
+        bis #10, r2
+    """, [(0x2400, ''.join(chr(i) for i in xrange(256)))]),
+
+    'dadd': ("""
+        mov #4400, r1
+        bic #1, r2
+        mov #0, r14
+        mov #0, r15
+        mov #c000, r10
+    count:
+        dadd #1, r14
+        dadd #0, r15
+        sub #1, r10
+        jnz count
+        bis #10, r2
+    """, []),
+}
+
+def write_rom(name):
+    source, data = WORKLOADS[name]
+    fd, fname = tempfile.mkstemp(suffix='.rom', prefix=name + '-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(assemble_rom(source.splitlines(), data=data))
+    return fname
+
+def timed_run(machine, trace=None):
+    """Runs the machine from power-on. Returns (seconds, insns)."""
+    machine.reset()
+    start = time.time()
+    result = machine.run(trace=trace)
+    elapsed = time.time() - start
+    if result.stop_reason != 'cpuoff':
+        raise Exception('Workload stopped early (%s).' % result.stop_reason)
+    return elapsed, result.insn_count
+
+def decode_rate(machine, min_decodes=100000):
+    """Returns decodes per second, decoding the insns the workload ran
+    (as left in the decoder's cache) without the cache."""
+    decoder = machine.decoder
+    pcs = [pc for pc in decoder.cache if pc not in decoder.hooks]
+    rounds = max(1, min_decodes / len(pcs))
+    decode = decoder.decode_uncached
+    mem = machine.mem
+    start = time.time()
+    for i in xrange(rounds):
+        for pc in pcs:
+            decode(pc, mem)
+    return rounds * len(pcs) / (time.time() - start)
+
+def bench(name, repeat=3, memory='pages'):
+    """Measures one workload. Meant to run in a fresh process, so that the
+    peak memory is the workload's own."""
+    fname = write_rom(name)
+    try:
+        results = {}
+        for engine in ('block', 'interp'):
+            machine = Machine(fname, engine, memory)
+            elapsed, insns = min(timed_run(machine) for i in xrange(repeat))
+            results[engine + '_seconds'] = elapsed
+            results[engine + '_insns_per_sec'] = insns / elapsed
+        results['insns'] = insns
+        results['decodes_per_sec'] = decode_rate(machine)
+        with open(os.devnull, 'w') as devnull:
+            elapsed, insns = min(timed_run(machine, Tracer(devnull).trace)
+                    for i in xrange(repeat))
+        results['trace_overhead'] = elapsed / results['interp_seconds']
+        trace = BinaryTracer(os.devnull)
+        elapsed, insns = min(timed_run(machine, trace.trace)
+                for i in xrange(repeat))
+        trace.tracefile.close()
+        results['binary_trace_overhead'] = elapsed / results['interp_seconds']
+        results['peak_rss_kb'] = \
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return name, results
+    finally:
+        os.remove(fname)
+
+def bench_all(names, repeat=3, memory='pages'):
+    # a new process per workload keeps their peak memory apart
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        return dict(pool.map(bench_one,
+                [(name, repeat, memory) for name in names],
+                1))
+    finally:
+        pool.terminate()
+        pool.join()
+
+def bench_one(args):
+    return bench(*args)
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always',
+                '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# metrics where bigger is better; for the rest smaller is better
+FASTER_IF_BIGGER = set(['block_insns_per_sec', 'interp_insns_per_sec',
+        'decodes_per_sec'])
+
+def compare(old, new):
+    """Yields (workload, metric, old value, new value, change), where change
+    is the relative improvement: positive is better."""
+    for name in sorted(new['workloads']):
+        if name not in old['workloads']:
+            continue
+        before = old['workloads'][name]
+        after = new['workloads'][name]
+        for metric in sorted(after):
+            if metric == 'insns' or metric not in before or \
+                    not before[metric] or not after[metric]:
+                continue
+            if metric in FASTER_IF_BIGGER:
+                change = after[metric] / float(before[metric]) - 1
+            else:
+                change = before[metric] / float(after[metric]) - 1
+            yield name, metric, before[metric], after[metric], change
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('workloads', nargs='*',
+            help='workloads to run (default: all of %s)' %
+                 ', '.join(sorted(WORKLOADS)))
+    parser.add_argument('-o', help='write the results as JSON to this file')
+    parser.add_argument('-r', type=int, default=3,
+            help='runs of each measurement; the best is kept')
+    parser.add_argument('-m', choices=['pages', 'image'], default='pages',
+            help='memory backend')
+    parser.add_argument('--compare',
+            help='JSON results of an earlier version to compare against')
+    args = parser.parse_args()
+
+    names = args.workloads or sorted(WORKLOADS)
+    for name in names:
+        if name not in WORKLOADS:
+            parser.error('unknown workload: %s' % name)
+    results = {
+        'revision': revision(),
+        'python': sys.version.split()[0],
+        'time': time.time(),
+        'memory': args.m,
+        'workloads': bench_all(names, args.r, args.m),
+    }
+    for name in names:
+        r = results['workloads'][name]
+        print '%-10s %8d insns  block %8.0f/s  interp %8.0f/s  ' \
+                'decode %8.0f/s  trace x%.2f  binary trace x%.2f  %d KB' % (
+                name, r['insns'], r['block_insns_per_sec'],
+                r['interp_insns_per_sec'], r['decodes_per_sec'],
+                r['trace_overhead'], r['binary_trace_overhead'],
+                r['peak_rss_kb'])
+    if args.o is not None:
+        with open(args.o, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print
+        print 'against %s:' % (old.get('revision') or args.compare)
+        for name, metric, before, after, change in compare(old, results):
+            print '%-10s %-24s %12.2f %12.2f %+6.1f%%' % (name, metric,
+                    before, after, 100 * change)
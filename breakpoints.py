@@ -0,0 +1,80 @@
+import types
+from memory import SR
+
+# names conditions can use for registers, and the sr bit of each flag
+REGISTER_NAMES = dict([('r%d' % i, i) for i in xrange(16)] +
+        [('pc', 0), ('sp', 1), ('sr', 2)])
+FLAG_BITS = {'carry': 0, 'zero': 1, 'negative': 2, 'overflow': 8}
+
+def code_names(code):
+    """Returns the names compiled code uses, in its own scope or any nested
+    in it: a generator expression or lambda has its own code object."""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= code_names(const)
+    return names
+
+def compile_condition(cond, machine, namespace):
+    """Turns a condition into a function of no arguments. Registers and flags
+    are read straight out of the register file, and byte(addr) and
+    word(addr) read memory; other names are looked up on the machine, then
+    in `namespace`. The expression is only parsed here, not on every
+    hit."""
+    names = sorted(code_names(compile(cond, '<breakpoint>', 'eval')))
+    lines = []
+    if SR in [REGISTER_NAMES.get(name) for name in names] or \
+            set(names) & set(FLAG_BITS):
+        lines.append('_sr = _regs[%d] if _R.pending is None else _R.flush()'
+                % SR)
+    for name in names:
+        if name in REGISTER_NAMES:
+            if REGISTER_NAMES[name] == SR:
+                lines.append('%s = _sr' % name)
+            else:
+                lines.append('%s = _regs[%d]' % (name, REGISTER_NAMES[name]))
+        elif name in FLAG_BITS:
+            lines.append('%s = _sr >> %d & 1' % (name, FLAG_BITS[name]))
+        elif name not in ('byte', 'word') and hasattr(machine, name):
+            lines.append('%s = _m.%s' % (name, name))
+    source = 'def test():\n%s    return (%s)\n' % (
+            ''.join('    %s\n' % line for line in lines), cond)
+    env = dict(namespace)
+    env.update(_regs=machine.registers.regs, _R=machine.registers,
+            _m=machine, byte=machine.mem.get_byte, word=machine.mem.get_word)
+    exec compile(source, '<breakpoint>', 'exec') in env
+    return env['test']
+
+class Breakpoint(object):
+
+    __slots__ = ['addr', 'condition', 'test', 'temporary', 'hits',
+            'ignore_count']
+
+    def __init__(self, addr, condition=None, test=None, temporary=False):
+        self.addr = addr
+        self.condition = condition
+        self.test = test
+        self.temporary = temporary
+        self.hits = 0
+        self.ignore_count = 0
+
+    def hit(self):
+        """Called when pc reaches the breakpoint. Returns whether to stop."""
+        if self.test is not None and not self.test():
+            return False
+        self.hits += 1
+        if self.ignore_count:
+            self.ignore_count -= 1
+            return False
+        return True
+
+    def __str__(self):
+        s = '%x' % self.addr
+        if self.temporary:
+            s += ' (temporary)'
+        if self.condition is not None:
+            s += ' if %s' % self.condition
+        s += '\thit %d times' % self.hits
+        if self.ignore_count:
+            s += ', ignoring the next %d' % self.ignore_count
+        return s
@@ -0,0 +1,152 @@
+#! /usr/bin/env python
+
+import sys
+import time
+import itertools
+import multiprocessing
+from emulator import Machine
+
+# Set up in the parent before the pool forks, so every worker starts with
+# the same machine and snapshot without pickling them.
+machine = None
+start_state = None
+max_insns = None
+hex_input = False
+# each worker's batch.Batch, made the first time it's needed
+lanes_engine = None
+
+def prepare(fname, engine='block', insns=None, hex=False, memory='pages'):
+    """Runs the ROM up to its first request for input and snapshots it
+    there. Returns the snapshot."""
+    global machine, start_state, max_insns, hex_input
+    machine = Machine(fname, engine, memory)
+    result = machine.run(max_insns=insns)
+    if result.stop_reason != 'eof':
+        raise Exception('Program finished without asking for input (%s).' %
+                result.stop_reason)
+    start_state = machine.snapshot()
+    max_insns = insns
+    hex_input = hex
+    return start_state
+
+def try_candidate(candidate):
+    """Runs one input from the snapshot. Returns (candidate, outcome,
+    insn_count, detail) where outcome is one of 'unlocked', 'crash' or the
+    RunResult stop_reason."""
+    machine.restore(start_state)
+    try:
+        result = machine.run([candidate], max_insns, hex_input)
+    except Exception as e:
+        return candidate, 'crash', machine.insn_count, str(e)
+    if result.unlocked:
+        return candidate, 'unlocked', result.insn_count, result.output
+    return candidate, result.stop_reason, result.insn_count, result.output
+
+def try_candidates(candidates):
+    """Runs a list of inputs from the snapshot at once, a lane each, with
+    the batch engine (which needs NumPy). Returns what try_candidate would
+    for each, with insn counts as the interp engine has them."""
+    global lanes_engine
+    if lanes_engine is None:
+        from batch import Batch
+        machine.restore(start_state)
+        lanes_engine = Batch(machine, max_insns, hex_input)
+    rv = []
+    for candidate, result in zip(candidates, lanes_engine.run(candidates)):
+        outcome = 'unlocked' if result.unlocked else result.stop_reason
+        rv.append((candidate, outcome, result.insn_count, result.output))
+    return rv
+
+def search(candidates, jobs=None, stop_on_success=True, chunksize=64,
+        report=None, lanes=None):
+    """Tries every input in the `candidates` iterable on a pool of `jobs`
+    worker processes, yielding (candidate, outcome, insn_count, detail)
+    for unlocks and crashes as they come in. prepare() must have been
+    called first. `report`, if given, is called with (runs, runs_per_sec)
+    about once a second. With `lanes`, each worker runs that many inputs
+    at a time with try_candidates."""
+    pool = multiprocessing.Pool(jobs)
+    if lanes is not None:
+        chunksize = lanes
+    # the pool would otherwise drain the whole candidate stream up front
+    batch_size = chunksize * 16 * (jobs or multiprocessing.cpu_count())
+    candidates = iter(candidates)
+    start = last_report = time.time()
+    runs = 0
+    try:
+        while True:
+            batch = list(itertools.islice(candidates, batch_size))
+            if not batch:
+                break
+            if lanes is None:
+                results = pool.imap_unordered(try_candidate, batch, chunksize)
+            else:
+                results = itertools.chain.from_iterable(pool.imap_unordered(
+                        try_candidates, [batch[i:i + lanes]
+                                for i in xrange(0, len(batch), lanes)]))
+            for rv in results:
+                runs += 1
+                now = time.time()
+                if report is not None and now - last_report >= 1:
+                    report(runs, runs / (now - start))
+                    last_report = now
+                outcome = rv[1]
+                if outcome in ('unlocked', 'crash'):
+                    yield rv
+                    if outcome == 'unlocked' and stop_on_success:
+                        return
+        if report is not None:
+            report(runs, runs / max(time.time() - start, 1e-9))
+    finally:
+        pool.terminate()
+        pool.join()
+
+def wordlist(fname):
+    with open(fname) as f:
+        for line in f:
+            yield line.rstrip('\r\n')
+
+def exhaustive(charset, max_len, min_len=1):
+    for length in xrange(min_len, max_len + 1):
+        for chars in itertools.product(charset, repeat=length):
+            yield ''.join(chars)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('romfile')
+    parser.add_argument('-w', help='file of candidate inputs, one per line')
+    parser.add_argument('-c', default='abcdefghijklmnopqrstuvwxyz0123456789',
+            help='characters to try when there is no wordlist')
+    parser.add_argument('-l', type=int, default=4,
+            help='longest input to try when there is no wordlist')
+    parser.add_argument('-j', type=int, help='worker processes')
+    parser.add_argument('-n', type=int, default=1000000,
+            help='give up on a run after this many insns')
+    parser.add_argument('-x', action='store_true',
+            help='treat candidates as hexadecimal')
+    parser.add_argument('-e', choices=['block', 'interp'], default='block')
+    parser.add_argument('-m', choices=['pages', 'image'], default='pages',
+            help="memory backend; workers share the image backend's ROM "
+                 "mapping until they write to it")
+    parser.add_argument('--lanes', type=int,
+            help='run this many candidates at once in each worker, with '
+                 'the NumPy batch engine')
+    parser.add_argument('--all', action='store_true',
+            help='keep going after the first unlock')
+    args = parser.parse_args()
+
+    prepare(args.romfile, args.e, args.n, args.x, args.m)
+    if args.w is not None:
+        candidates = wordlist(args.w)
+    else:
+        candidates = exhaustive(args.c, args.l)
+
+    def report(runs, rate):
+        sys.stderr.write('\r%d runs, %.0f runs/s' % (runs, rate))
+    for candidate, outcome, insn_count, detail in \
+            search(candidates, args.j, not args.all, report=report,
+                    lanes=args.lanes):
+        sys.stderr.write('\n')
+        print '%s\t%r\t%d insns\t%s' % (outcome, candidate, insn_count, detail)
+    sys.stderr.write('\n')
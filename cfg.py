@@ -0,0 +1,223 @@
+import os
+import hashlib
+import tempfile
+import cPickle as pickle
+from memory import Memory, PC, SR
+from disassembler import Disassembler
+
+CALLGATE = 0x10
+RESET_VECTOR = 0xfffe
+
+# bump when the analysis changes, so stale cache entries are ignored
+VERSION = 1
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pymsp430')
+
+class BasicBlock(object):
+
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.insns = []
+        self.succs = []
+        self.calls = []
+        self.function = None
+
+    def __repr__(self):
+        return '<BasicBlock %04x-%04x>' % (self.start, self.end)
+
+class Function(object):
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.blocks = []
+        self.callees = set()
+        self.callers = set()
+
+    def __repr__(self):
+        return '<Function %04x, %d blocks>' % (self.entry, len(self.blocks))
+
+class CFG(object):
+    """The functions and basic blocks reachable from a ROM's reset vector,
+    following direct calls and jumps."""
+
+    def __init__(self):
+        self.functions = {}
+        self.blocks = {}
+        # insn address -> start of the block holding it
+        self.block_starts = {}
+
+    def lookup(self, pc):
+        """Returns the BasicBlock containing the insn at pc, or None."""
+        start = self.block_starts.get(pc)
+        if start is None:
+            return None
+        return self.blocks[start]
+
+    def function_at(self, pc):
+        block = self.lookup(pc)
+        if block is None:
+            return None
+        return self.functions[block.function]
+
+class Analyzer(object):
+    """Recursive-descent disassembly. Each function is explored from its
+    entry, following both ways of every conditional jump, then cut into
+    basic blocks at jump targets and after each jump."""
+
+    def __init__(self, mem):
+        self.mem = mem
+        self.decoder = Disassembler().decoder
+        self.insns = {}
+
+    def decode(self, pc):
+        """Returns (name, is_byte_insn, args, size), or None if pc doesn't
+        hold a valid insn."""
+        if pc & 1 or pc + 2 > len(self.mem):
+            return None
+        try:
+            insn = self.decoder.decode(pc, self.mem)
+        except Exception:
+            return None
+        if not isinstance(insn[0], basestring):
+            return None # not implemented by the emulator
+        return insn
+
+    @staticmethod
+    def immediate(arg):
+        if arg.mode == 3 and arg.loc == PC:
+            return arg.data & 0xffff
+        return None
+
+    def successors(self, pc, name, args, size):
+        """Returns (successors, call_target, falls_through) for an insn.
+        call_target is False for insns that aren't direct calls."""
+        next_pc = pc + size & 0xffff
+        if name[0] == 'j':
+            target = pc + args[0] & 0xffff
+            if name == 'jmp':
+                return [target], False, False
+            return [target, next_pc], False, False
+        if name == 'call':
+            return [next_pc], self.immediate(args[0]), True
+        if Disassembler.is_ret(name, args):
+            return [], False, False
+        dest = args[-1]
+        if dest.mode == 0 and dest.loc == PC and name != 'cmp' and \
+                name != 'bit' and name != 'push':
+            target = self.immediate(args[0])
+            if name == 'mov' and target is not None:
+                return [target], False, False
+            return [], False, False # computed jump
+        if dest.mode == 0 and dest.loc == SR and name in ('mov', 'bis'):
+            flags = self.immediate(args[0])
+            if flags is not None and flags & 0x10:
+                return [], False, False # CPUOFF
+        return [next_pc], False, True
+
+    def explore(self, entry):
+        """Finds the insns of the function at entry. Returns the
+        function's block leaders and the entries of its direct callees."""
+        leaders = set([entry])
+        callees = set()
+        todo = [entry]
+        seen = set()
+        while todo:
+            pc = todo.pop()
+            while pc not in seen:
+                seen.add(pc)
+                insn = self.decode(pc)
+                if insn is None:
+                    break
+                name, is_byte_insn, args, size = insn
+                succs, call_target, falls_through = \
+                        self.successors(pc, name, args, size)
+                self.insns[pc] = (size, succs, falls_through, call_target)
+                if call_target:
+                    callees.add(call_target)
+                if not falls_through:
+                    leaders.update(succs)
+                    todo.extend(succs)
+                    break
+                pc = succs[0]
+        return leaders, callees
+
+    def analyze(self, entries):
+        cfg = CFG()
+        todo = list(entries)
+        while todo:
+            entry = todo.pop()
+            if entry in cfg.functions or entry == CALLGATE:
+                continue
+            function = cfg.functions[entry] = Function(entry)
+            leaders, callees = self.explore(entry)
+            function.callees = callees
+            todo.extend(callees)
+            for leader in sorted(leaders):
+                if leader not in self.insns or leader in cfg.blocks:
+                    continue
+                block = self.build_block(leader, leaders, cfg)
+                block.function = entry
+                function.blocks.append(block.start)
+        for function in cfg.functions.itervalues():
+            for callee in function.callees:
+                if callee in cfg.functions:
+                    cfg.functions[callee].callers.add(function.entry)
+        return cfg
+
+    def build_block(self, start, leaders, cfg):
+        block = cfg.blocks[start] = BasicBlock(start)
+        pc = start
+        while True:
+            size, succs, falls_through, call_target = self.insns[pc]
+            block.insns.append(pc)
+            cfg.block_starts[pc] = start
+            if call_target:
+                block.calls.append(call_target)
+            block.end = pc + size
+            if not falls_through:
+                block.succs = succs
+                break
+            pc = succs[0]
+            if pc in leaders or pc not in self.insns:
+                block.succs = [pc]
+                break
+        return block
+
+def rom_hash(fname):
+    with open(fname, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def analyze(mem, entries=None):
+    if entries is None:
+        entries = [mem[RESET_VECTOR]]
+    return Analyzer(mem).analyze(entries)
+
+def load(fname, cache_dir=CACHE_DIR):
+    """Returns the CFG of the ROM in fname, from the cache if it has been
+    analysed before."""
+    path = os.path.join(cache_dir, '%s-%d.cfg' % (rom_hash(fname), VERSION))
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        # missing, or unreadable some other way; a truncated pickle can
+        # raise almost anything
+        pass
+    with open(fname, 'rb') as f:
+        cfg = analyze(Memory(f))
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # written whole and then renamed into place, so that another
+        # process (or this one, interrupted) never leaves half a file there
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(cfg, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+    except (IOError, OSError):
+        pass # caching is only an optimisation
+    return cfg
@@ -4,6 +4,59 @@ from opcodes import condition_codes, format_one, format_two
 
 Address = namedtuple('Address', ['mode', 'loc', 'data'])
 
+# kinds of insn, each with its own table of handlers in a Decoder
+FORMAT_ONE, JUMP, FORMAT_TWO = range(3)
+
+# the operands without an extension word, shared by every table entry
+ADDRESSES = [Address(mode, loc, None) for mode in xrange(4)
+        for loc in xrange(16)]
+
+def has_extension(mode, loc):
+    return (mode == 1 and loc != 3) or (mode == 3 and loc == 0)
+
+def decode_word(insn):
+    """Returns the decode table entry for an insn's first word: (kind,
+    opcode, byte flag, args, indices of the args that take an extension
+    word, size). Args with an extension word have None for their data."""
+    is_byte_insn = insn & (1 << 6)
+    if insn >> 12 == 1: # format 1
+        mode = insn >> 4 & 0x3
+        loc = insn & 0xf
+        extensions = (0,) if has_extension(mode, loc) else ()
+        return (FORMAT_ONE, insn >> 7 & 0x7, is_byte_insn,
+                (ADDRESSES[mode << 4 | loc],), extensions,
+                2 + 2 * len(extensions))
+    elif insn >> 13 == 1: # jump
+        mask = 1 << 10
+        offset = (((insn & 0x3ff) + 1 << 1) ^ mask) - mask # convert to signed
+        return (JUMP, insn >> 10 & 0x7, is_byte_insn, (offset,), (), 2)
+    else: # format 2
+        src_mode = insn >> 4 & 0x3
+        src_loc = insn >> 8 & 0xf
+        dest_mode = insn >> 7 & 0x1
+        dest_loc = insn & 0xf
+        extensions = ()
+        if has_extension(src_mode, src_loc):
+            extensions += (0,)
+        if dest_mode == 1 and dest_loc != 3:
+            extensions += (1,)
+        return (FORMAT_TWO, insn >> 12 & 0xf, is_byte_insn,
+                (ADDRESSES[src_mode << 4 | src_loc],
+                 ADDRESSES[dest_mode << 4 | dest_loc]), extensions,
+                2 + 2 * len(extensions))
+
+# decode_word() of every first word, shared by all Decoders and filled in
+# as words are first seen
+TABLE = [None] * 0x10000
+
+def decode_table():
+    """Fills in the whole table, say before forking workers that should
+    share it, and returns it."""
+    for insn in xrange(0x10000):
+        if TABLE[insn] is None:
+            TABLE[insn] = decode_word(insn)
+    return TABLE
+
 class Decoder(object):
 
     def __init__(self, handlers):
@@ -13,6 +66,13 @@ class Decoder(object):
         self.register_handlers(self.condition_handlers, condition_codes, handlers)
         self.register_handlers(self.format_one_handlers, format_one, handlers)
         self.register_handlers(self.format_two_handlers, format_two, handlers)
+        # indexed by kind of insn
+        self.handler_tables = [self.format_one_handlers,
+                self.condition_handlers, self.format_two_handlers]
+        self.mem = None
+        self.cache = None
+        # pc -> a decoded insn to use there instead of what memory holds
+        self.hooks = {}
 
     @staticmethod
     def register_handlers(handler_table, mapping, handlers):
@@ -36,44 +96,33 @@ class Decoder(object):
         return insn & (1 << 6)
 
     def decode(self, pc, mem):
+        if mem is self.mem:
+            try:
+                return self.cache[pc]
+            except KeyError:
+                pass
+        else:
+            self.mem = mem
+            self.cache = mem.code_cache(self)
+        rv = self.hooks.get(pc)
+        if rv is None:
+            rv = self.decode_uncached(pc, mem)
+        self.cache[pc] = rv
+        mem.mark_code(pc, rv[3])
+        return rv
+
+    def decode_uncached(self, pc, mem):
         if pc & 1:
             raise Exception('insn unaligned. pc: %x' % pc)
         insn = mem[pc]
-        if insn >> 12 == 1: # format 1
-            mode = insn >> 4 & 0x3
-            loc = insn & 0xf
-            size = 2
-            if (mode == 1 and loc != 3) or (mode == 3 and loc == 0):
-                data = as_signed(mem[pc+2])
-                size += 2
-            else:
-                data = None
-            return (self.format_one_handlers[insn >> 7 & 0x7],
-                    self.is_byte_insn(insn),
-                    [Address(mode, loc, data)], size)
-        elif insn >> 13 == 1: # jump
-            mask = 1 << 10
-            offset = (((insn & 0x3ff) + 1 << 1) ^ mask) - mask # convert to signed
-            return (self.condition_handlers[insn >> 10 & 0x7],
-                    self.is_byte_insn(insn),
-                    [offset], 2)
-        else: # format 2
-            src_mode = insn >> 4 & 0x3
-            src_loc = insn >> 8 & 0xf
-            size = 2
-            if (src_mode == 1 and src_loc != 3) or (src_mode == 3 and src_loc == 0):
-                src_data = as_signed(mem[pc+2])
-                size += 2
-            else:
-                src_data = None
-            dest_mode = insn >> 7 & 0x1
-            dest_loc = insn & 0xf
-            dest_data = None
-            if dest_mode == 1 and dest_loc != 3:
-                dest_data = as_signed(mem[pc+size])
-                size += 2
-            return (self.format_two_handlers[insn >> 12 & 0xf],
-                    self.is_byte_insn(insn),
-                    [Address(src_mode, src_loc, src_data),
-                     Address(dest_mode, dest_loc, dest_data)], size)
-
+        entry = TABLE[insn]
+        if entry is None:
+            entry = TABLE[insn] = decode_word(insn)
+        kind, opcode, is_byte_insn, args, extensions, size = entry
+        args = list(args)
+        addr = pc
+        for i in extensions:
+            addr += 2
+            arg = args[i]
+            args[i] = Address(arg.mode, arg.loc, as_signed(mem[addr]))
+        return (self.handler_tables[kind][opcode], is_byte_insn, args, size)
@@ -13,27 +13,44 @@ class Disassembler(object):
         return name[3:]
 
     def disassemble(self, pc, mem, limit_addr=sys.maxint, is_trace=False):
+        # formatted lines are kept until the memory under them is written
+        lines = mem.code_cache((self, is_trace))
         try:
             while pc < limit_addr and pc < len(mem):
-                name, is_byte_insn, args, size = self.decoder.decode(pc, mem)
-                is_ret = self.is_ret(name, args)
-                name, args = self.try_emulate_insn(name, args)
-                full_name = name
-                if name[0] == 'j':
-                    arg_str = '$%+x' % args[0]
-                    if not is_trace:
-                        arg_str += ' [%x]' % (args[0] + pc)
-                else:
-                    if is_byte_insn:
-                        full_name += '.b'
-                    arg_str = (', '.join(map(self.pretty_addr, args)))
-                yield pc, '%s\t' % full_name + arg_str
+                try:
+                    text, size, ends_block = lines[pc]
+                except KeyError:
+                    text, size, ends_block = lines[pc] = \
+                            self.format_insn(pc, mem, is_trace)
+                yield pc, text
                 pc += size
-                if (is_ret or name == 'jmp') and not is_trace:
+                if ends_block and not is_trace:
                     break
         except:
             yield pc, 'Failed to disassemble.'
 
+    def format_insn(self, pc, mem, is_trace=False):
+        """Returns (text, size, ends_block) for the insn at pc."""
+        name, is_byte_insn, args, size = self.decoder.decode(pc, mem)
+        is_ret = self.is_ret(name, args)
+        name, args = self.try_emulate_insn(name, args)
+        full_name = name
+        if name[0] == 'j':
+            arg_str = '$%+x' % args[0]
+            if not is_trace:
+                arg_str += ' [%x]' % (args[0] + pc)
+        else:
+            if is_byte_insn:
+                full_name += '.b'
+            arg_str = (', '.join(map(self.pretty_addr, args)))
+        return '%s\t' % full_name + arg_str, size, is_ret or name == 'jmp'
+
+    def disassemble_blocks(self, blocks, mem):
+        """Disassembles a function's BasicBlocks, in address order."""
+        for block in sorted(blocks, key=lambda block: block.start):
+            for line in self.disassemble(block.start, mem, block.end):
+                yield line
+
     reg_names = ['pc', 'sp', 'sr', 'cg']
 
     @staticmethod
@@ -80,10 +97,23 @@ class Disassembler(object):
         return name, args
 
 if __name__ == '__main__':
-    from emulator import Memory
     import os.path
+    from emulator import Memory
+    from cfg import analyze
     disassembler = Disassembler()
     with open(sys.argv[1]) as f:
-        mem = Memory(f, os.path.getsize(sys.argv[1]))
+        mem = Memory(f, min(os.path.getsize(sys.argv[1]), 0x10000))
+    if mem.size < 0x10000:
+        # a dump rather than a whole ROM, with no reset vector to analyse
+        # from: list it from the start, as it comes
         dis = disassembler.disassemble(0, mem, is_trace=True)
         print '\n'.join(line[1] for line in dis)
+        sys.exit(0)
+    cfg = analyze(mem)
+    for entry in sorted(cfg.functions):
+        function = cfg.functions[entry]
+        print '%04x:' % entry
+        blocks = [cfg.blocks[start] for start in function.blocks]
+        for line in disassembler.disassemble_blocks(blocks, mem):
+            print '  %04x: %s' % line
+        print
@@ -1,40 +1,133 @@
 #! /usr/bin/env python
 
 import sys
+from array import array
+from collections import namedtuple
+from StringIO import StringIO
 from termcolor import colored
 from util import as_signed
 from decoder import Decoder, Address
 from disassembler import Disassembler
-from memory import Registers, Memory
+from memory import Registers, Memory, ImageMemory, READ, WRITE
+from translator import Translator
+from idioms import Idioms
+from tracer import Tracer, BinaryTracer, ChunkedTracer
+import cfg
+from breakpoints import Breakpoint, compile_condition
+from history import History
+from iolog import IOLog, CALLGATES, read_log, log_inputs
+from profiler import Profiler
 
 PC, SP, SR, CG = range(4)
+CALLGATE = 0x10
 
 disassembler = Disassembler()
 
+# ways of holding memory; see memory.py
+MEMORY_BACKENDS = {'pages': Memory, 'image': ImageMemory}
+
+RunResult = namedtuple('RunResult',
+        ['unlocked', 'insn_count', 'output', 'registers', 'stop_reason'])
+
+MachineState = namedtuple('MachineState',
+        ['registers', 'pending', 'memory', 'callsites', 'call_targets',
+         'current_block_start', 'insn_count', 'door_unlocked'])
+
+class WatchpointHit(Exception):
+    """Stops Machine.run after an insn touches a watched address."""
+
+class NullOutput(object):
+
+    def write(self, s):
+        pass
+
 class Machine(object):
 
-    def __init__(self, fname):
+    def __init__(self, fname, engine='block', memory='pages'):
         self.fname = fname
+        if memory not in MEMORY_BACKENDS:
+            raise Exception('Unknown memory backend: %s' % memory)
+        self.memory_class = MEMORY_BACKENDS[memory]
+        if engine == 'block':
+            self.step = self.execute_block
+        elif engine == 'interp':
+            self.step = self.execute_next
+        else:
+            raise Exception('Unknown execution engine: %s' % engine)
+        self.engine = engine
         self.decoder = Decoder(self)
+        self.decoder.hooks[CALLGATE] = self.callgate_insn()
+        # interrupt number -> handler(machine); see register_callgate
+        self.callgates = dict(self.default_callgates)
+        # address -> handler(machine) run instead of the function there; see
+        # register_function
+        self.functions = {}
+        self.output_buffer = []
         self.breakpoints = {}
-        self.breakpoint_conditions = {}
+        # address -> (size, kinds of access)
+        self.watchpoints = {}
+        self.watch_hits = []
+        self.history = History()
+        # an IOLog, if recording the callgates
+        self.io_log = None
         self.prev_input = None
         self.hex_input_mode = False
         self.tracked_registers = set([SP])
+        self.interactive = True
+        self.trace = None
+        # an array('B') of 0x10000 edge hit counts, if recording coverage
+        self.coverage = None
+        # a Profiler, if profiling
+        self.profile = None
+        # stop fast-forwarding loops at this insn count, if set; see run()
+        self.insn_limit = None
+        self._cfg = None
+        self.load()
         self.reset()
 
-    def reset(self):
-        with open(self.fname) as f:
-            self.mem = Memory(f)
+    def load(self):
+        """Reads the ROM and records the power-on state for reset()."""
+        with open(self.fname, 'rb') as f:
+            self.mem = self.memory_class(f)
         self.door_unlocked = False
-        self.step_count = 1
-        self.break_at_finish = -1
         self.registers = Registers()
         self.registers[PC] = self.mem[0xfffe]
         self.call_targets = [self.registers[PC]]
         self.callsites = []
         self.current_block_start = self.registers[PC]
         self.insn_count = 0
+        self.translator = Translator(self)
+        # None runs loops an iteration at a time, like any other code
+        self.idioms = Idioms(self)
+        self.boot_state = self.snapshot()
+
+    def reset(self):
+        self.restore(self.boot_state)
+        self.step_count = 1
+        self.break_at_finish = -1
+
+    def snapshot(self):
+        """Captures registers, memory, the call stack and the flags. Memory
+        pages are shared with the snapshot until either side writes them."""
+        return MachineState(array('H', self.registers.regs),
+                self.registers.pending, self.mem.snapshot(),
+                tuple(self.callsites), tuple(self.call_targets),
+                self.current_block_start, self.insn_count, self.door_unlocked)
+
+    def restore(self, state):
+        if self.profile is not None:
+            self.profile.switch(self)
+        # registers are updated in place since translated code refers to them
+        self.registers.regs[:] = state.registers
+        self.registers.pending = state.pending
+        self.mem.restore(state.memory)
+        self.callsites = list(state.callsites)
+        self.call_targets = list(state.call_targets)
+        self.current_block_start = state.current_block_start
+        self.insn_count = state.insn_count
+        self.door_unlocked = state.door_unlocked
+        if self.profile is not None:
+            self.profile.mark = self.insn_count
 
     def debug(self, prog_input=raw_input, debug_input=raw_input,
             prog_output=sys.stdout, debug_output=sys.stdout,
@@ -44,17 +137,89 @@ class Machine(object):
         self.prog_output = prog_output
         self.debug_output = debug_output
         self.trace = trace
+        history = self.history
+        history.clear(self)
         try:
-            while self.execute_next():
-                pass
+            while self.step():
+                if self.insn_count >= history.next_checkpoint:
+                    history.checkpoint(self)
         except EOFError:
             self.display('EOF received. Bye!')
+        finally:
+            self.flush_output()
+
+    def run(self, inputs=(), max_insns=None, hex_input=False, trace=None):
+        """Runs from the current state without the debugger until the door
+        unlocks, the cpu turns off, `inputs` run out, an insn touches a
+        watchpoint (see watch()) or at least `max_insns` insns have been
+        executed in total. Each element of `inputs` answers one getsn
+        callgate, and may be an (input, hex) pair to choose the mode for
+        that answer alone. Returns a RunResult."""
+        self.go_headless(inputs, hex_input, trace)
+        stop_reason = 'max_insns'
+        self.insn_limit = max_insns
+        try:
+            while self.step():
+                if max_insns is not None and self.insn_count >= max_insns:
+                    break
+            else:
+                stop_reason = 'unlocked' if self.door_unlocked else 'cpuoff'
+        except EOFError:
+            # the callgate asking for input is left to run again, so that a
+            # snapshot taken now can be resumed with more input
+            self.insn_count -= 1
+            stop_reason = 'eof'
+        except WatchpointHit:
+            stop_reason = 'watchpoint'
+        finally:
+            self.interactive = True
+            self.insn_limit = None
+            # even if a run raises, its output goes with it
+            self.flush_output()
+        self.registers.flush()
+        return RunResult(self.door_unlocked, self.insn_count,
+                self.prog_output.getvalue(), tuple(self.registers.regs),
+                stop_reason)
+
+    def go_headless(self, inputs=(), hex_input=False, trace=None):
+        """Sets up for stepping without the debugger, answering getsn from
+        `inputs` as run() does. Program output collects in prog_output."""
+        inputs = iter(inputs)
+        def prog_input(prompt):
+            for s in inputs:
+                if isinstance(s, tuple):
+                    s, self.hex_input_mode = s
+                return s
+            raise EOFError
+        self.prog_input = prog_input
+        # anything left unflushed was an earlier run's
+        del self.output_buffer[:]
+        self.prog_output = StringIO()
+        self.debug_output = NullOutput()
+        self.trace = trace
+        self.hex_input_mode = hex_input
+        self.step_count = 0
+        self.interactive = False
 
     def display(self, v):
+        self.flush_output()
         self.debug_output.write(str(v) + '\n')
 
+    @property
+    def cfg(self):
+        """The ROM's control-flow graph, as loaded from disk. Code the
+        program writes at runtime isn't in it."""
+        if self._cfg is None:
+            self._cfg = cfg.load(self.fname)
+        return self._cfg
+
     def display_state(self):
-        lines = disassembler.disassemble(self.current_block_start, self.mem,
+        block = self.cfg.lookup(self.registers[PC])
+        if block is not None:
+            start = block.start
+        else:
+            start = self.current_block_start
+        lines = disassembler.disassemble(start, self.mem,
                 self.registers[PC] + 10)
         for line in lines:
             addr, insn = line
@@ -101,30 +266,111 @@ class Machine(object):
 
             if cmd == 'break':
                 target, sep, cond = rest.partition(' if ')
-                self.breakpoints[int(target, 16)] = -1
+                test = None
                 if cond != '':
-                    self.breakpoint_conditions[int(target, 16)] = \
-                            lambda: eval(cond, globals(), self.__dict__)
+                    try:
+                        test = compile_condition(cond, self, globals())
+                    except SyntaxError:
+                        self.display('Invalid condition')
+                        continue
+                addr = int(target, 16)
+                self.breakpoints[addr] = Breakpoint(addr, cond or None, test)
             elif cmd == 'unbreak':
                 if rest == 'all':
-                    self.breakpoints = set()
+                    self.breakpoints = {}
                 else:
                     try:
                         del self.breakpoints[int(rest, 16)]
-                        del self.breakpoint_conditions[int(rest, 16)]
                     except:
                         pass
+            elif cmd == 'ignore':
+                addr, sep, count = rest.partition(' ')
+                try:
+                    self.breakpoints[int(addr, 16)].ignore_count = int(count)
+                except:
+                    self.display('usage: ignore ADDR COUNT, for a breakpoint '
+                            'at ADDR')
             elif cmd == 'breakpoints':
                 self.display('List of breakpoints currently set:')
-                for b in self.breakpoints.keys():
-                    self.display('\t%x' % b)
+                for addr in sorted(self.breakpoints):
+                    self.display('\t%s' % self.breakpoints[addr])
+            elif cmd in ('watch', 'rwatch', 'awatch'):
+                kinds = {'watch': WRITE, 'rwatch': READ,
+                        'awatch': READ | WRITE}[cmd]
+                addr, sep, size = rest.partition(' ')
+                self.watch(int(addr, 16), int(size or '2', 16), kinds)
+            elif cmd == 'unwatch':
+                if rest == 'all':
+                    for addr in self.watchpoints.keys():
+                        self.unwatch(addr)
+                else:
+                    self.unwatch(int(rest, 16))
+            elif cmd == 'watchpoints':
+                self.display('List of watchpoints currently set:')
+                for addr in sorted(self.watchpoints):
+                    size, kinds = self.watchpoints[addr]
+                    self.display('\t%x-%x\t%s' % (addr, addr + size - 1,
+                        self.access_names[kinds]))
+            elif cmd == 'hook':
+                addr, sep, name = rest.partition(' ')
+                if name not in self.library_functions:
+                    self.display('usage: hook ADDR NAME, where NAME is one '
+                            'of %s' %
+                            ', '.join(sorted(self.library_functions)))
+                    continue
+                self.register_function(int(addr, 16),
+                        self.library_functions[name])
+            elif cmd == 'unhook':
+                if rest == 'all':
+                    for addr in self.functions.keys():
+                        self.unregister_function(addr)
+                else:
+                    try:
+                        self.unregister_function(int(rest, 16))
+                    except:
+                        pass
+            elif cmd == 'hooks':
+                self.display('List of functions replaced in Python:')
+                for addr in sorted(self.functions):
+                    self.display('\t%x\t%s' % (addr,
+                            self.functions[addr].__name__))
             elif cmd == 'track':
                 self.tracked_registers.add(int(rest))
             elif cmd == 'untrack':
                 self.tracked_registers.discard(int(rest))
             elif cmd == 'reset':
                 self.reset()
+                self.history.clear(self)
+                if self.io_log is not None:
+                    self.io_log.rewind(0)
+                # count the first insn, which runs as soon as this returns
+                self.insn_count += 1
                 break
+            elif cmd in ('rs', 'reverse-step'):
+                self.go_back(self.insn_count - 1 - int(rest or '1'))
+            elif cmd in ('rc', 'reverse-continue'):
+                def at_breakpoint():
+                    breakpoint = self.breakpoints.get(self.registers[PC])
+                    return breakpoint is not None and \
+                            (breakpoint.test is None or breakpoint.test())
+                self.go_back(self.find_last(at_breakpoint))
+            elif cmd in ('rf', 'reverse-finish'):
+                if not self.callsites:
+                    self.display('Not in a function call.')
+                    continue
+                depth = len(self.callsites) - 1
+                callsite = self.callsites[-1]
+                def at_call():
+                    return len(self.callsites) == depth and \
+                            self.registers[PC] == callsite
+                self.go_back(self.find_last(at_call))
+            elif cmd == 'history':
+                if rest != '':
+                    self.history.configure(*map(int, rest.split()))
+                self.display('Checkpoint every %d insns, keeping %d. Can go '
+                        'back to insn %d.' % (self.history.interval,
+                            self.history.checkpoints.maxlen,
+                            self.history.oldest()))
             elif cmd == 'print':
                 try:
                     self.display(eval(rest, globals(), self.__dict__))
@@ -161,20 +407,113 @@ class Machine(object):
                 self.break_at_finish = 0
                 break
             elif cmd == 'tbreak':
-                self.breakpoints[int(rest, 16)] = 1
+                addr = int(rest, 16)
+                self.breakpoints[addr] = Breakpoint(addr, temporary=True)
             elif cmd == 'bt':
                 self.print_backtrace()
             elif cmd == 'trace':
                 self.trace = Tracer(rest).trace
+            elif cmd == 'btrace':
+                self.trace = BinaryTracer(rest).trace
             elif cmd == 'disas':
                 addr = int(rest, 16)
-                lines = disassembler.disassemble(addr, self.mem,
-                        addr + 10)
+                function = self.cfg.function_at(addr)
+                if function is not None:
+                    lines = disassembler.disassemble_blocks(
+                            [self.cfg.blocks[start]
+                             for start in function.blocks], self.mem)
+                else:
+                    lines = disassembler.disassemble(addr, self.mem,
+                            addr + 10)
                 for line in lines:
                     print "%x: %s" % line
             else:
                 self.display('Unrecognized command')
 
+    # Going back in time. At the debugger prompt, insn_count already counts
+    # the insn at pc, so insn_count - 1 insns have run.
+
+    def replay(self, start, end, predicate=None):
+        """Restores the MachineState `start` and runs quietly until `end`
+        insns have run, feeding back the input recorded in history. Returns
+        the last insn count below `end` at which predicate(), if given, held
+        before the next insn ran."""
+        if self.profile is not None:
+            self.profile.switch(self)
+        saved = (self.prog_input, self.prog_output, self.debug_output,
+                self.trace, self.coverage, self.watchpoints, self.io_log,
+                self.profile, self.hex_input_mode, self.step_count,
+                self.break_at_finish)
+        self.flush_output()
+        inputs = self.history.inputs
+        def prog_input(prompt):
+            if self.insn_count not in inputs:
+                raise Exception('No input recorded for insn %d.' %
+                        self.insn_count)
+            s, self.hex_input_mode = inputs[self.insn_count]
+            return s
+        self.prog_input = prog_input
+        self.prog_output = self.debug_output = NullOutput()
+        self.trace = self.coverage = self.io_log = self.profile = None
+        self.watchpoints = {}
+        self.step_count = 0
+        self.break_at_finish = -1
+        self.interactive = False
+        self.restore(start)
+        found = None
+        try:
+            while self.insn_count < end:
+                if predicate is not None and predicate():
+                    found = self.insn_count
+                if not self.execute_next():
+                    break
+        finally:
+            del self.output_buffer[:] # already shown the first time round
+            (self.prog_input, self.prog_output, self.debug_output,
+                    self.trace, self.coverage, self.watchpoints, self.io_log,
+                    self.profile, self.hex_input_mode, self.step_count,
+                    self.break_at_finish) = saved
+            self.interactive = True
+            if self.profile is not None:
+                self.profile.mark = self.insn_count
+        return found
+
+    def find_last(self, predicate):
+        """Returns the last point in history, as a count of insns run, at
+        which predicate() held, or None. Works back a checkpoint at a
+        time."""
+        now = self.insn_count - 1
+        here = self.snapshot()
+        end = now
+        try:
+            for state in self.history.checkpoints_before(now):
+                found = self.replay(state, end, predicate)
+                if found is not None:
+                    return found
+                end = state.insn_count
+            return None
+        finally:
+            self.restore(here)
+
+    def go_back(self, position):
+        """Takes the machine back to when `position` insns had run."""
+        oldest = self.history.oldest()
+        if position is None or position < oldest:
+            self.display('Going back to the start of the recorded history.')
+            position = oldest
+        here = self.snapshot()
+        try:
+            self.replay(self.history.checkpoints_before(position)[0],
+                    position)
+        except Exception as e:
+            self.restore(here)
+            self.display('Could not go back: %s' % e)
+            return
+        self.history.forget_after(position)
+        if self.io_log is not None:
+            self.io_log.rewind(position)
+        self.insn_count += 1
+
     def print_backtrace(self):
         pc = self.registers[PC]
         i = 0
@@ -185,19 +524,73 @@ class Machine(object):
             i += 1
         self.display('')
 
+    access_names = {READ: 'read', WRITE: 'write', READ | WRITE: 'access'}
+
+    def watch(self, addr, size=2, kinds=WRITE):
+        """Stops after any insn that makes an access of one of `kinds`
+        (memory.READ, memory.WRITE) to the `size` bytes at addr. The debugger
+        prompts; run() returns with stop_reason 'watchpoint', and the
+        accesses are in watch_hits."""
+        self.watchpoints[addr] = (size, kinds)
+        self.update_watches()
+
+    def unwatch(self, addr):
+        self.watchpoints.pop(addr, None)
+        self.update_watches()
+
+    def update_watches(self):
+        watches = {}
+        for addr, (size, kinds) in self.watchpoints.iteritems():
+            for i in xrange(addr, addr + size):
+                watches[i & 0xffff] = watches.get(i & 0xffff, 0) | kinds
+        cls = self.memory_class
+        if watches:
+            cls = cls.watched
+        if self.mem.__class__ is not cls:
+            self.mem.__class__ = cls
+            # translated code holds on to the old class's accessors
+            self.translator.flush()
+        if watches:
+            self.mem.set_watches(watches)
+
+    def report_watch_hits(self, pc, hits):
+        self.watch_hits = hits
+        for addr, size, kind, old, new in self.watch_hits:
+            fmt = '%02x' if size == 1 else '%04x'
+            if kind == WRITE:
+                change = (fmt + ' -> ' + fmt) % (old, new)
+            else:
+                change = fmt % new
+            self.display('Watchpoint: %x %s by insn at %x: %s' % (addr,
+                'written' if kind == WRITE else 'read', pc, change))
+        if not self.interactive:
+            raise WatchpointHit()
+        self.step_count = 1
+
     def should_break(self, pc):
-        if pc not in self.breakpoints:
+        breakpoint = self.breakpoints.get(pc)
+        if breakpoint is None:
             return False
-        if pc in self.breakpoint_conditions:
-            return self.breakpoint_conditions[pc]()
-        return True
-
-    def execute_next(self):
-        cpuoff = self.registers[SR] & (1 << 4)
+        try:
+            return breakpoint.hit()
+        except Exception as e:
+            self.display('Error in the condition of breakpoint %x: %s' %
+                    (pc, e))
+            return True
+
+    def halted(self):
+        # a pending result always leaves CPUOFF clear
+        registers = self.registers
+        cpuoff = registers.pending is None and registers.regs[SR] & (1 << 4)
         if cpuoff:
             self.display('<CPUOFF bit set. Exiting.>')
         if cpuoff or self.door_unlocked:
             self.display('<Executed %d instructions.>' % self.insn_count)
+            return True
+        return False
+
+    def execute_next(self):
+        if self.halted():
             return False
         pc = self.registers[PC]
 
@@ -206,27 +599,25 @@ class Machine(object):
         if self.step_count > 0:
             self.step_count -= 1
 
-        should_break = self.should_break(pc)
-        if should_break:
-            if self.breakpoints[pc] == 1: # -1 is a permanent breakpoint
+        if self.interactive:
+            should_break = self.should_break(pc)
+            if should_break and self.breakpoints[pc].temporary:
                 del self.breakpoints[pc]
-                if pc in self.breakpoint_conditions:
-                    del self.breakpoint_conditions[pc]
-            elif self.breakpoints > 1:
-                self.breakpoints[pc] -= 1
 
-        if should_break or step_count == 1:
-            self.handle_cmds()
-        pc = self.registers[PC] # in case of reset
+            if should_break or step_count == 1:
+                self.handle_cmds()
+            pc = self.registers[PC] # in case of reset
+
+        if self.profile is not None:
+            self.profile.counts[pc] += 1
 
         is_ret = False
         is_call = False
-        if pc == 0x10:
-            self.handle_callgate(self.registers[SR])
-            self.mem[0x10] = 0x4130 # ret
-
         handler, is_byte_insn, args, size = self.decoder.decode(pc, self.mem)
         self.operand_bytes = 1 if is_byte_insn else 2
+        if self.watchpoints:
+            # from here on: fetching the insn isn't a read of its data
+            self.mem.watch_hits = []
 
         if handler is None:
             raise Exception('Failed to decode instruction at pc %x.' % pc)
@@ -236,7 +627,12 @@ class Machine(object):
         self.registers[PC] += 2
 
         if not self.peephole_execute(name, is_byte_insn, args, size):
-            if self.trace is not None:
+            if self.trace is not None and self.watchpoints:
+                # what the tracer reads doesn't count
+                hits, self.mem.watch_hits = self.mem.watch_hits, None
+                self.trace(pc, name, is_byte_insn, args, self)
+                self.mem.watch_hits = hits
+            elif self.trace is not None:
                 self.trace(pc, name, is_byte_insn, args, self)
 
             handler(*args)
@@ -246,30 +642,139 @@ class Machine(object):
 
         if self.registers[PC] == pc + 2:
             self.registers[PC] = self.next_pc
+            if self.coverage is not None and name[0] == 'j':
+                self.record_edge(pc, self.registers[PC])
         else:
-            self.current_block_start = self.registers[PC]
-            if self.break_at_finish >= 0:
-                if is_ret:
-                    self.break_at_finish -= 1
-                    if self.break_at_finish == -1:
-                        self.step_count = 1
-                elif is_call:
-                    self.break_at_finish += 1
-
-            if is_call:
-                self.callsites.append(pc)
-                self.call_targets.append(self.registers[PC])
-            elif is_ret:
-                self.callsites.pop()
-                self.call_targets.pop()
+            if self.coverage is not None:
+                self.record_edge(pc, self.registers[PC])
+            self.follow_branch(pc, is_call, is_ret)
+
+        if self.watchpoints:
+            hits = self.mem.watch_hits
+            self.mem.watch_hits = None
+            if hits:
+                self.report_watch_hits(pc, hits)
+        return True
 
+    def execute_block(self):
+        """Runs a whole translated block at a time. Anything that needs to
+        look at individual insns (stepping, tracing, breakpoints inside the
+        block, the callgate) goes through execute_next instead. Loops the
+        idioms know are fast-forwarded to their last iteration first, unless
+        there are watchpoints."""
+        if self.halted():
+            return False
+        regs = self.registers.regs
+        block = self.translator.lookup(regs[PC])
+        if block is None or self.step_count > 0 or self.trace is not None or \
+                self.interactive and self.breakpoints and \
+                block.contains_any(self.breakpoints):
+            return self.execute_next()
+
+        ops = block.ops
+        n = len(ops)
+        hits = None
+        if self.watchpoints:
+            hits = []
+            if not self.execute_watched_ops(block, hits):
+                return True
+        else:
+            if block.loop is not False and self.idioms is not None:
+                self.idioms.run(block)
+            for i in xrange(n):
+                ops[i]()
+                if not block.valid and i + 1 < n:
+                    self.stop_block(block, i)
+                    return True
+        self.insn_count += n
+        profile = self.profile
+        if profile is not None:
+            profile.blocks[block] = profile.blocks.get(block, 0) + 1
+
+        pc = block.branch_pc
+        if pc is None or regs[PC] == pc + 2:
+            regs[PC] = block.end
+            if self.coverage is not None and block.is_jump:
+                self.record_edge(pc, regs[PC])
+        else:
+            if self.coverage is not None:
+                self.record_edge(pc, regs[PC])
+            self.follow_branch(pc, block.is_call, block.is_ret)
+        if hits:
+            self.report_watch_hits(block.pcs[-1], hits)
         return True
 
+    def execute_watched_ops(self, block, hits):
+        """Runs a block's ops with the watched memory noting accesses in
+        `hits`, which costs an unwatched access the one lookup in
+        watch_pages. The fast-forwarded loops of the idioms would access
+        memory outside any insn, so they're left to run an insn at a time.
+        Stops after an insn that hits a watchpoint, or that overwrites the
+        block, and reports any hits. Returns whether every op ran."""
+        ops = block.ops
+        n = len(ops)
+        self.mem.watch_hits = hits
+        try:
+            for i in xrange(n):
+                ops[i]()
+                if i + 1 < n and (hits or not block.valid):
+                    break
+            else:
+                return True
+        finally:
+            self.mem.watch_hits = None
+        self.stop_block(block, i)
+        if hits:
+            self.report_watch_hits(block.pcs[i], hits)
+        return False
+
+    def stop_block(self, block, i):
+        """Accounts for a block left after the op at `i`, carrying on from
+        the next insn: with a fresh translation, if the block overwrote its
+        own code."""
+        self.insn_count += i + 1
+        self.registers.regs[PC] = block.pcs[i + 1]
+        if self.profile is not None:
+            for pc in block.pcs[:i + 1]:
+                self.profile.counts[pc] += 1
+
+    def record_edge(self, pc, dest, n=1):
+        """Counts `n` control transfers from the insn at `pc` to `dest` in
+        the coverage bitmap. Jumps count whether or not they are taken."""
+        i = (pc * 0x9e37 ^ dest) & 0xffff
+        count = self.coverage[i]
+        if count != 0xff:
+            self.coverage[i] = min(count + n, 0xff)
+
+    def follow_branch(self, pc, is_call, is_ret):
+        self.current_block_start = self.registers[PC]
+        if self.break_at_finish >= 0:
+            if is_ret:
+                self.break_at_finish -= 1
+                if self.break_at_finish == -1:
+                    self.step_count = 1
+            elif is_call:
+                self.break_at_finish += 1
+
+        if self.profile is not None and (is_call or is_ret):
+            self.profile.switch(self)
+        if is_call:
+            self.callsites.append(pc)
+            self.call_targets.append(self.registers[PC])
+        elif is_ret:
+            self.callsites.pop()
+            self.call_targets.pop()
+
     def peephole_execute(self, name, is_byte_insn, args, size):
         if not (name == 'jnz' and args[0] == -2):
             return False
 
+        if self.watchpoints:
+            # fetching the insn before isn't a read of its data either
+            hits, self.mem.watch_hits = self.mem.watch_hits, None
         prev_insn_data = self.decoder.decode(self.registers[PC] - 4, self.mem)
+        if self.watchpoints:
+            self.mem.watch_hits = hits
         prev_handler, prev_is_byte_insn, prev_args, prev_size = prev_insn_data
         if not (prev_handler.__name__[3:] == 'add' and \
                 prev_args[0] == Address(3, 3, None) and \
@@ -384,12 +889,18 @@ class Machine(object):
         self.registers[SR] |= v
 
     def set_status_result_bits(self, v):
-        self.registers[SR] = 0
-        bit_count = self.operand_bytes * 8
-        mask = (1 << bit_count) - 1
-        self.negative = (v & mask) >> 15 & 1
-        self.zero = int((v & mask) == 0)
-        self.carry = v >> 16 & 1
+        # Clears sr, then sets negative from bit 15 and zero from the low
+        # operand_bytes of v, and carry from bit 16. That only depends on
+        # these bits, so keep them and let Registers work sr out on demand.
+        if self.operand_bytes == 1:
+            self.registers.pending = v & 0x100ff
+        else:
+            self.registers.pending = v & 0x1ffff
+
+    def set_logic_result_bits(self, v):
+        """Like set_status_result_bits, but carry is the inverse of zero."""
+        r = v & ((1 << self.operand_bytes * 8) - 1)
+        self.registers.pending = r | (r != 0) << 16
 
     def do_mov(self, src, dest):
         self.set_addr(dest, self.get_addr(src))
@@ -427,14 +938,12 @@ class Machine(object):
 
     def do_xor(self, src, dest):
         v = self.get_addr(dest) ^ self.get_addr(src)
-        self.set_status_result_bits(v)
-        self.carry = 1 - self.zero
+        self.set_logic_result_bits(v)
         self.set_addr(dest, v)
 
     def do_and(self, src, dest):
         v = self.get_addr(dest) & self.get_addr(src)
-        self.set_status_result_bits(v)
-        self.carry = 1 - self.zero
+        self.set_logic_result_bits(v)
         self.set_addr(dest, v)
 
     def do_push(self, src):
@@ -480,8 +989,7 @@ class Machine(object):
 
     def do_sxt(self, dest):
         v = as_signed(self.get_addr(dest), 8)
-        self.set_status_result_bits(v)
-        self.carry = 1 - self.zero
+        self.set_logic_result_bits(v)
         self.set_addr(dest, v)
 
     def do_rrc(self, dest):
@@ -529,64 +1037,318 @@ class Machine(object):
             self.negative = negative
         self.set_addr(dest, v)
 
+    # The callgate. Programs call 0x10 with an interrupt number in sr; the
+    # handlers below are looked up by that number in self.callgates, and
+    # register_callgate replaces or adds one.
+
+    def register_callgate(self, interrupt, handler):
+        """Makes handler(machine) run when the program calls the callgate
+        with `interrupt`. Arguments are on the stack, from sp + 8."""
+        self.callgates[interrupt] = handler
+
+    def callgate_insn(self):
+        """Returns the decoded insn for 0x10: the ret the callgate leaves
+        there, run after the callgate's handler. Hooking it into the decoder
+        means nothing is checked on the way through any other insn."""
+        def do_mov(src, dest): # named for the insn it stands in for
+            try:
+                self.handle_callgate(self.registers[SR])
+            except EOFError:
+                # leave the callgate to run again; see run()
+                self.registers[PC] = CALLGATE
+                raise
+            self.mem[CALLGATE] = 0x4130 # ret
+            self.do_mov(src, dest)
+        return (do_mov, False, [Address(3, SP, None), Address(0, PC, None)],
+                2)
+
     def handle_callgate(self, sr):
         if not sr >> 15 & 1:
             return
         interrupt = sr >> 8 & 0x7f
-        if interrupt == 0:
-            self.prog_output.write(chr(self.mem.get_byte(self.registers[SP] + 8)))
-        elif interrupt == 2:
-            while True:
-                addr = self.mem[self.registers[SP] + 8]
-                max_len = self.mem[self.registers[SP] + 10]
+        handler = self.callgates.get(interrupt)
+        if handler is None:
+            raise Exception('NYI: Interrupt %x' % interrupt)
+        if interrupt in CALLGATES and interrupt not in (0, 2):
+            self.log_callgate(CALLGATES[interrupt])
+        handler(self)
+
+    def log_callgate(self, name):
+        if self.io_log is not None:
+            self.io_log.write(self.insn_count, name)
+
+    def flush_output(self):
+        """Writes out what the program has putchar'd since the last flush.
+        Output is batched, and flushed before anything else is shown."""
+        if self.output_buffer:
+            self.prog_output.write(''.join(self.output_buffer))
+            del self.output_buffer[:]
+
+    def callgate_putchar(self):
+        self.putchar(chr(self.mem.get_byte(self.registers[SP] + 8)))
+
+    def putchar(self, c):
+        self.output_buffer.append(c)
+        if c == '\n' and self.interactive:
+            self.flush_output()
+        if self.io_log is not None:
+            self.io_log.putchar(self.insn_count, c)
+
+    def callgate_getsn(self):
+        self.getsn(self.mem[self.registers[SP] + 8],
+                self.mem[self.registers[SP] + 10])
+
+    def getsn(self, addr, max_len):
+        """Reads a line of program input into memory at `addr`."""
+        self.flush_output()
+        while True:
+            try:
+                s = self.prog_input('(max: %d; mode: %s)> ' %
+                        (max_len, 'hex' if self.hex_input_mode else 'char'))
+            except KeyboardInterrupt:
+                if not self.interactive:
+                    raise
+                self.handle_cmds()
+                continue
+            if self.hex_input_mode:
+                s = s.replace(' ', '')
+                if len(s) % 2 != 0:
+                    self.display('Hex input should have an even length.')
+                    continue
                 try:
-                    s = self.prog_input('(max: %d; mode: %s)> ' %
-                            (max_len, 'hex' if self.hex_input_mode else 'char'))
-                except KeyboardInterrupt:
-                    self.handle_cmds()
+                    for i in xrange(0, min(len(s) / 2, max_len)):
+                        self.mem.set_byte(addr + i, int(s[i*2:(i+1)*2], 16))
+                except Exception as e:
+                    self.display('Error parsing hex input: ' + e.message)
                     continue
-                if self.hex_input_mode:
-                    s = s.replace(' ', '')
-                    if len(s) % 2 != 0:
-                        self.display('Hex input should have an even length.')
-                        continue
-                    try:
-                        for i in xrange(0, min(len(s) / 2, max_len)):
-                            self.mem.set_byte(addr + i, int(s[i*2:(i+1)*2], 16))
-                    except Exception as e:
-                        self.display('Error parsing hex input: ' + e.message)
-                        continue
-                else:
-                    s = s[:max_len]
-                    for i, c in enumerate(s):
-                        self.mem.set_byte(addr + i, ord(c))
-                    self.mem.set_byte(addr + len(s), 0)
-                break
+            else:
+                s = s[:max_len]
+                self.mem.write(addr, s + '\0')
+            if self.interactive:
+                self.history.record_input(self.insn_count, s,
+                        self.hex_input_mode)
+            if self.io_log is not None:
+                self.io_log.getsn(self.insn_count, s, self.hex_input_mode)
+            break
+        if self.interactive:
             self.step_count = 1
-        elif interrupt == 0x20: # rand
-            self.registers[15] = 0 # not actually random
-        elif interrupt == 0x7d: # is password correct?
-            flag_location = self.mem[self.registers[SP] + 10]
-            self.mem[flag_location] = 0 # always false
-        elif interrupt == 0x7e:
-            self.mem[15] = 0 # always false
-        elif interrupt == 0x7f:
-            self.door_unlocked = True
-            self.display('<Door unlocked!>')
-        else:
-            raise Exception('NYI: Interrupt %x' % interrupt)
+
+    def callgate_rand(self):
+        self.registers[15] = 0 # not actually random
+
+    def callgate_check(self):
+        """HSM-1: is the password correct?"""
+        flag_location = self.mem[self.registers[SP] + 10]
+        self.mem[flag_location] = 0 # always false
+
+    def callgate_check_hsm(self):
+        """HSM-2: unlocks the door itself if the password is correct."""
+        self.mem[15] = 0 # always false
+
+    def callgate_unlock(self):
+        self.door_unlocked = True
+        self.display('<Door unlocked!>')
+
+    default_callgates = {0: callgate_putchar, 2: callgate_getsn,
+            0x20: callgate_rand, 0x7d: callgate_check,
+            0x7e: callgate_check_hsm, 0x7f: callgate_unlock}
+
+    # Functions replaced in Python. When the program gets to one of them,
+    # a handler runs in place of its code and then a ret, so that library
+    # code needn't be emulated an insn at a time.
+
+    def register_function(self, addr, handler):
+        """Makes handler(machine) run instead of the function at `addr`.
+        Arguments are in r15, r14 and r13 and the result goes in r15, as
+        the ROMs' own functions have them; the handler may leave r12-r14 as
+        they were, where the ROM's code would have changed them."""
+        self.functions[addr] = handler
+        self.decoder.hooks[addr] = self.function_insn(addr, handler)
+        # drop what was decoded or translated from the code there
+        self.mem.invalidate(addr, 2)
+
+    def unregister_function(self, addr):
+        del self.functions[addr]
+        del self.decoder.hooks[addr]
+        self.mem.invalidate(addr, 2)
+
+    def function_insn(self, addr, handler):
+        """Returns the decoded insn for a replaced function: a ret, run
+        after the handler, as at the callgate."""
+        def do_mov(src, dest): # named for the insn it stands in for
+            try:
+                handler(self)
+            except EOFError:
+                # leave the function to run again; see run()
+                self.registers[PC] = addr
+                raise
+            self.do_mov(src, dest)
+        return (do_mov, False, [Address(3, SP, None), Address(0, PC, None)],
+                2)
+
+    def function_putchar(self):
+        self.putchar(chr(self.registers[15] & 0xff))
+
+    def function_puts(self):
+        addr = self.registers[15]
+        while True:
+            c = self.mem.get_byte(addr)
+            if c == 0:
+                break
+            self.putchar(chr(c))
+            addr += 1
+        self.putchar('\n')
+
+    def function_getsn(self):
+        self.getsn(self.registers[15], self.registers[14])
+
+    def function_strcpy(self):
+        dest, src = self.registers[15], self.registers[14]
+        n = 0
+        while self.mem.get_byte(src + n):
+            n += 1
+        self.mem.write(dest, self.mem.read(src, n + 1))
+
+    def function_memset(self):
+        dest, c, n = self.registers[15], self.registers[14], self.registers[13]
+        self.mem.write(dest, chr(c & 0xff) * n)
+
+    def function_test_password_valid(self):
+        """HSM-1, as callgate_check answers it."""
+        self.log_callgate('check')
+        self.registers[15] = 0
+
+    def function_conditional_unlock_door(self):
+        """HSM-2, as callgate_check_hsm answers it."""
+        self.log_callgate('check_hsm')
+        self.registers[15] = 0
+
+    def function_unlock_door(self):
+        self.log_callgate('unlock')
+        self.callgate_unlock()
+
+    # name -> handler, for the debugger's hook command and --hook
+    library_functions = {'putchar': function_putchar, 'puts': function_puts,
+            'getsn': function_getsn, 'strcpy': function_strcpy,
+            'memset': function_memset,
+            'test_password_valid': function_test_password_valid,
+            'conditional_unlock_door': function_conditional_unlock_door,
+            'unlock_door': function_unlock_door}
 
 
 if __name__ == '__main__':
     import sys
+    import atexit
     import argparse
-    from tracer import Tracer
     parser = argparse.ArgumentParser()
     parser.add_argument('-t', help='trace')
+    parser.add_argument('-T', help='binary trace; see tracedump.py')
+    parser.add_argument('-z', action='store_true',
+            help='write the -t trace as compressed chunks with an index; '
+                 'see tracequery.py')
+    parser.add_argument('-e', choices=['block', 'interp'], default='block',
+            help='execution engine; interp runs one insn at a time')
+    parser.add_argument('-m', choices=sorted(MEMORY_BACKENDS),
+            default='pages', help='memory backend')
+    parser.add_argument('-b', action='store_true',
+            help='batch mode: run without the debugger and print the result')
+    parser.add_argument('-i', action='append',
+            help='program input for batch mode, once per getsn call. '
+                 'Without it, every line of stdin is a separate run')
+    parser.add_argument('-n', type=int,
+            help='stop batch runs after this many insns')
+    parser.add_argument('-x', action='store_true',
+            help='treat batch program input as hexadecimal')
+    parser.add_argument('--record',
+            help='log every callgate with its insn count to this file')
+    parser.add_argument('--replay',
+            help='run without the debugger, answering getsn from a '
+                 '--record log, and check the callgates match it')
+    parser.add_argument('--hook', action='append', default=[],
+            metavar='ADDR=NAME',
+            help='run the Python version of a library function (one of %s) '
+                 'in place of the function at ADDR' %
+                 ', '.join(sorted(Machine.library_functions)))
+    parser.add_argument('--profile', action='store_true',
+            help='count the insns run per pc, function and opcode, and '
+                 'print the busiest to stderr at the end')
+    parser.add_argument('--collapsed',
+            help='profile, and write the insns run per call stack to this '
+                 'file for flamegraph.pl')
     args, rest = parser.parse_known_args()
-    if args.t is not None:
+    if args.t is not None and args.z:
+        trace = ChunkedTracer(args.t).trace
+    elif args.t is not None:
         trace = Tracer(args.t).trace
+    elif args.T is not None:
+        trace = BinaryTracer(args.T).trace
     else:
         trace = None
-    machine = Machine(rest[0])
-    machine.debug(trace=trace)
+    machine = Machine(rest[0], args.e, args.m)
+    for hook in args.hook:
+        addr, sep, name = hook.partition('=')
+        if name not in Machine.library_functions:
+            parser.error('unknown library function: %s' % name)
+        machine.register_function(int(addr, 16),
+                Machine.library_functions[name])
+    if args.record is not None:
+        if args.b and args.i is None:
+            parser.error('--record needs -i in batch mode')
+        machine.io_log = IOLog(args.record, cfg.rom_hash(rest[0]))
+    if args.profile or args.collapsed is not None:
+        profile = Profiler()
+        profile.attach(machine)
+        def write_profile():
+            profile.switch(machine)
+            if args.profile:
+                profile.report(machine.mem, sys.stderr)
+            if args.collapsed is not None:
+                with open(args.collapsed, 'w') as f:
+                    profile.write_collapsed(f)
+        atexit.register(write_profile)
+
+    if args.replay is not None:
+        with open(args.replay) as f:
+            rom_hash, events = read_log(f)
+        if rom_hash != cfg.rom_hash(rest[0]):
+            sys.stderr.write('warning: the log was recorded with another '
+                    'ROM\n')
+        replayed = StringIO()
+        machine.io_log = IOLog(replayed, rom_hash)
+        result = machine.run(log_inputs(events), args.n, trace=trace)
+        replayed.seek(0)
+        got = read_log(replayed)[1]
+        print '%s\t%d\t%r' % (result.stop_reason, result.insn_count,
+                result.output)
+        for i, (expected, actual) in enumerate(zip(events, got)):
+            if expected != actual:
+                print 'diverged at callgate %d: expected %s, got %s' % (i,
+                        ' '.join(map(str, expected[:2]) + expected[2]),
+                        ' '.join(map(str, actual[:2]) + actual[2]))
+                sys.exit(1)
+        print 'matched %d of %d logged callgates' % (len(got), len(events))
+        sys.exit(0)
+
+    if not args.b:
+        machine.debug(trace=trace)
+        sys.exit(0)
+
+    if args.i is not None:
+        candidates = [args.i]
+    else:
+        candidates = ([line.rstrip('\n')] for line in sys.stdin)
+    for inputs in candidates:
+        machine.reset()
+        try:
+            result = machine.run(inputs, args.n, args.x, trace)
+        except Exception as e:
+            # as bruteforce.py has it: this candidate crashed, the rest
+            # still run
+            machine.registers.flush()
+            result = RunResult(machine.door_unlocked, machine.insn_count,
+                    str(e), tuple(machine.registers.regs), 'crash')
+        print '%s\t%s\t%d\t%r' % (' '.join(inputs), result.stop_reason,
+                result.insn_count, result.output)
+        if args.i is not None:
+            print ' '.join('%s: %04x' % (Disassembler.pretty_reg(i), r)
+                    for i, r in enumerate(result.registers))
@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+
+import re
+import random
+from array import array
+from emulator import Machine, SP
+
+# AFL-style hit count buckets, so that running a loop a different number of
+# times (say, matching one more character of a password) counts as new
+# behaviour
+BUCKETS = array('B', [0, 1, 2, 4] + [8] * 4 + [16] * 8 + [32] * 16 +
+        [64] * 96 + [128] * 128)
+
+NONZERO = re.compile('[^\x00]')
+
+INTERESTING_BYTES = [0x00, 0x01, 0x0a, 0x20, 0x41, 0x7f, 0x80, 0xff]
+
+class Fuzzer(object):
+    """Mutates input for the first getsn callgate of a ROM, keeping the
+    inputs that reach new edges as the base for further mutations."""
+
+    def __init__(self, fname, engine='block', max_insns=100000, seeds=('',)):
+        self.machine = Machine(fname, engine)
+        self.max_insns = max_insns
+        result = self.machine.run(max_insns=max_insns)
+        if result.stop_reason != 'eof':
+            raise Exception('Program finished without asking for input (%s).'
+                    % result.stop_reason)
+        self.start_state = self.machine.snapshot()
+        self.max_len = self.machine.mem[self.machine.registers[SP] + 10]
+        self.coverage = array('B', [0]) * 0x10000
+        self.empty = array('B', [0]) * 0x10000
+        self.seen = array('B', [0]) * 0x10000
+        self.dictionary = self.find_strings()
+        self.corpus = []
+        self.executions = 0
+        self.seeds = list(seeds)
+
+    def find_strings(self, min_len=4):
+        mem = self.machine.mem
+        data = mem.read(0, len(mem))
+        return re.findall('[\x20-\x7e]{%d,}' % min_len, data)
+
+    def execute(self, data):
+        """Runs `data` from the snapshot. Returns (outcome, detail) where
+        outcome is 'unlocked', 'crash' or the RunResult stop_reason."""
+        m = self.machine
+        m.restore(self.start_state)
+        self.coverage[:] = self.empty
+        m.coverage = self.coverage
+        self.executions += 1
+        try:
+            result = m.run([data], self.max_insns)
+        except Exception as e:
+            return 'crash', str(e)
+        finally:
+            m.coverage = None
+        if result.unlocked:
+            return 'unlocked', result.output
+        return result.stop_reason, result.output
+
+    def has_new_bits(self):
+        new = False
+        coverage = self.coverage
+        seen = self.seen
+        for match in NONZERO.finditer(coverage.tostring()):
+            i = match.start()
+            bucket = BUCKETS[coverage[i]]
+            if not seen[i] & bucket:
+                seen[i] |= bucket
+                new = True
+        return new
+
+    def mutate(self, data):
+        data = bytearray(data)
+        for _ in xrange(random.randint(1, 4)):
+            op = random.randint(0, 7)
+            pos = random.randint(0, len(data))
+            if op == 0 and data:
+                data[pos % len(data)] ^= 1 << random.randint(0, 7)
+            elif op == 1 and data:
+                data[pos % len(data)] = random.randint(0, 0xff)
+            elif op == 2 and data:
+                data[pos % len(data)] = random.choice(INTERESTING_BYTES)
+            elif op == 3:
+                data[pos:pos] = chr(random.randint(0x20, 0x7e))
+            elif op == 4 and data:
+                del data[pos % len(data):pos % len(data) + random.randint(1, 4)]
+            elif op == 5 and self.dictionary:
+                data[pos:pos] = random.choice(self.dictionary)
+            elif op == 6 and self.corpus:
+                other = random.choice(self.corpus)
+                data = data[:pos] + other[random.randint(0, len(other)):]
+            else:
+                data += chr(random.randint(0x20, 0x7e)) * random.randint(1, 8)
+        return str(data[:self.max_len])
+
+    def fuzz(self, iterations=None, stop_on_unlock=True):
+        """Generates ('new', input), ('unlocked', input) and ('crash', input,
+        detail) events as the corpus grows."""
+        i = 0
+        while iterations is None or i < iterations:
+            if self.seeds:
+                data = self.seeds.pop(0)
+            elif self.corpus:
+                data = self.mutate(random.choice(self.corpus))
+            else:
+                data = self.mutate('')
+            i += 1
+            outcome, detail = self.execute(data)
+            if outcome == 'unlocked':
+                yield 'unlocked', data
+                if stop_on_unlock:
+                    return
+            elif outcome == 'crash':
+                yield 'crash', data, detail
+            if self.has_new_bits():
+                self.corpus.append(data)
+                yield 'new', data
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('romfile')
+    parser.add_argument('-s', action='append', default=[''],
+            help='seed input; may be repeated')
+    parser.add_argument('-i', type=int, help='stop after this many runs')
+    parser.add_argument('-n', type=int, default=100000,
+            help='give up on a run after this many insns')
+    parser.add_argument('-e', choices=['block', 'interp'], default='block')
+    parser.add_argument('--all', action='store_true',
+            help='keep going after the first unlock')
+    args = parser.parse_args()
+
+    fuzzer = Fuzzer(args.romfile, args.e, args.n, args.s)
+    start = time.time()
+    for event in fuzzer.fuzz(args.i, not args.all):
+        rate = fuzzer.executions / max(time.time() - start, 1e-9)
+        print '[%d runs, %.0f/s, corpus %d] %s %r' % (fuzzer.executions,
+                rate, len(fuzzer.corpus), event[0], event[1]),
+        if len(event) > 2:
+            print event[2],
+        print
@@ -0,0 +1,58 @@
+from collections import deque
+
+class History(object):
+    """What the debugger needs to go back in time: a machine snapshot every
+    `interval` insns, keeping only the latest `count`, and the program input
+    given since the oldest of them. Any earlier point can then be reached
+    by restoring the snapshot before it and running forward again, which
+    gives the same results as long as the same input is fed back in.
+
+    Snapshots share unchanged memory pages, so the memory used is bounded
+    by `count` times the pages a stretch of `interval` insns writes."""
+
+    def __init__(self, interval=10000, count=100):
+        self.interval = interval
+        self.checkpoints = deque(maxlen=count)
+        # insn_count at the getsn callgate -> (input, hex_input_mode)
+        self.inputs = {}
+        self.next_checkpoint = 0
+
+    def configure(self, interval, count=None):
+        self.interval = interval
+        self.checkpoints = deque(self.checkpoints,
+                count or self.checkpoints.maxlen)
+        self.next_checkpoint = self.checkpoints[-1].insn_count + interval
+
+    def checkpoint(self, machine):
+        self.checkpoints.append(machine.snapshot())
+        self.next_checkpoint = machine.insn_count + self.interval
+        oldest = self.checkpoints[0].insn_count
+        for n in [n for n in self.inputs if n < oldest]:
+            del self.inputs[n]
+
+    def record_input(self, insn_count, s, hex_input_mode):
+        self.inputs[insn_count] = (s, hex_input_mode)
+
+    def oldest(self):
+        return self.checkpoints[0].insn_count
+
+    def checkpoints_before(self, position):
+        """Returns the checkpoints at or before `position`, latest first."""
+        return [state for state in reversed(self.checkpoints)
+                if state.insn_count <= position]
+
+    def forget_after(self, position):
+        """Drops what was recorded after `position`, which is about to be
+        run again, maybe differently."""
+        while self.checkpoints and \
+                self.checkpoints[-1].insn_count > position:
+            self.checkpoints.pop()
+        for n in [n for n in self.inputs if n > position]:
+            del self.inputs[n]
+        self.next_checkpoint = self.checkpoints[-1].insn_count + \
+                self.interval
+
+    def clear(self, machine):
+        self.checkpoints.clear()
+        self.inputs.clear()
+        self.checkpoint(machine)
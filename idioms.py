@@ -0,0 +1,539 @@
+import struct
+from array import array
+from collections import defaultdict
+from util import as_signed
+
+PC, SP, SR, CG = range(4)
+
+# operands: (CONST, value), (REG, n) or (MEM, base register or None for an
+# absolute address, offset, autoincrement)
+CONST, REG, MEM = range(3)
+
+# loop body ops: (STEP, n, amount) adds a constant to a register;
+# (MOV, src, dest, width); (TEST, kind, a, b, width) sets the flags, from
+# a alone (b then being what the insn added to get it) or as a cmp of a
+# with b; (EXIT, if_taken) is a jnz that stays in the loop only if it is
+# (or isn't) taken
+STEP, MOV, TEST, EXIT = range(4)
+ZERO, EQUAL = range(2)
+
+WORD = struct.Struct('<H')
+
+def operand(arg):
+    """Returns the operand for an Address, or None for one loops here may
+    not use: anything on pc, sp or sr besides constants and absolute
+    addresses."""
+    mode, loc, data = arg
+    if loc == CG:
+        return (CONST, (0, 1, 2, 0xffff)[mode])
+    if loc == SR:
+        if mode == 1:
+            return (MEM, None, data, False)
+        if mode >= 2:
+            return (CONST, 1 << mode)
+        return None
+    if loc == PC:
+        if mode == 3:
+            return (CONST, data)
+        return None
+    if loc == SP:
+        return None
+    if mode == 0:
+        return (REG, loc)
+    if mode == 1:
+        return (MEM, loc, data, False)
+    return (MEM, loc, 0, mode == 3)
+
+def pack(v, width):
+    return chr(v & 0xff) if width == 1 else WORD.pack(v & 0xffff)
+
+def first_zero(values, width):
+    """Returns the index of the first zero among the `width`-byte values in
+    a string, or how many values there are."""
+    zero = '\0' * width
+    i = values.find(zero)
+    while i > 0 and i % width:
+        i = values.find(zero, i + 1)
+    return len(values) / width if i < 0 else i / width
+
+def common_prefix(a, b):
+    """Returns the length of the longest common prefix of two strings."""
+    if a == b:
+        return len(a)
+    # a[:lo] == b[:lo] and a[:hi] != b[:hi]
+    lo, hi = 0, min(len(a), len(b))
+    while hi - lo > 1:
+        mid = (lo + hi) / 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+class Stop(Exception):
+    """An iteration left the loop, or can't be run here."""
+
+class Loop(object):
+    """A loop of one or two translated blocks that only moves data, steps
+    registers by constants and compares: memset, memcpy, strlen, strcmp and
+    the like. Its iterations can be run without the blocks, on the
+    registers and memory directly; all of them at once when the loop is
+    simple enough to tell beforehand how many there will be (see plan()).
+
+    The iteration that leaves the loop is never run here, so the blocks
+    still run it themselves and leave the flags, pc and call stack as
+    they would have. The flags the last iteration run here leaves are set
+    too, for when that one crashes before it sets its own."""
+
+    def __init__(self, machine, blocks, ops):
+        self.m = machine
+        self.blocks = blocks
+        self.ops = ops
+        self.insns = sum(len(block) for block in blocks)
+        self.bulk = self.plan()
+
+    def run(self, cap):
+        """Runs up to `cap` iterations that stay in the loop and accounts
+        for them as the blocks would have. Returns how many ran."""
+        m = self.m
+        regs = m.registers.regs
+        r = list(regs)
+        k = 0
+        flags = None
+        try:
+            if self.bulk is not None:
+                k = self.bulk(r, cap)
+            while k < cap:
+                result = self.iterate(r)
+                if result is None:
+                    break
+                flags = result
+                k += 1
+        finally:
+            if k:
+                regs[4:] = array('H', r[4:])
+                if flags is not None:
+                    m.registers.pending = flags
+                m.insn_count += k * self.insns
+                m.current_block_start = self.blocks[0].start
+                if m.profile is not None:
+                    blocks = m.profile.blocks
+                    for block in self.blocks:
+                        blocks[block] = blocks.get(block, 0) + k
+                if m.coverage is not None:
+                    for block in self.blocks[:-1]:
+                        m.record_edge(block.branch_pc, block.end, k)
+                    last = self.blocks[-1]
+                    m.record_edge(last.branch_pc, self.blocks[0].start, k)
+        return k
+
+    # One iteration at a time.
+
+    def address(self, r, arg, width):
+        base = arg[1]
+        addr = arg[2] if base is None else r[base] + arg[2]
+        if addr + width > 0x10000:
+            raise Stop
+        return addr
+
+    def load(self, r, arg, width):
+        kind = arg[0]
+        if kind == CONST:
+            v = arg[1]
+        elif kind == REG:
+            v = r[arg[1]]
+        else:
+            addr = self.address(r, arg, width)
+            mem = self.m.mem
+            v = mem.get_byte(addr) if width == 1 else mem.get_word(addr)
+            if arg[3]:
+                base = arg[1]
+                if r[base] + 2 > 0xffff:
+                    raise Stop
+                r[base] += 2
+        return v & (0xff if width == 1 else 0xffff)
+
+    def iterate(self, r):
+        """Runs one iteration on the register values `r`, changing memory
+        as it goes. Returns the Registers.pending its last test leaves if
+        the loop goes round again, or else None, with r and memory put back
+        as they were."""
+        mem = self.m.mem
+        code = mem.code
+        saved = r[:]
+        undo = []
+        z = 0
+        flags = None
+        try:
+            for op in self.ops:
+                kind = op[0]
+                if kind == STEP:
+                    r[op[1]] = r[op[1]] + op[2] & 0xffff
+                elif kind == MOV:
+                    width = op[3]
+                    v = self.load(r, op[1], width)
+                    dest = op[2]
+                    if dest[0] == REG:
+                        r[dest[1]] = v
+                        continue
+                    addr = self.address(r, dest, width)
+                    if code[addr] or width == 2 and code[addr + 1]:
+                        raise Stop
+                    if width == 1:
+                        undo.append((addr, 1, mem.get_byte(addr)))
+                        mem.set_byte(addr, v)
+                    else:
+                        undo.append((addr, 2, mem.get_word(addr)))
+                        mem.set_word(addr, v)
+                elif kind == TEST:
+                    width = op[4]
+                    mask = 0xff if width == 1 else 0xffff
+                    keep = mask | 0x10000
+                    # as the insns do, the destination is read first
+                    if op[1] == ZERO:
+                        v = self.load(r, op[2], width)
+                        z = v == 0
+                        added = op[3]
+                        flags = (v - added & mask) + added & keep
+                    else:
+                        b = self.load(r, op[3], width)
+                        a = self.load(r, op[2], width)
+                        z = a == b
+                        flags = b + (~a & 0xffff) + 1 & keep
+                elif (not z) != op[1]:
+                    raise Stop
+        except Stop:
+            self.undo(r, saved, undo)
+            return None
+        except:
+            self.undo(r, saved, undo)
+            raise
+        return flags
+
+    def undo(self, r, saved, undo):
+        mem = self.m.mem
+        r[:] = saved
+        for addr, width, v in reversed(undo):
+            if width == 1:
+                mem.set_byte(addr, v)
+            else:
+                mem.set_word(addr, v)
+
+    # All at once.
+
+    def plan(self):
+        """Works out whether all the iterations can be run at once, and
+        returns a function that does it, or None.
+
+        That takes memory operands that each address a stream moving by the
+        same amount every iteration, at most one store, loads only into
+        registers nothing else writes, and exits that each either count a
+        register by one to zero, look for a zero in a stream or leave where
+        two streams differ. Then how many iterations stay in the loop can
+        be read off memory before any of them run, and the store is one
+        write."""
+        # register -> how far it has moved so far in the iteration
+        delta = defaultdict(int)
+        stepped = set()
+        backwards = set()
+        # (base, offset, width) addressing memory at delta's registers
+        streams = []
+        # loaded register -> its stream
+        loads = {}
+        reads = set()
+        store = None
+        test = None
+        # (test, if_taken) for each exit
+        exits = []
+
+        def stream(arg, width):
+            base = arg[1]
+            s = (base, arg[2] + delta[base] if base is not None else arg[2],
+                    width)
+            streams.append(s)
+            if arg[3]:
+                delta[base] += 2
+                stepped.add(base)
+            return s
+
+        def value(arg, width):
+            if arg[0] == MEM:
+                return (MEM, stream(arg, width))
+            if arg[0] == REG:
+                reads.add(arg[1])
+                return (REG, arg[1], delta[arg[1]])
+            return arg
+
+        for op in self.ops:
+            kind = op[0]
+            if kind == STEP:
+                amount = as_signed(op[2])
+                if amount < 0:
+                    backwards.add(op[1])
+                delta[op[1]] += amount
+                stepped.add(op[1])
+            elif kind == MOV:
+                width = op[3]
+                src = value(op[1], width)
+                dest = op[2]
+                if dest[0] == REG:
+                    x = dest[1]
+                    if src[0] != MEM or x in loads or x in reads:
+                        return None
+                    loads[x] = src[1]
+                elif store is not None:
+                    return None
+                else:
+                    store = (stream(dest, width), src)
+            elif kind == TEST:
+                width = op[4]
+                if op[1] == ZERO:
+                    test = (ZERO, value(op[2], width), None, width)
+                else:
+                    # as the insns do, the destination is read first
+                    b = value(op[3], width)
+                    test = (EQUAL, value(op[2], width), b, width)
+            else:
+                exits.append((test, op[1]))
+
+        steps = dict((n, d) for n, d in delta.iteritems() if d)
+        for base, offset, width in streams:
+            if base is not None and (base in loads or base in backwards):
+                return None
+        for x in loads:
+            if x in stepped:
+                return None
+
+        def values(what, width):
+            """Returns a function of (r, n) giving the values `what` has at
+            this point of each of the next n iterations, as a string, or
+            None if they aren't known beforehand."""
+            if what[0] == CONST:
+                v = pack(what[1], width)
+                return lambda r, n: v * n
+            if what[0] == REG:
+                x = what[1]
+                if x in stepped:
+                    return None
+                if x not in loads:
+                    return lambda r, n: pack(r[x], width) * n
+                if loads[x][2] != width:
+                    return None
+                what = (MEM, loads[x])
+            base, offset, width = what[1]
+            stride = steps.get(base, 0)
+            if width != 1 and stride not in (0, width):
+                return None
+            mem = self.m.mem
+            def read(r, n):
+                start = offset if base is None else r[base] + offset
+                if stride == width:
+                    return mem.read(start, n * width)
+                if stride == 0:
+                    return mem.read(start, width) * n
+                return mem.read(start, (n - 1) * stride + 1)[::stride]
+            return read
+
+        def leaves(test, if_taken):
+            """Returns a function of (r, cap) giving the iteration, up to
+            cap, at which an exit leaves the loop, or None."""
+            kind, a, b, width = test
+            if if_taken and kind == ZERO:
+                if a[0] == REG and width == 2 and \
+                        steps.get(a[1]) in (1, -1):
+                    counter, partial = a[1], a[2]
+                    direction = steps[counter]
+                    def counted(r, cap):
+                        v = r[counter] + partial & 0xffff
+                        return min(cap, v if direction == -1 else -v & 0xffff)
+                    return counted
+                if a[0] == REG and a[1] in loads and loads[a[1]][2] == 1:
+                    # the byte loaded is zero when the word is
+                    width = 1
+                read = values(a, width)
+                if read is None:
+                    return None
+                return lambda r, cap: first_zero(read(r, cap), width)
+            if not if_taken and kind == EQUAL:
+                read_a = values(a, width)
+                read_b = values(b, width)
+                if read_a is None or read_b is None:
+                    return None
+                return lambda r, cap: \
+                        common_prefix(read_a(r, cap), read_b(r, cap)) / width
+            return None
+
+        exits = [leaves(test, if_taken) for test, if_taken in exits]
+        if None in exits:
+            return None
+
+        if store is not None:
+            (base, offset, width), src = store
+            if steps.get(base, 0) != width:
+                return None
+            if src[0] == REG:
+                if src[1] in loads:
+                    src = (MEM, loads[src[1]])
+                    if src[1][2] != width:
+                        return None
+                elif src[1] in stepped:
+                    return None
+            if src[0] == MEM and src[1][2] != width:
+                return None
+            store = (store[0], src)
+
+        def bulk(r, cap):
+            mem = self.m.mem
+            # keep every register and address in range
+            for base, offset, width in streams:
+                stride = steps.get(base, 0)
+                start = offset if base is None else r[base] + offset
+                if start < 0 or start + width > 0x10000:
+                    return 0
+                if stride:
+                    cap = min(cap, (0x10000 - width - start) / stride + 1,
+                            (0xffff - r[base]) / stride)
+            k = cap
+            for leave in exits:
+                k = leave(r, k)
+            # the last iteration is left to iterate(), for its flags
+            k -= 1
+            if k <= 0:
+                return 0
+            if store is not None:
+                (base, offset, width), src = store
+                start = r[base] + offset
+                end = start + k * width
+                if mem.code[start:end].count(1):
+                    return 0
+                for other in streams:
+                    if other is store[0]:
+                        continue
+                    b, o, w = other
+                    s = o if b is None else r[b] + o
+                    e = s + (k - 1) * steps.get(b, 0) + w
+                    if s < end and start < e:
+                        return 0
+                if src[0] == MEM:
+                    b, o, w = src[1]
+                    stride = steps.get(b, 0)
+                    s = o if b is None else r[b] + o
+                    if stride == w:
+                        data = mem.read(s, k * w)
+                    elif w == 1 and stride:
+                        data = mem.read(s, (k - 1) * stride + 1)[::stride]
+                    elif stride == 0:
+                        data = mem.read(s, w) * k
+                    else:
+                        return 0
+                else:
+                    v = src[1] if src[0] == CONST else r[src[1]]
+                    data = pack(v, width) * k
+                mem.write(start, data)
+            for x, (b, o, w) in loads.iteritems():
+                addr = (o if b is None else r[b] + o) + \
+                        (k - 1) * steps.get(b, 0)
+                r[x] = mem.get_byte(addr) if w == 1 else mem.get_word(addr)
+            for n, d in steps.iteritems():
+                r[n] = r[n] + k * d & 0xffff
+            return k
+        return bulk
+
+class Idioms(object):
+    """Finds the loops the block engine can fast-forward (see Loop), and
+    runs them. Machine.execute_block calls run() before running a block;
+    whatever is left of the loop then runs as usual."""
+
+    # iterations at most per call, so that a loop that never ends doesn't
+    # hold up the machine
+    max_iterations = 0x10000
+
+    def __init__(self, machine):
+        self.m = machine
+
+    def run(self, block):
+        m = self.m
+        loop = block.loop
+        if loop is None:
+            loop = block.loop = self.match(block)
+            if not loop:
+                return
+        for other in loop.blocks[1:]:
+            if not other.valid:
+                block.loop = None
+                return
+            if m.interactive and m.breakpoints and \
+                    other.contains_any(m.breakpoints):
+                return
+        cap = self.max_iterations
+        if m.insn_limit is not None:
+            # stopping short of the limit, as the block runs after this and
+            # run() only stops once an insn reaches it
+            cap = min(cap, (m.insn_limit - m.insn_count - 1) / loop.insns)
+        if cap > 0:
+            loop.run(cap)
+
+    def match(self, block):
+        """Returns the Loop that starts at `block`, or False."""
+        first = self.body(block)
+        if first is None:
+            return False
+        ops, target = first
+        if target == block.start:
+            return Loop(self.m, [block], ops + [(EXIT, True)])
+        if target == block.end:
+            return False
+        following = self.m.translator.lookup(block.end)
+        if following is None or following is block:
+            return False
+        second = self.body(following)
+        if second is None or second[1] != block.start:
+            return False
+        return Loop(self.m, [block, following],
+                ops + [(EXIT, False)] + second[0] + [(EXIT, True)])
+
+    def body(self, block):
+        """Returns (ops, target) for a block of supported insns ending in a
+        jnz, or None. The jnz itself is left out of the ops."""
+        if not block.is_jump or len(block) < 2:
+            return None
+        decode = self.m.decoder.decode
+        mem = self.m.mem
+        handler, is_byte_insn, args, size = decode(block.branch_pc, mem)
+        # jnz $-2 is the delay loop, which the translator already shortcuts
+        if handler.__name__ != 'do_jnz' or args[0] == -2:
+            return None
+        target = block.branch_pc + args[0] & 0xffff
+        ops = []
+        for pc in block.pcs[:-1]:
+            handler, is_byte_insn, args, size = decode(pc, mem)
+            insn_ops = self.insn(handler.__name__[3:],
+                    1 if is_byte_insn else 2, args)
+            if insn_ops is None:
+                return None
+            ops.extend(insn_ops)
+        if not any(op[0] == TEST for op in ops):
+            return None
+        return ops, target
+
+    @staticmethod
+    def insn(name, width, args):
+        if name not in ('mov', 'add', 'sub', 'cmp'):
+            return None
+        src = operand(args[0])
+        dest = operand(args[1])
+        if src is None or dest is None or dest[0] == CONST:
+            return None
+        if name == 'mov':
+            return [(MOV, src, dest, width)]
+        if name == 'cmp':
+            if src == (CONST, 0):
+                # cmp #0 adds 0xffff + 1
+                return [(TEST, ZERO, dest, 0x10000, width)]
+            return [(TEST, EQUAL, src, dest, width)]
+        if width != 2 or src[0] != CONST or dest[0] != REG:
+            return None
+        amount = src[1] if name == 'add' else -src[1]
+        added = src[1] if name == 'add' else (~src[1] & 0xffff) + 1
+        return [(STEP, dest[1], amount & 0xffff),
+                (TEST, ZERO, dest, added, 2)]
@@ -0,0 +1,69 @@
+import binascii
+
+# callgate interrupt numbers, as Machine.default_callgates knows them
+CALLGATES = {0: 'putchar', 2: 'getsn', 0x20: 'rand', 0x7d: 'check',
+        0x7e: 'check_hsm', 0x7f: 'unlock'}
+
+class IOLog(object):
+    """Records each callgate the program makes, one line per call: the insn
+    count it happened at, the callgate's name and what went in or out, in
+    hex. A 'rewind N' line means the debugger went back to when N insns had
+    run, so that anything logged after that point is void."""
+
+    def __init__(self, fname, rom_hash):
+        if isinstance(fname, basestring):
+            self.f = open(fname, 'w')
+        else:
+            self.f = fname
+        self.f.write('# callgate log %s\n' % rom_hash)
+
+    def write(self, insn_count, name, *fields):
+        self.f.write('%d %s\n' % (insn_count, ' '.join((name,) + fields)))
+        # the log should survive the run crashing
+        self.f.flush()
+
+    def putchar(self, insn_count, c):
+        self.write(insn_count, 'putchar', binascii.hexlify(c))
+
+    def getsn(self, insn_count, s, hex_input_mode):
+        if hex_input_mode:
+            self.write(insn_count, 'getsn', 'hex', s.lower() or '-')
+        else:
+            self.write(insn_count, 'getsn', 'char',
+                    binascii.hexlify(s) or '-')
+
+    def rewind(self, insn_count):
+        self.write(insn_count, 'rewind')
+
+def read_log(f):
+    """Returns (rom_hash, events) for a log, where events is a list of
+    (insn_count, name, fields) with rewound events left out."""
+    header = f.readline().split()
+    if header[:3] != ['#', 'callgate', 'log']:
+        raise Exception('Not a callgate log.')
+    events = []
+    for line in f:
+        fields = line.split()
+        insn_count, name, fields = int(fields[0]), fields[1], fields[2:]
+        if name == 'rewind':
+            while events and events[-1][0] > insn_count:
+                events.pop()
+        else:
+            events.append((insn_count, name, fields))
+    return header[3], events
+
+def log_inputs(events):
+    """Returns the getsn answers in a log as (input, hex) pairs, which
+    Machine.run takes as inputs."""
+    inputs = []
+    for insn_count, name, fields in events:
+        if name != 'getsn':
+            continue
+        mode, data = fields
+        if data == '-':
+            data = ''
+        if mode == 'hex':
+            inputs.append((data, True))
+        else:
+            inputs.append((binascii.unhexlify(data), False))
+    return inputs
@@ -0,0 +1,673 @@
+#! /usr/bin/env python
+
+import os
+import random
+import tempfile
+from collections import defaultdict
+from StringIO import StringIO
+from assembler import assemble_rom
+from disassembler import Disassembler
+from emulator import Machine, RunResult, PC
+from memory import READ, WRITE
+from tracer import Tracer, BinaryTracer
+from tracedump import render
+
+disassembler = Disassembler()
+
+class Divergence(object):
+    """Where two engines first disagreed: what differed, and the insns each
+    engine ran since they last agreed, by the pc of each step."""
+
+    def __init__(self, insn_count, engines, steps, differences, mem):
+        self.insn_count = insn_count
+        self.engines = engines
+        self.steps = steps
+        self.differences = differences
+        self.mem = mem
+
+    def __str__(self):
+        lines = ['diverged at insn %d:' % self.insn_count]
+        # the engine that took the most steps ran the smallest ones
+        steps = max(self.steps, key=len)
+        for pc in steps:
+            try:
+                text = disassembler.format_insn(pc, self.mem)[0]
+            except Exception:
+                text = 'Failed to disassemble.'
+            lines.append('  %04x: %s' % (pc, text))
+        for what, a, b in self.differences:
+            lines.append('  %s: %s (%s) vs %s (%s)' % (what, a,
+                    self.engines[0], b, self.engines[1]))
+        return '\n'.join(lines)
+
+class Lockstep(object):
+    """Runs a ROM on two engines side by side. Each round runs the first
+    engine one step (a block, for the block engine) and then steps
+    whichever is behind until both have run the same insns. The registers,
+    SR, bytes written, call stack and output are compared after every
+    round."""
+
+    def __init__(self, fname, engines=('block', 'interp'), inputs=(),
+            hex_input=False, memories=('pages', 'pages')):
+        self.engines = tuple(engines)
+        self.machines = [Machine(fname, engine, memory)
+                for engine, memory in zip(engines, memories)]
+        inputs = list(inputs)
+        for m in self.machines:
+            m.go_headless(inputs, hex_input)
+
+    @staticmethod
+    def step(m):
+        """Returns whether m is still running, or the exception it
+        raised."""
+        try:
+            return m.step()
+        except EOFError:
+            # out of input; the callgate is left to run again, as in run()
+            m.insn_count -= 1
+            return 'eof'
+        except Exception as e:
+            return '%s: %s' % (type(e).__name__, e)
+
+    def round(self):
+        """Returns (running, steps) where steps lists, for each machine, the
+        pc each of its steps started at."""
+        a, b = self.machines
+        steps = ([a.registers[PC]], [])
+        status = [self.step(a), True]
+        while a.insn_count != b.insn_count:
+            # the one behind catches up, even if the other has stopped
+            i = 0 if a.insn_count < b.insn_count else 1
+            if status[i] is not True:
+                break
+            steps[i].append(self.machines[i].registers[PC])
+            status[i] = self.step(self.machines[i])
+        if (status[0] is True) != (status[1] is True) and \
+                a.insn_count == b.insn_count:
+            # see whether the other one stops here too
+            i = 0 if status[0] is True else 1
+            steps[i].append(self.machines[i].registers[PC])
+            status[i] = self.step(self.machines[i])
+        return status, steps
+
+    def differences(self, status, before):
+        a, b = self.machines
+        rv = []
+        if status[0] != status[1]:
+            rv.append(('status', status[0], status[1]))
+        if a.insn_count != b.insn_count:
+            rv.append(('insns', a.insn_count, b.insn_count))
+        a.registers.flush()
+        b.registers.flush()
+        for i, (x, y) in enumerate(zip(a.registers.regs, b.registers.regs)):
+            if x != y:
+                rv.append((Disassembler.pretty_reg(i), '%04x' % x, '%04x' % y))
+        wa = a.mem.changes(before[0])
+        wb = b.mem.changes(before[1])
+        for addr in sorted(set(wa) | set(wb)):
+            x = wa.get(addr)
+            y = wb.get(addr)
+            if x != y:
+                rv.append(('byte %04x' % addr,
+                        '-' if x is None else '%02x' % x,
+                        '-' if y is None else '%02x' % y))
+        if a.callsites != b.callsites:
+            rv.append(('callsites', a.callsites, b.callsites))
+        if a.door_unlocked != b.door_unlocked:
+            rv.append(('unlocked', a.door_unlocked, b.door_unlocked))
+        a.flush_output()
+        b.flush_output()
+        if a.prog_output.getvalue() != b.prog_output.getvalue():
+            rv.append(('output', repr(a.prog_output.getvalue()),
+                    repr(b.prog_output.getvalue())))
+        return rv
+
+    def run(self, max_insns=None):
+        """Returns the first Divergence, or None if the engines agreed
+        until the program stopped or `max_insns` insns had run."""
+        a = self.machines[0]
+        while max_insns is None or a.insn_count < max_insns:
+            before = [m.mem.snapshot() for m in self.machines]
+            status, steps = self.round()
+            differences = self.differences(status, before)
+            if differences:
+                return Divergence(a.insn_count, self.engines, steps,
+                        differences, a.mem)
+            if status[0] is not True:
+                return None
+        return None
+
+# Random programs. Data registers are the only register destinations; the
+# pointer registers stay within the scratch area, which all memory
+# operands address. The only backward jumps are those of random_loop().
+DATA_REGS = range(8, 16)
+POINTER_REGS = range(4, 8)
+SCRATCH = 0x2000
+TWO_OPERAND = ['mov', 'add', 'addc', 'sub', 'cmp', 'dadd', 'bit', 'bic',
+        'bis', 'xor', 'and']
+ONE_OPERAND = ['rrc', 'swpb', 'rra', 'sxt', 'push']
+BYTE_OPS = set(TWO_OPERAND + ['rrc', 'rra', 'push'])
+JUMPS = ['jnz', 'jeq', 'jnc', 'jc', 'jge', 'jl', 'jmp']
+FLAGS = [0x1, 0x2, 0x4, 0x100]
+
+def random_source(rng):
+    kind = rng.randrange(8)
+    if kind == 0:
+        return 'r%d' % rng.choice(DATA_REGS + [2])
+    elif kind == 1:
+        return '#%x' % rng.choice([0, 1, 2, 4, 8, -1])
+    elif kind == 2:
+        return '#%x' % rng.randrange(0x10000)
+    elif kind == 3:
+        return '@r%d' % rng.choice(POINTER_REGS)
+    elif kind == 4:
+        return '@r%d+' % rng.choice(POINTER_REGS)
+    elif kind == 5:
+        return '&%x' % (SCRATCH + rng.randrange(0, 0x200, 2))
+    return random_dest(rng)
+
+def random_dest(rng):
+    if rng.randrange(3):
+        return 'r%d' % rng.choice(DATA_REGS)
+    return '%x(r%d)' % (rng.randrange(0, 0x40, 2), rng.choice(POINTER_REGS))
+
+def random_insn(rng):
+    kind = rng.randrange(10)
+    if kind < 6:
+        op = rng.choice(TWO_OPERAND)
+        args = [random_source(rng), random_dest(rng)]
+    else:
+        op = rng.choice(ONE_OPERAND)
+        args = [random_source(rng) if op == 'push' else random_dest(rng)]
+    if op in BYTE_OPS and rng.randrange(3) == 0:
+        op += '.b'
+    return '%s %s' % (op, ', '.join(args))
+
+def random_loop(rng, label):
+    """Returns the lines of a memset, memcpy, strlen, strcpy or strcmp
+    loop, as idioms.py knows them, on random registers."""
+    p, q = rng.sample(POINTER_REGS, 2)
+    x, c = rng.sample(DATA_REGS, 2)
+    b, w = rng.choice([('', 2), ('.b', 1)])
+    kind = rng.randrange(6)
+    if kind == 5:
+        lines = []
+        if rng.randrange(2):
+            lines.append('mov r%d, r%d' % (p, q))
+        return lines + [
+            label + ':',
+            'mov.b @r%d, r%d' % (p, x),
+            'cmp.b @r%d, r%d' % (q, x),
+            'jnz %s_done' % label,
+            'add #1, r%d' % p,
+            'add #1, r%d' % q,
+            'cmp.b #0, r%d' % x,
+            'jnz ' + label,
+            label + '_done:']
+    if kind == 3:
+        body = ['mov.b @r%d+, r%d' % (p, x), 'add #1, r%d' % c,
+                'cmp.b #0, r%d' % x]
+    elif kind == 4:
+        body = ['mov.b @r%d+, r%d' % (p, x), 'mov.b r%d, 0(r%d)' % (x, q),
+                'add #1, r%d' % q, 'cmp #0, r%d' % x]
+    else:
+        n = rng.randint(1, 0x40)
+        if kind == 0:
+            body = ['mov%s #%x, 0(r%d)' % (b, rng.randrange(0x10000), q)]
+        elif kind == 1:
+            body = ['mov%s @r%d+, 0(r%d)' % (b, p, q)]
+        else:
+            body = ['mov%s @r%d, r%d' % (b, p, x), 'add #%x, r%d' % (w, p),
+                    'mov%s r%d, 0(r%d)' % (b, x, q)]
+        body.append('add #%x, r%d' % (w, q))
+        if rng.randrange(2):
+            body.append(rng.choice(['sub #1, r%d', 'add #-1, r%d']) % c)
+            start = 'mov #%x, r%d' % (n, c)
+        else:
+            body.append('add #1, r%d' % c)
+            start = 'mov #%x, r%d' % (-n & 0xffff, c)
+        if rng.randrange(2):
+            body.append('cmp #0, r%d' % c)
+        return [start, label + ':'] + body + ['jnz ' + label]
+    return [label + ':'] + body + ['jnz ' + label]
+
+def random_program(rng, length=50):
+    """Returns the source of a random program of about `length` insns that
+    runs to CPUOFF. Jumps only go forwards, so it always gets there."""
+    lines = ['mov #4400, r1']
+    for r in POINTER_REGS:
+        lines.append('mov #%x, r%d' % (SCRATCH + rng.randrange(0, 0x100, 2),
+                r))
+    for r in DATA_REGS:
+        lines.append('mov #%x, r%d' % (rng.randrange(0x10000), r))
+    lines.append('mov #%x, r2' % sum(f for f in FLAGS if rng.randrange(2)))
+    # insn index -> labels to put before it
+    labels = defaultdict(list)
+    for i in xrange(length):
+        for label in labels.pop(i, []):
+            lines.append(label + ':')
+        kind = rng.randrange(10)
+        if kind == 0:
+            label = 'l%d' % i
+            labels[i + rng.randint(1, 4)].append(label)
+            lines.append('%s %s' % (rng.choice(JUMPS), label))
+        elif kind == 1:
+            # the countdown loop execute_next shortcuts
+            lines.append('add #-1, r%d' % rng.choice(DATA_REGS))
+            lines.append('jnz $-0x2')
+        elif kind == 2:
+            lines.extend(random_loop(rng, 'loop%d' % i))
+        else:
+            lines.append(random_insn(rng))
+    for i in sorted(labels):
+        lines.extend(label + ':' for label in labels[i])
+    lines.append('bis #10, r2')
+    return lines
+
+def write_random_rom(rng, fname, length=50):
+    """Writes a random program, and random data in the scratch area, to a
+    ROM. Returns the program's source."""
+    source = random_program(rng, length)
+    with open(fname, 'wb') as f:
+        f.write(assemble_rom(source, data=[(SCRATCH,
+                ''.join(chr(rng.randrange(256)) for j in xrange(0x300)))]))
+    return source
+
+def check_random(count, length=50, seed=None, engines=('block', 'interp'),
+        max_insns=100000, memories=('pages', 'pages')):
+    """Runs `count` random programs in lockstep. Returns (source,
+    Divergence) for the first that diverges, or None."""
+    rng = random.Random(seed)
+    fd, fname = tempfile.mkstemp(suffix='.rom')
+    os.close(fd)
+    try:
+        for i in xrange(count):
+            source = write_random_rom(rng, fname, length)
+            divergence = Lockstep(fname, engines,
+                    memories=memories).run(max_insns)
+            if divergence is not None:
+                return source, divergence
+    finally:
+        os.remove(fname)
+    return None
+
+def watched_stops(fname, engine, watches, max_insns=100000):
+    """Runs a ROM with watchpoints, given as (addr, size, kinds), carrying
+    on after each hit. Returns how each run() stopped: its result and the
+    hits."""
+    m = Machine(fname, engine)
+    for addr, size, kinds in watches:
+        m.watch(addr, size, kinds)
+    rv = []
+    while True:
+        try:
+            result = m.run((), max_insns)
+        except Exception as e:
+            rv.append('%s: %s' % (type(e).__name__, e))
+            break
+        rv.append((result, m.watch_hits))
+        if result.stop_reason != 'watchpoint':
+            break
+        m.watch_hits = []
+    return rv
+
+def check_watch(count, length=50, seed=None, engines=('block', 'interp')):
+    """Runs `count` random programs with random watchpoints in the scratch
+    area on both engines. Returns (source, watches, stops on one, stops on
+    the other) for the first where the engines stop differently, or
+    None."""
+    rng = random.Random(seed)
+    fd, fname = tempfile.mkstemp(suffix='.rom')
+    os.close(fd)
+    try:
+        for i in xrange(count):
+            source = write_random_rom(rng, fname, length)
+            watches = [(SCRATCH + rng.randrange(0x120), rng.choice([1, 2]),
+                    rng.choice([READ, WRITE, READ | WRITE]))
+                    for j in xrange(rng.randint(1, 3))]
+            a, b = [watched_stops(fname, engine, watches)
+                    for engine in engines]
+            if a != b:
+                return source, watches, a, b
+    finally:
+        os.remove(fname)
+    return None
+
+# Programs that read and write at both ends of memory, where an address
+# below 0 wraps around and a word at 0xffff or anything past the end
+# faults. Backends have to agree on these.
+EDGE_PROGRAMS = [
+    ['mov #ffff, r4', 'mov @r4, r5'],
+    ['mov #ffff, r4', 'mov r4, 0(r4)'],
+    ['mov #ffff, r4', 'mov.b @r4, r5', 'mov.b r5, 0(r4)'],
+    ['mov #fffe, r4', 'mov 1(r4), r5'],
+    ['mov #fff0, r4', 'mov 10(r4), r5'],
+    ['mov #fffe, r4', 'mov @r4+, r5'],
+    ['mov #0, r4', 'mov -1(r4), r5', 'mov r5, -1(r4)'],
+    ['mov #0, r4', 'mov -2(r4), r5', 'add #1, -2(r4)'],
+    ['mov #1234, &fffe', 'mov &fffe, r5'],
+    # loops the idioms take up, crashing in the iteration that leaves
+    ['mov #fff0, r4', 'mov #4, r2', 'loop:', 'mov 1(r4), r5', 'add #2, r4',
+            'cmp #1234, r5', 'jnz loop'],
+    ['mov #ff00, r4', 'mov #4, r2', 'loop:', 'mov @r4+, r5', 'add #-1, r6',
+            'jnz loop'],
+]
+
+def check_edges(engines=('interp', 'interp'), memories=('pages', 'image')):
+    """Runs EDGE_PROGRAMS in lockstep. Returns (source, Divergence) for the
+    first that diverges, or None."""
+    fd, fname = tempfile.mkstemp(suffix='.rom')
+    os.close(fd)
+    try:
+        for program in EDGE_PROGRAMS:
+            source = ['mov #4400, r1'] + program + ['bis #10, r2']
+            with open(fname, 'wb') as f:
+                f.write(assemble_rom(source))
+            divergence = Lockstep(fname, engines, memories=memories).run()
+            if divergence is not None:
+                return source, divergence
+    finally:
+        os.remove(fname)
+    return None
+
+def finish(m, max_insns):
+    """Runs a machine to the end or `max_insns`, and returns everything
+    about how it ended."""
+    try:
+        outcome = m.run((), max_insns)
+    except Exception as e:
+        outcome = '%s: %s' % (type(e).__name__, e)
+    m.registers.flush()
+    return (outcome, m.insn_count, tuple(m.registers.regs),
+            m.mem.read(0, m.mem.size), m.prog_output.getvalue())
+
+def check_idioms(count, length=50, seed=None,
+        limits=(None, 1, 100, 1001, 5000)):
+    """Runs `count` random programs, and then EDGE_PROGRAMS, on the block
+    engine with and without the idioms, stopping at each of `limits`
+    insns. Returns (source, limit, what differed) for the first that ends
+    differently, or None."""
+    rng = random.Random(seed)
+    fd, fname = tempfile.mkstemp(suffix='.rom')
+    os.close(fd)
+    fields = ['outcome', 'insns', 'registers', 'memory', 'output']
+    try:
+        for i in xrange(count + len(EDGE_PROGRAMS)):
+            if i < count:
+                source = write_random_rom(rng, fname, length)
+            else:
+                source = ['mov #4400, r1'] + EDGE_PROGRAMS[i - count] + \
+                        ['bis #10, r2']
+                with open(fname, 'wb') as f:
+                    f.write(assemble_rom(source))
+            for limit in limits:
+                fast = Machine(fname, 'block')
+                slow = Machine(fname, 'block')
+                slow.idioms = None
+                a = finish(fast, limit)
+                b = finish(slow, limit)
+                differ = [field for field, x, y in zip(fields, a, b)
+                        if x != y]
+                if differ:
+                    return source, limit, differ
+    finally:
+        os.remove(fname)
+    return None
+
+# A lock that reads its input to 3000 and jumps there, and inputs (in hex)
+# for it to run as code, for the batch engine, whose lanes each run
+# different code at the same pc.
+SHELLCODE_LOCK = ['mov #4400, r1', 'push #10', 'push #3000', 'push #0',
+        'push #0', 'push #0', 'mov #8200, r2', 'call #10', 'add #a, r1',
+        'mov #3000, r0']
+SHELLCODE = [
+    '3f4041003240f000', # mov #41, r15; mov #f0, r2
+    '3f4042003240f000',
+    '3f4043003240f000',
+    '3240f000',
+    '03433240f000', # nop first
+    '324000ffb0121000', # the unlock callgate
+    '30400030', # jumps back to itself
+    '',
+]
+
+def check_batch(max_insns=1000):
+    """Runs SHELLCODE on the batch engine, twice over in different orders,
+    and one at a time. Returns (input, batch result, expected) for the
+    first that differs, or None."""
+    import bruteforce
+    from batch import Batch
+    fd, fname = tempfile.mkstemp(suffix='.rom')
+    os.close(fd)
+    try:
+        with open(fname, 'wb') as f:
+            # a ret at the callgate already, as the batch engine writes one
+            f.write(assemble_rom(SHELLCODE_LOCK, data=[(0x10, '\x30\x41')]))
+        bruteforce.lanes_engine = None
+        bruteforce.prepare(fname, 'interp', max_insns, True)
+        m = bruteforce.machine
+        expected = {}
+        for candidate in SHELLCODE:
+            m.restore(bruteforce.start_state)
+            try:
+                result = m.run([candidate], max_insns, True)
+            except Exception as e:
+                # how the batch engine stops a lane instead
+                m.registers.flush()
+                result = RunResult(m.door_unlocked, m.insn_count, str(e),
+                        tuple(m.registers.regs), 'crash')
+            expected[candidate] = (bruteforce.try_candidate(candidate),
+                    result)
+        m.restore(bruteforce.start_state)
+        batch = Batch(m, max_insns, True)
+        for candidates in [SHELLCODE, SHELLCODE[::-1]]:
+            got = zip(bruteforce.try_candidates(candidates),
+                    batch.run(candidates))
+            for candidate, rv in zip(candidates, got):
+                if rv != expected[candidate]:
+                    return candidate, rv, expected[candidate]
+    finally:
+        bruteforce.lanes_engine = None
+        os.remove(fname)
+    return None
+
+def trace_both(fname, inputs=(), hex_input=False, hooks=(),
+        max_insns=100000):
+    """Runs a ROM with a text trace (-t) and again with a binary one (-T),
+    with library functions hooked as (addr, name) pairs. Returns the text
+    trace and the binary one as tracedump.py renders it."""
+    fd, bname = tempfile.mkstemp(suffix='.bin')
+    os.close(fd)
+    rv = []
+    try:
+        for tracer in [Tracer(StringIO()), BinaryTracer(bname)]:
+            m = Machine(fname)
+            for addr, name in hooks:
+                m.register_function(addr, Machine.library_functions[name])
+            try:
+                m.run(inputs, max_insns, hex_input, tracer.trace)
+            except Exception:
+                # traced up to the crash either way
+                pass
+            if isinstance(tracer, BinaryTracer):
+                tracer.close()
+                out = StringIO()
+                with open(bname, 'rb') as f:
+                    render(f, out)
+            else:
+                out = tracer.tracefile
+            rv.append(out.getvalue())
+    finally:
+        os.remove(bname)
+    return rv
+
+def check_trace(fname, inputs=(), hex_input=False, hooks=()):
+    """Returns (line number, text line, rendered line) for the first line
+    where a ROM's binary trace renders differently from its text trace, or
+    None."""
+    text, rendered = trace_both(fname, inputs, hex_input, hooks)
+    text = text.splitlines()
+    rendered = rendered.splitlines()
+    for i in xrange(max(len(text), len(rendered))):
+        a = text[i] if i < len(text) else '-'
+        b = rendered[i] if i < len(rendered) else '-'
+        if a != b:
+            return i + 1, a, b
+    return None
+
+# runs of SHELLCODE_LOCK, whose callgate is still 0 when it's first called,
+# to trace: (input, hooks)
+TRACE_CHECKS = [
+    ('3f4041003240f000', ()),
+    ('3f4041003240f000', [(0x3000, 'putchar')]),
+]
+
+def check_traces():
+    """Runs check_trace on TRACE_CHECKS. Returns (input, hooks, what
+    check_trace did) for the first that differs, or None."""
+    fd, fname = tempfile.mkstemp(suffix='.rom')
+    os.close(fd)
+    try:
+        with open(fname, 'wb') as f:
+            f.write(assemble_rom(SHELLCODE_LOCK))
+        for candidate, hooks in TRACE_CHECKS:
+            rv = check_trace(fname, [candidate], True, hooks)
+            if rv is not None:
+                return (candidate, hooks) + rv
+    finally:
+        os.remove(fname)
+    return None
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('romfile', nargs='?')
+    parser.add_argument('-e', nargs=2, choices=['block', 'interp'],
+            help='the two engines to compare (default: block and interp, '
+                 'or interp for both with --edges)')
+    parser.add_argument('-m', nargs=2, choices=['pages', 'image'],
+            help='the memory backend of each engine (default: pages for '
+                 'both, or pages and image with --edges)')
+    parser.add_argument('-i', action='append', default=[],
+            help='program input, once per getsn call')
+    parser.add_argument('-x', action='store_true',
+            help='treat program input as hexadecimal')
+    parser.add_argument('-n', type=int, help='stop after this many insns')
+    parser.add_argument('--random', type=int, metavar='COUNT',
+            help='check this many random programs instead of a ROM')
+    parser.add_argument('--length', type=int, default=50,
+            help='insns in each random program')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--idioms', type=int, metavar='COUNT',
+            help='check this many random programs, and the edge programs, '
+                 'with and without the idioms')
+    parser.add_argument('--trace', action='store_true',
+            help='check that the binary trace of the ROM (or, without one, '
+                 'of a few built-in runs) renders as the text trace does')
+    parser.add_argument('--hook', action='append', default=[],
+            metavar='ADDR=NAME',
+            help='with --trace, replace the function at ADDR as '
+                 'emulator.py --hook does')
+    parser.add_argument('--watch', type=int, metavar='COUNT',
+            help='check this many random programs with random watchpoints')
+    parser.add_argument('--batch', action='store_true',
+            help='check the batch engine on inputs run as code')
+    parser.add_argument('--edges', action='store_true',
+            help='check programs that access the ends of memory instead '
+                 'of a ROM')
+    args = parser.parse_args()
+
+    if args.idioms is not None:
+        rv = check_idioms(args.idioms, args.length, args.seed)
+        if rv is None:
+            print '%d programs agreed with and without the idioms' % \
+                    (args.idioms + len(EDGE_PROGRAMS))
+            sys.exit(0)
+        source, limit, differ = rv
+        print '\n'.join(source)
+        print 'differed at max_insns %s: %s' % (limit, ', '.join(differ))
+        sys.exit(1)
+    if args.watch is not None:
+        rv = check_watch(args.watch, args.length, args.seed,
+                args.e or ['block', 'interp'])
+        if rv is None:
+            print '%d programs stopped alike at their watchpoints' % \
+                    args.watch
+            sys.exit(0)
+        source, watches, a, b = rv
+        print '\n'.join(source)
+        print 'watching %s' % ', '.join('%04x+%d (%d)' % w for w in watches)
+        for x, y in map(None, a, b):
+            print '  %s\n  %s' % (x, y)
+            if x != y:
+                break
+        sys.exit(1)
+    if args.trace:
+        if args.romfile is None:
+            rv = check_traces()
+        else:
+            hooks = []
+            for hook in args.hook:
+                addr, sep, name = hook.partition('=')
+                if name not in Machine.library_functions:
+                    parser.error('unknown library function: %s' % name)
+                hooks.append((int(addr, 16), name))
+            rv = check_trace(args.romfile, args.i, args.x, hooks)
+            if rv is not None:
+                rv = (args.i, hooks) + rv
+        if rv is None:
+            print 'the traces agreed'
+            sys.exit(0)
+        inputs, hooks, line, text, rendered = rv
+        print 'input %r, hooks %r' % (inputs, hooks)
+        print 'line %d differed:' % line
+        print '  -t:        %s' % text
+        print '  tracedump: %s' % rendered
+        sys.exit(1)
+    if args.batch:
+        rv = check_batch()
+        if rv is None:
+            print '%d inputs agreed on the batch engine' % len(SHELLCODE)
+            sys.exit(0)
+        candidate, got, expected = rv
+        print 'input %r' % candidate
+        print '  batch: %s' % (got,)
+        print '  alone: %s' % (expected,)
+        sys.exit(1)
+    if args.edges:
+        rv = check_edges(args.e or ['interp', 'interp'],
+                args.m or ['pages', 'image'])
+        if rv is None:
+            print '%d edge programs agreed' % len(EDGE_PROGRAMS)
+            sys.exit(0)
+        source, divergence = rv
+        print '\n'.join(source)
+        print divergence
+        sys.exit(1)
+    if args.e is None:
+        args.e = ['block', 'interp']
+    if args.m is None:
+        args.m = ['pages', 'pages']
+
+    if args.random is not None:
+        rv = check_random(args.random, args.length, args.seed, args.e,
+                args.n or 100000, args.m)
+        if rv is None:
+            print '%d random programs agreed' % args.random
+            sys.exit(0)
+        source, divergence = rv
+        print '\n'.join(source)
+        print divergence
+        sys.exit(1)
+
+    if args.romfile is None:
+        parser.error('give a ROM, --random, --idioms, --watch, --edges, --batch '
+            'or --trace')
+    lockstep = Lockstep(args.romfile, args.e, args.i, args.x, args.m)
+    divergence = lockstep.run(args.n)
+    if divergence is None:
+        print 'agreed for %d insns' % lockstep.machines[0].insn_count
+        sys.exit(0)
+    print divergence
+    sys.exit(1)
@@ -1,44 +1,373 @@
+import os
+import mmap
+import struct
 from array import array
 
+PC, SP, SR, CG = range(4)
+
+# kinds of memory access a watchpoint can catch
+READ = 1
+WRITE = 2
+
 class Registers(object):
 
     def __init__(self):
         self.regs = array('H', [0] * 16)
+        # The result of the last insn that set the status bits from its
+        # result, masked down to the bits those depend on, or None if sr is
+        # up to date. sr is only worked out from it when something reads it.
+        self.pending = None
 
     def __getitem__(self, no):
+        if no == SR and self.pending is not None:
+            self.flush()
         return self.regs[no]
 
     def __setitem__(self, no, v):
+        if no == SR:
+            self.pending = None
         self.regs[no] = v
 
+    def flush(self):
+        """Brings sr up to date with any pending result and returns it."""
+        p = self.pending
+        if p is not None:
+            self.regs[SR] = p >> 16 | ((p & 0xffff) == 0) << 1 | \
+                    (p >> 15 & 1) << 2
+            self.pending = None
+        return self.regs[SR]
+
 class Memory(object):
+    """64K of byte-addressed memory, kept as copy-on-write pages so that
+    snapshots are cheap: a snapshot shares every page with the live memory,
+    and a page is only copied the first time it is written afterwards."""
+
+    # addresses split into page number addr >> 8 and offset addr & 0xff
+    page_size = 0x100
 
     def __init__(self, f, size=0x10000):
-        self.mem = array('B')
-        self.mem.fromfile(f, size)
+        mem = array('B')
+        mem.fromfile(f, size)
+        self.size = len(mem)
+        self.pages = [mem[i:i + self.page_size]
+                for i in xrange(0, self.size, self.page_size)]
+        # nonzero for pages that no snapshot shares, and so can be written
+        self.owned = array('B', [1]) * len(self.pages)
+        # nonzero for every byte that some cached decoded instruction covers
+        self.code = array('B', [0]) * self.size
+        self.code_caches = {}
 
     def __getitem__(self, addr):
         if isinstance(addr, slice):
             # I am assuming no step value is provided in the slice
-            arr = []
-            for i in xrange(addr.start, addr.stop, 2):
-                arr.append(self.mem[i] | self.mem[i+1] << 8)
-            return arr
+            n = len(xrange(addr.start, addr.stop, 2))
+            return list(struct.unpack('<%dH' % n, self.read(addr.start, n * 2)))
         else:
-            return self.mem[addr] | self.mem[addr+1] << 8
+            return self.get_word(addr)
 
     def __setitem__(self, addr, v):
-        self.mem[addr] = v & 0xff
-        self.mem[addr+1] = v >> 8 & 0xff
+        self.set_word(addr, v)
 
     def __len__(self):
-        return len(self.mem)
+        return self.size
+
+    def get_word(self, addr):
+        page = self.pages[addr >> 8]
+        i = addr & 0xff
+        if i == 0xff:
+            return page[i] | self.pages[addr + 1 >> 8][0] << 8
+        return page[i] | page[i+1] << 8
+
+    def set_word(self, addr, v):
+        i = addr & 0xff
+        if i == 0xff:
+            self.set_byte(addr, v)
+            self.set_byte(addr + 1, v >> 8)
+            return
+        # Memory's own get_word, which Watched doesn't count as a read
+        if (self.code[addr] or self.code[addr+1]) and \
+                Memory.get_word(self, addr) != v & 0xffff:
+            self.invalidate(addr, 2)
+        p = addr >> 8
+        if not self.owned[p]:
+            self.copy_page(p)
+        page = self.pages[p]
+        page[i] = v & 0xff
+        page[i+1] = v >> 8 & 0xff
 
     def get_byte(self, addr):
-        return self.mem[addr]
+        return self.pages[addr >> 8][addr & 0xff]
 
     def set_byte(self, addr, v):
-        self.mem[addr] = v & 0xff
+        if self.code[addr] and Memory.get_byte(self, addr) != v & 0xff:
+            self.invalidate(addr, 1)
+        p = addr >> 8
+        if not self.owned[p]:
+            self.copy_page(p)
+        self.pages[p][addr & 0xff] = v & 0xff
+
+    def read(self, addr, n):
+        """Returns the n bytes from addr as a string."""
+        chunks = []
+        while n > 0:
+            i = addr & 0xff
+            m = min(n, self.page_size - i)
+            chunks.append(self.pages[addr >> 8][i:i + m].tostring())
+            addr += m
+            n -= m
+        return ''.join(chunks)
+
+    def write(self, addr, s):
+        """Writes the string s at addr."""
+        if self.code[addr:addr + len(s)].count(1):
+            self.invalidate(addr, len(s))
+        while s:
+            p = addr >> 8
+            i = addr & 0xff
+            m = min(len(s), self.page_size - i)
+            if not self.owned[p]:
+                self.copy_page(p)
+            self.pages[p][i:i + m] = array('B', s[:m])
+            addr += m
+            s = s[m:]
+
+    def copy_page(self, p):
+        self.pages[p] = array('B', self.pages[p])
+        self.owned[p] = 1
 
     def tofile(self, f):
-        self.mem.tofile(f)
+        for page in self.pages:
+            page.tofile(f)
+
+    def snapshot(self):
+        """Returns the current contents as an opaque value for restore()."""
+        self.owned = array('B', [0]) * len(self.pages)
+        return tuple(self.pages)
+
+    def restore(self, snapshot):
+        for p, page in enumerate(snapshot):
+            if self.pages[p] is not page and self.pages[p] != page:
+                start = p * self.page_size
+                for i in xrange(start, start + len(page)):
+                    if self.code[i]:
+                        self.invalidate(start, len(page))
+                        break
+        self.pages = list(snapshot)
+        self.owned = array('B', [0]) * len(self.pages)
+
+    def changes(self, snapshot):
+        """Returns {addr: byte} for every byte that differs from the
+        snapshot. Only pages copied since are looked at."""
+        rv = {}
+        for p, page in enumerate(self.pages):
+            old = snapshot[p]
+            if page is old or page == old:
+                continue
+            start = p * self.page_size
+            for i in xrange(len(page)):
+                if page[i] != old[i]:
+                    rv[start + i] = page[i]
+        return rv
+
+    def code_cache(self, owner, factory=dict):
+        """Returns the cache of decoded instructions that `owner` keeps for
+        this memory. Entries are keyed by pc and dropped when written to."""
+        if owner not in self.code_caches:
+            self.code_caches[owner] = factory()
+        return self.code_caches[owner]
+
+    def mark_code(self, addr, size):
+        for i in xrange(addr, addr + size):
+            self.code[i] = 1
+
+    def invalidate(self, addr, size):
+        # instructions are at most 6 bytes long, so only entries starting up
+        # to 4 bytes before the write can overlap it
+        for cache in self.code_caches.itervalues():
+            for pc in xrange(addr - 4 & ~1, addr + size, 2):
+                cache.pop(pc, None)
+
+WORD = struct.Struct('<H')
+BYTE = struct.Struct('B')
+
+class ImageMemory(Memory):
+    """Memory as one flat image: the ROM file mapped privately, so that it
+    is loaded without copying and processes forked afterwards share it
+    until they write to it, or a bytearray if the ROM can't be mapped.
+    Words are read and written with struct, and snapshots are copies of
+    the whole image, which at 64K is a single memcpy."""
+
+    def __init__(self, f, size=0x10000):
+        try:
+            if os.fstat(f.fileno()).st_size < size:
+                raise ValueError('ROM too short to map.')
+            self.image = mmap.mmap(f.fileno(), size, mmap.MAP_PRIVATE,
+                    mmap.PROT_READ | mmap.PROT_WRITE)
+        except (AttributeError, ValueError, EnvironmentError):
+            # not a real file, or too short
+            self.image = bytearray(f.read(size))
+        self.size = len(self.image)
+        self.code = array('B', [0]) * self.size
+        self.code_caches = {}
+
+    # Addresses work as in Memory: below 0 they wrap around, and an access
+    # reaching past the end raises the IndexError Memory's page list (for
+    # reads) or code array (for writes) would, so that programs crash the
+    # same way on either backend.
+
+    def get_word(self, addr):
+        if addr >= 0xffff or addr & 0xffff == 0xffff:
+            return ImageMemory.get_byte(self, addr) | \
+                    ImageMemory.get_byte(self, addr + 1) << 8
+        return WORD.unpack_from(self.image, addr)[0]
+
+    def set_word(self, addr, v):
+        # split where Memory splits them, so Watched sees the same accesses
+        if addr & 0xff == 0xff:
+            self.set_byte(addr, v)
+            self.set_byte(addr + 1, v >> 8)
+            return
+        # as in Memory, a read watchpoints don't see
+        if (self.code[addr] or self.code[addr+1]) and \
+                ImageMemory.get_word(self, addr) != v & 0xffff:
+            self.invalidate(addr, 2)
+        WORD.pack_into(self.image, addr, v & 0xffff)
+
+    def get_byte(self, addr):
+        if addr >= self.size:
+            raise IndexError('list index out of range')
+        return BYTE.unpack_from(self.image, addr)[0]
+
+    def set_byte(self, addr, v):
+        if self.code[addr] and ImageMemory.get_byte(self, addr) != v & 0xff:
+            self.invalidate(addr, 1)
+        BYTE.pack_into(self.image, addr, v & 0xff)
+
+    def read(self, addr, n):
+        if addr < 0:
+            m = min(n, -addr)
+            return self.read(addr + self.size, m) + self.read(0, n - m)
+        if addr + n > self.size:
+            raise IndexError('list index out of range')
+        return str(self.image[addr:addr + n])
+
+    def write(self, addr, s):
+        if addr < 0:
+            m = min(len(s), -addr)
+            self.write(addr + self.size, s[:m])
+            self.write(0, s[m:])
+            return
+        # what fits is written before the fault, as in Memory
+        n = min(len(s), self.size - addr)
+        if self.code[addr:addr + n].count(1):
+            self.invalidate(addr, n)
+        self.image[addr:addr + n] = s[:n]
+        if n < len(s):
+            raise IndexError('array index out of range')
+
+    def tofile(self, f):
+        f.write(self.read(0, self.size))
+
+    def snapshot(self):
+        return self.read(0, self.size)
+
+    def restore(self, snapshot):
+        image = self.image
+        for start in xrange(0, self.size, self.page_size):
+            end = start + self.page_size
+            if image[start:end] != snapshot[start:end]:
+                if self.code[start:end].count(1):
+                    self.invalidate(start, self.page_size)
+                image[start:end] = snapshot[start:end]
+
+    def changes(self, snapshot):
+        rv = {}
+        image = self.read(0, self.size)
+        for start in xrange(0, self.size, self.page_size):
+            end = start + self.page_size
+            if image[start:end] == snapshot[start:end]:
+                continue
+            for i in xrange(start, end):
+                if image[i] != snapshot[i]:
+                    rv[i] = ord(image[i])
+        return rv
+
+class Watched(object):
+    """Mixed into a memory class to note accesses to watched addresses in
+    watch_hits, while that is a list. A Machine switches its memory to the
+    class's `watched` version while it has watchpoints and back
+    afterwards, so that memory without any pays nothing for them.
+
+    watch_pages holds the kinds of access watched anywhere in each page, or
+    in the first byte of the page after it, so that accessing a word
+    nowhere near a watchpoint costs a single array lookup."""
+
+    watch_hits = None
+
+    def set_watches(self, watches):
+        """Takes a dict mapping each watched byte address to the kinds of
+        access to catch there."""
+        self.watches = watches
+        self.watch_pages = array('B', [0]) * 0x100
+        for addr, kinds in watches.iteritems():
+            self.watch_pages[addr >> 8] |= kinds
+            self.watch_pages[addr - 1 >> 8 & 0xff] |= kinds
+
+    def accessed(self, addr, size, kind, old, new):
+        hits = self.watch_hits
+        if hits is None:
+            return
+        for i in xrange(addr, addr + size):
+            if self.watches.get(i & 0xffff, 0) & kind:
+                hits.append((addr, size, kind, old, new))
+                return
+
+    def get_word(self, addr):
+        v = super(Watched, self).get_word(addr)
+        if self.watch_pages[addr >> 8 & 0xff] & READ:
+            self.accessed(addr, 2, READ, v, v)
+        return v
+
+    def set_word(self, addr, v):
+        # words split across pages are written as two bytes
+        if addr & 0xff != 0xff and self.watch_pages[addr >> 8 & 0xff] & WRITE:
+            self.accessed(addr, 2, WRITE,
+                    super(Watched, self).get_word(addr), v & 0xffff)
+        super(Watched, self).set_word(addr, v)
+
+    def get_byte(self, addr):
+        v = super(Watched, self).get_byte(addr)
+        if self.watch_pages[addr >> 8 & 0xff] & READ:
+            self.accessed(addr, 1, READ, v, v)
+        return v
+
+    def set_byte(self, addr, v):
+        if self.watch_pages[addr >> 8 & 0xff] & WRITE:
+            self.accessed(addr, 1, WRITE,
+                    super(Watched, self).get_byte(addr), v & 0xff)
+        super(Watched, self).set_byte(addr, v)
+
+    def watched_pages(self, addr, n, kind):
+        return any(self.watch_pages[p & 0xff] & kind
+                for p in xrange(addr - 1 >> 8, (addr + n >> 8) + 1))
+
+    def read(self, addr, n):
+        if self.watched_pages(addr, n, READ):
+            return ''.join(chr(self.get_byte(i)) for i in xrange(addr, addr + n))
+        return super(Watched, self).read(addr, n)
+
+    def write(self, addr, s):
+        if self.watched_pages(addr, len(s), WRITE):
+            for i, c in enumerate(s):
+                self.set_byte(addr + i, ord(c))
+        else:
+            super(Watched, self).write(addr, s)
+
+class WatchedMemory(Watched, Memory):
+    pass
+
+class WatchedImageMemory(Watched, ImageMemory):
+    pass
+
+Memory.watched = WatchedMemory
+ImageMemory.watched = WatchedImageMemory
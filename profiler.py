@@ -0,0 +1,99 @@
+from array import array
+from collections import defaultdict
+from disassembler import Disassembler
+
+class Profiler(object):
+    """Counts the insns a Machine runs: per pc, in an array indexed by pc,
+    and per call stack of function entries. Stacks are only looked at when
+    a call or ret changes them, so the cost per insn is one array
+    increment, or one dict increment per block with the block engine.
+
+    Opcodes are counted from what memory holds when the report is made,
+    so code the program rewrote is counted as its latest version."""
+
+    def __init__(self):
+        self.counts = array('L', [0]) * 0x10000
+        # translated Block -> times run to the end
+        self.blocks = {}
+        # tuple of function entries, outermost first -> insns run
+        self.stacks = defaultdict(int)
+        self.mark = 0
+
+    def attach(self, machine):
+        machine.profile = self
+        self.mark = machine.insn_count
+
+    def switch(self, machine):
+        """Called before machine.call_targets changes, or at the end, to
+        charge the insns run since the last switch to the current stack."""
+        n = machine.insn_count - self.mark
+        if n > 0:
+            self.stacks[tuple(machine.call_targets)] += n
+        self.mark = machine.insn_count
+
+    def pc_counts(self):
+        counts = self.counts
+        for block, n in self.blocks.iteritems():
+            for pc in block.pcs:
+                counts[pc] += n
+        self.blocks.clear()
+        return counts
+
+    def hot_spots(self):
+        """Returns (count, pc) for every pc that ran, most run first."""
+        counts = self.pc_counts()
+        return sorted(((n, pc) for pc, n in enumerate(counts) if n),
+                reverse=True)
+
+    def functions(self):
+        """Returns (self insns, total insns, entry) for each function,
+        where total includes the functions it called; most self first."""
+        own = defaultdict(int)
+        total = defaultdict(int)
+        for stack, n in self.stacks.iteritems():
+            own[stack[-1]] += n
+            for entry in set(stack):
+                total[entry] += n
+        return sorted(((own[entry], total[entry], entry) for entry in total),
+                reverse=True)
+
+    def opcodes(self, mem):
+        """Returns (count, opcode) for the insns that ran, most run first."""
+        disassembler = Disassembler()
+        opcodes = defaultdict(int)
+        for n, pc in self.hot_spots():
+            try:
+                text = disassembler.format_insn(pc, mem)[0]
+            except Exception:
+                text = '(undecodable)'
+            opcodes[text.split('\t')[0]] += n
+        return sorted(((n, name) for name, n in opcodes.iteritems()),
+                reverse=True)
+
+    def report(self, mem, out, limit=20):
+        disassembler = Disassembler()
+        hot_spots = self.hot_spots()
+        total = sum(n for n, pc in hot_spots) or 1
+        out.write('hot spots:\n')
+        for n, pc in hot_spots[:limit]:
+            try:
+                text = disassembler.format_insn(pc, mem)[0]
+            except Exception:
+                text = 'Failed to disassemble.'
+            out.write('%10d %5.1f%%  %04x: %s\n' %
+                    (n, 100.0 * n / total, pc, text))
+        out.write('\nfunctions (self, total):\n')
+        for own, inclusive, entry in self.functions()[:limit]:
+            out.write('%10d %5.1f%% %10d %5.1f%%  %04x\n' % (own,
+                    100.0 * own / total, inclusive, 100.0 * inclusive / total,
+                    entry))
+        out.write('\nopcodes:\n')
+        for n, name in self.opcodes(mem)[:limit]:
+            out.write('%10d %5.1f%%  %s\n' % (n, 100.0 * n / total, name))
+
+    def write_collapsed(self, f):
+        """Writes the stacks in the collapsed format flamegraph.pl reads:
+        one 'outer;...;inner count' line per stack."""
+        for stack, n in sorted(self.stacks.iteritems()):
+            f.write('%s %d\n' % (';'.join('%04x' % entry for entry in stack),
+                    n))
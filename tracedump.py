@@ -0,0 +1,58 @@
+#! /usr/bin/env python
+
+import sys
+from decoder import Decoder
+from emulator import Machine
+from tracer import Tracer, BinaryTracer, read_records
+
+class InsnWords(object):
+    """Just enough of Memory for Decoder to decode a single insn."""
+
+    def __init__(self):
+        self.pc = 0
+        self.words = (0, 0, 0)
+
+    def __getitem__(self, addr):
+        return self.words[addr - self.pc >> 1]
+
+class Renderer(object):
+    """Formats binary trace records the way Tracer does."""
+
+    def __init__(self, outfile):
+        # decode with the emulator's handlers so insns get the same names
+        self.decoder = Decoder(Machine)
+        self.tracer = Tracer(outfile)
+        self.insn = InsnWords()
+
+    def render(self, rec, collapse_loops=True):
+        pc, flags, w0, w1, w2, v0, v1, waddr = rec[:8]
+        regs = rec[8:]
+        tracer = self.tracer
+        if collapse_loops and tracer.in_loop(pc, regs):
+            if flags & BinaryTracer.WRITES:
+                tracer.stored(waddr, 1 if flags & BinaryTracer.WRITES_BYTE
+                        else 2)
+            return
+        insn = self.insn
+        insn.pc = pc - 2 if flags & BinaryTracer.PEEPHOLE else pc
+        insn.words = (w0, w1, w2)
+        handler, is_byte_insn, args, size = \
+                self.decoder.decode_uncached(insn.pc, insn)
+        name = handler.__name__[3:]
+        if flags & BinaryTracer.PEEPHOLE:
+            name = '%s_peephole_%d' % (name, v0)
+        tracer.write(pc, name, is_byte_insn, args, [v0, v1], regs)
+
+def render(infile, outfile):
+    """Writes a binary trace out in the format Tracer produces."""
+    renderer = Renderer(outfile)
+    for rec in read_records(infile):
+        renderer.render(rec)
+
+if __name__ == '__main__':
+    with open(sys.argv[1], 'rb') as infile:
+        if len(sys.argv) > 2:
+            with open(sys.argv[2], 'w') as outfile:
+                render(infile, outfile)
+        else:
+            render(infile, sys.stdout)
@@ -0,0 +1,27 @@
+#! /usr/bin/env python
+
+import sys
+from itertools import islice
+from tracer import TraceStore
+from tracedump import Renderer
+
+def query(fname, pc=None, write=None, limit=None, outfile=sys.stdout):
+    """Prints the insns of a chunked trace that match, each preceded by
+    its position in the trace."""
+    store = TraceStore(fname)
+    renderer = Renderer(outfile)
+    for n, rec in islice(store.query(pc, write), limit):
+        outfile.write('%d\t' % n)
+        renderer.render(rec, collapse_loops=False)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tracefile')
+    parser.add_argument('--pc', type=lambda s: int(s, 16),
+            help='only insns at this address')
+    parser.add_argument('--write', type=lambda s: int(s, 16),
+            help='only insns storing to this address')
+    parser.add_argument('-n', type=int, help='stop after this many matches')
+    args = parser.parse_args()
+    query(args.tracefile, args.pc, args.write, args.n)
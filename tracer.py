@@ -1,39 +1,153 @@
+import zlib
+import atexit
+import struct
+import marshal
+from array import array
+from memory import PC, SP, SR, CG
 from disassembler import Disassembler
-from collections import deque
+
+# insns which store to their last operand
+STORING_INSNS = frozenset(['mov', 'add', 'addc', 'sub', 'bic', 'bis', 'xor',
+    'and', 'dadd', 'rrc', 'rra', 'swpb', 'sxt'])
+
+def store_getter(name, is_byte_insn, args, regs):
+    """Returns (get, nbytes), where get() gives the address the insn is
+    about to store to, mirroring Machine.set_addr. get is None for insns
+    that don't store to memory."""
+    if name in ('push', 'call'):
+        return (lambda: regs[SP] - 2 & 0xffff), 2
+    elif name not in STORING_INSNS or args[-1].mode == 0:
+        return None, 0
+    mode, loc, data = args[-1]
+    nbytes = 1 if is_byte_insn else 2
+    if loc == SR and mode == 1:
+        return (lambda: data), nbytes
+    elif mode == 1:
+        return (lambda: regs[loc] + data & 0xffff), nbytes
+    elif mode == 3:
+        # the operand has been read, and the register bumped, first
+        return (lambda: regs[loc] + 2 & 0xffff), nbytes
+    return (lambda: regs[loc]), nbytes
 
 class Tracer(object):
+    """Writes a text trace, one line per insn, with the operand values each
+    insn sees.
+
+    Once a backward jump goes to an insn that ran not long before at the
+    same stack depth, the rest of that loop is summarised in a single line:
+    everything between the jump target and the jump, and anything the loop
+    calls, is counted rather than written, until execution leaves it. The
+    summary gives how many more times the loop ran, the registers it
+    changed and the memory it stored to."""
+
+    # how many insns back a loop's first insn may have run
+    max_loop_body = 0x1000
 
     def __init__(self, fname):
-        self.tracefile = open(fname, 'w')
-        self.circular_buffer = deque(maxlen=0x11)
+        if isinstance(fname, basestring):
+            self.tracefile = open(fname, 'w')
+        else:
+            self.tracefile = fname
+        self.insn_count = 0
+        self.last_run = {}
         self.loop_header = None
         self.loop_end = None
+        self.loop_sp = None
         self.loop_count = 0
+        self.loop_regs = None
+        self.loop_stores = None
+        self.mem = None
 
     def trace(self, pc, name, is_byte_insn, args, m):
-        if self.loop_header is not None:
-            if self.loop_header == pc:
-                self.loop_count += 1
-                return
-            elif self.loop_header < pc <= self.loop_end:
-                return
+        R = m.registers
+        if self.in_loop(pc, R):
+            if m.mem is not self.mem:
+                self.mem = m.mem
+                self.stores = m.mem.code_cache(self)
+            try:
+                get, nbytes = self.stores[pc]
+            except KeyError:
+                get, nbytes = self.stores[pc] = \
+                        store_getter(name, is_byte_insn, args, R.regs)
+            if get is not None:
+                self.stored(get(), nbytes)
+            return
+        values = None
+        if name[0] != 'j':
+            values = [m.get_addr(arg, inc=False) for arg in args]
+        self.write(pc, name, is_byte_insn, args, values, R)
+
+    def in_loop(self, pc, regs):
+        """Returns whether pc is inside a loop that is being collapsed,
+        ending the loop if it isn't. `regs` are the registers before the
+        insn at pc runs."""
+        if self.loop_header is None:
+            return False
+        if self.loop_header == pc:
+            self.loop_count += 1
+            return True
+        elif self.loop_header < pc <= self.loop_end or \
+                regs[SP] < self.loop_sp:
+            return True
+        self.end_loop(regs)
+        return False
+
+    def stored(self, addr, nbytes):
+        """Records a store made inside the loop being collapsed."""
+        self.loop_stores.add(addr)
+        if nbytes == 2:
+            self.loop_stores.add(addr + 1 & 0xffff)
+
+    def end_loop(self, regs):
+        if self.loop_count:
+            effects = []
+            changed = ['%s %04x->%04x' % (Disassembler.pretty_reg(i), v,
+                    regs[i]) for i, v in enumerate(self.loop_regs)
+                    if i not in (PC, SR, CG) and v != regs[i]]
+            if changed:
+                effects.append(', '.join(changed))
+            if self.loop_stores:
+                effects.append('stored to ' +
+                        ', '.join(self.ranges(self.loop_stores)))
+            self.tracefile.write('<loop %d times%s>\n' % (self.loop_count,
+                ''.join('; ' + e for e in effects)))
+        self.loop_header = None
+        self.loop_count = 0
+        self.loop_regs = None
+        self.loop_stores = None
+
+    @staticmethod
+    def ranges(addrs):
+        rv = []
+        addrs = sorted(addrs)
+        first = last = addrs[0]
+        for addr in addrs[1:] + [None]:
+            if addr == last + 1:
+                last = addr
+                continue
+            if first == last:
+                rv.append('%04x' % first)
             else:
-                self.tracefile.write('<loop %d times>\n' % self.loop_count)
-                self.loop_header = None
-                self.loop_count = 0
+                rv.append('%04x-%04x' % (first, last))
+            first = last = addr
+        return rv
 
-        if name[0] == 'j' and name != 'jmp' and -0x20 <= args[0] < 0:
+    def write(self, pc, name, is_byte_insn, args, values, regs):
+        """Writes one insn. `values` holds the value of each of args, and is
+        only used for non-jumps; `regs` are the registers before the insn
+        runs."""
+        self.insn_count += 1
+        self.last_run[pc] = (self.insn_count, regs[SP])
+        if name[0] == 'j' and args[0] < 0 and '_peephole_' not in name:
             target = args[0] + pc
-            simple_loop = True
-            for op_pc, op_name in reversed(self.circular_buffer):
-                if op_pc == target:
-                    break
-                if op_name[0] == 'j':
-                    simple_loop = False
-                    break
-            if simple_loop:
+            insn_count, sp = self.last_run.get(target, (0, None))
+            if sp == regs[SP] and \
+                    self.insn_count - insn_count <= self.max_loop_body:
                 self.loop_header = target
                 self.loop_end = pc
+                self.loop_sp = sp
+                self.loop_regs = [regs[i] for i in xrange(16)]
+                self.loop_stores = set()
 
         if name[0] != 'j':
             emulated_name, emulated_args = \
@@ -41,19 +155,241 @@ class Tracer(object):
             if is_byte_insn:
                 emulated_name += '.b'
             arg_strs = map(Disassembler.pretty_addr, emulated_args)
-            values = []
+            arg_values = []
             for i, s in enumerate(arg_strs):
                 if s[0] != '#':
-                    values.append('%04x (%04x)' %
-                            (m.get_addr(args[i], inc=False), m.registers[args[i].loc]))
+                    arg_values.append('%04x (%04x)' %
+                            (values[i], regs[args[i].loc]))
             arg_str = ", ".join(arg_strs)
-            if len(values) > 0:
-                arg_str += ' [%s]' % ", ".join(values)
+            if len(arg_values) > 0:
+                arg_str += ' [%s]' % ", ".join(arg_values)
         else:
             emulated_name = name
             arg_str = '$%+x [%04x]' % (args[0], args[0] + pc)
 
-        self.circular_buffer.append((pc, name))
-
         self.tracefile.write("%04x %s\t%s\n" % (pc,
             emulated_name, arg_str))
+
+class BinaryTracer(object):
+    """Writes one fixed-size record per insn, leaving all formatting to
+    tracedump.py. Records hold the pc, the three words starting at the insn,
+    the value of each operand, the memory address the insn is about to store
+    to, if any, and all the registers."""
+
+    magic = 'MSP430T2'
+    record = struct.Struct('<HH3H3H16H')
+    PEEPHOLE = 1
+    WRITES_BYTE = 2
+    WRITES_WORD = 4
+    WRITES = WRITES_BYTE | WRITES_WORD
+
+    def __init__(self, fname, buffer_size=1 << 20):
+        self.tracefile = open(fname, 'wb', buffer_size)
+        self.tracefile.write(self.magic)
+        self.mem = None
+
+    def trace(self, pc, name, is_byte_insn, args, m):
+        R = m.registers
+        if R.pending is not None:
+            R.flush()
+        if '_peephole_' in name:
+            # Machine.peephole_execute traces the jump with pc past it and
+            # the final counter value in the name
+            v = int(name.rsplit('_', 1)[1])
+            self.write(pc, self.PEEPHOLE, self.words(pc - 2, m.mem), v, 0, 0,
+                    R.regs)
+            return
+
+        if m.mem is not self.mem:
+            self.mem = m.mem
+            self.cache = m.mem.code_cache(self)
+        try:
+            words, get0, get1, dest, flags = self.cache[pc]
+        except KeyError:
+            words, get0, get1, dest, flags = self.cache[pc] = \
+                    self.prepare(pc, name, is_byte_insn, args, m)
+        v0 = v1 = waddr = 0
+        if get0 is not None:
+            v0 = get0() & 0xffff
+            if get1 is not None:
+                v1 = get1() & 0xffff
+            if dest is not None:
+                waddr = dest()
+        self.write(pc, flags, words, v0, v1, waddr, R.regs)
+
+    def write(self, pc, flags, words, v0, v1, waddr, regs):
+        self.tracefile.write(self.record.pack(pc, flags, words[0], words[1],
+            words[2], v0, v1, waddr, *regs))
+
+    @staticmethod
+    def words(pc, mem):
+        return (mem.get_word(pc), mem.get_word(pc + 2 & 0xfffe),
+                mem.get_word(pc + 4 & 0xfffe))
+
+    def prepare(self, pc, name, is_byte_insn, args, m):
+        """Works out what to record for the insn at pc: its words, getters
+        for its operands, and a function giving the address it stores to.
+        This is cached until the insn is overwritten."""
+        getters = [None, None]
+        dest = None
+        flags = 0
+        if name[0] != 'j':
+            nbytes = 1 if is_byte_insn else 2
+            for i, arg in enumerate(args):
+                getters[i] = m.translator.getter(arg, nbytes, inc=False)
+            dest, nbytes = store_getter(name, is_byte_insn, args,
+                    m.registers.regs)
+            if dest is not None:
+                flags = self.WRITES_BYTE if nbytes == 1 else self.WRITES_WORD
+        if pc in m.decoder.hooks:
+            # what memory holds there doesn't run: the hook stands in for a
+            # ret, at the callgate and at a replaced function alike
+            words = (0x4130, 0, 0)
+        else:
+            words = self.words(pc, m.mem)
+        return [words] + getters + [dest, flags]
+
+    def close(self):
+        self.tracefile.close()
+
+class ChunkedTracer(BinaryTracer):
+    """Stores BinaryTracer records in zlib-compressed chunks of
+    `chunk_size` insns, followed by an index from pc, and from each byte
+    written, to the chunks holding them. See TraceStore for reading it
+    back.
+
+    The index is written when the tracer is closed, which happens at exit
+    at the latest."""
+
+    magic = 'MSP430Z2'
+    header = struct.Struct('<I')
+    trailer = struct.Struct('<Q')
+
+    def __init__(self, fname, chunk_size=4096):
+        BinaryTracer.__init__(self, fname)
+        self.tracefile.write(self.header.pack(chunk_size))
+        self.chunk_size = chunk_size
+        self.chunk = []
+        self.chunk_pcs = set()
+        self.chunk_writes = set()
+        self.chunks = []
+        self.pc_index = {}
+        self.write_index = {}
+        atexit.register(self.close)
+
+    def write(self, pc, flags, words, v0, v1, waddr, regs):
+        chunk = self.chunk
+        chunk.append(self.record.pack(pc, flags, words[0], words[1],
+            words[2], v0, v1, waddr, *regs))
+        self.chunk_pcs.add(pc)
+        if flags & self.WRITES:
+            self.chunk_writes.add(waddr)
+            if flags & self.WRITES_WORD:
+                self.chunk_writes.add(waddr + 1 & 0xffff)
+        if len(chunk) == self.chunk_size:
+            self.flush_chunk()
+
+    def flush_chunk(self):
+        if not self.chunk:
+            return
+        chunk_id = len(self.chunks)
+        data = zlib.compress(''.join(self.chunk))
+        self.chunks.append((self.tracefile.tell(), len(data), len(self.chunk)))
+        self.tracefile.write(data)
+        for index, keys in ((self.pc_index, self.chunk_pcs),
+                (self.write_index, self.chunk_writes)):
+            for key in keys:
+                try:
+                    index[key].append(chunk_id)
+                except KeyError:
+                    index[key] = array('I', [chunk_id])
+            keys.clear()
+        self.chunk = []
+
+    def close(self):
+        if self.tracefile.closed:
+            return
+        self.flush_chunk()
+        index_offset = self.tracefile.tell()
+        self.tracefile.write(zlib.compress(marshal.dumps((self.chunks,
+            dict((k, v.tostring()) for k, v in self.pc_index.iteritems()),
+            dict((k, v.tostring()) for k, v in self.write_index.iteritems())
+            ))))
+        self.tracefile.write(self.trailer.pack(index_offset))
+        self.tracefile.close()
+
+class TraceStore(object):
+    """Reads a ChunkedTracer file, only decompressing the chunks a query
+    needs."""
+
+    def __init__(self, fname):
+        self.f = open(fname, 'rb')
+        if self.f.read(len(ChunkedTracer.magic)) != ChunkedTracer.magic:
+            raise Exception('Not a chunked trace file.')
+        self.chunk_size, = ChunkedTracer.header.unpack(
+                self.f.read(ChunkedTracer.header.size))
+        trailer = ChunkedTracer.trailer
+        self.f.seek(-trailer.size, 2)
+        end = self.f.tell()
+        index_offset, = trailer.unpack(self.f.read(trailer.size))
+        self.f.seek(index_offset)
+        self.chunks, self.pc_index, self.write_index = marshal.loads(
+                zlib.decompress(self.f.read(end - index_offset)))
+
+    def __len__(self):
+        return sum(count for offset, size, count in self.chunks)
+
+    def chunk_ids(self, index, key):
+        if key not in index:
+            return array('I')
+        return array('I', index[key])
+
+    def read_chunk(self, chunk_id):
+        """Returns the unpacked records of one chunk."""
+        offset, size, count = self.chunks[chunk_id]
+        self.f.seek(offset)
+        data = zlib.decompress(self.f.read(size))
+        record = ChunkedTracer.record
+        return [record.unpack_from(data, i)
+                for i in xrange(0, len(data), record.size)]
+
+    def query(self, pc=None, write=None):
+        """Yields (insn number, record) for every insn at `pc` that writes
+        the byte at `write`. Either may be None to match anything."""
+        if pc is None and write is None:
+            chunk_ids = xrange(len(self.chunks))
+        else:
+            chunk_ids = None
+            for index, key in ((self.pc_index, pc),
+                    (self.write_index, write)):
+                if key is not None:
+                    ids = set(self.chunk_ids(index, key))
+                    chunk_ids = ids if chunk_ids is None else chunk_ids & ids
+            chunk_ids = sorted(chunk_ids)
+        for chunk_id in chunk_ids:
+            n = chunk_id * self.chunk_size
+            for i, rec in enumerate(self.read_chunk(chunk_id)):
+                if pc is not None and rec[0] != pc:
+                    continue
+                if write is not None and not self.writes(rec, write):
+                    continue
+                yield n + i, rec
+
+    @staticmethod
+    def writes(rec, addr):
+        flags, waddr = rec[1], rec[7]
+        if flags & ChunkedTracer.WRITES_WORD:
+            return addr in (waddr, waddr + 1 & 0xffff)
+        return flags & ChunkedTracer.WRITES_BYTE and addr == waddr
+
+def read_records(f):
+    """Yields the unpacked records of a binary trace file."""
+    if f.read(len(BinaryTracer.magic)) != BinaryTracer.magic:
+        raise Exception('Not a binary trace file.')
+    record = BinaryTracer.record
+    while True:
+        data = f.read(record.size * 4096)
+        if not data:
+            break
+        for i in xrange(0, len(data) - record.size + 1, record.size):
+            yield record.unpack_from(data, i)
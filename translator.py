@@ -0,0 +1,494 @@
+from decoder import Address
+from disassembler import Disassembler
+from util import as_signed
+
+PC, SP, SR, CG = range(4)
+
+class Block(object):
+
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.ops = []
+        self.pcs = []
+        self.valid = True
+        # pc of the control-flow insn that ends the block, if any
+        self.branch_pc = None
+        self.is_jump = False
+        self.is_call = False
+        self.is_ret = False
+        # the idioms.Loop starting here, False if none, None if not looked
+        # for yet
+        self.loop = None
+
+    def __len__(self):
+        return len(self.ops)
+
+    def contains_any(self, addrs):
+        for addr in addrs:
+            if self.start <= addr < self.end:
+                return True
+        return False
+
+class BlockMap(dict):
+    """Maps the pc of every translated insn to the blocks containing it.
+    Memory pops entries from here when code is overwritten."""
+
+    def __init__(self, translator):
+        dict.__init__(self)
+        self.translator = translator
+
+    def pop(self, pc, default=None):
+        blocks = dict.pop(self, pc, default)
+        if blocks:
+            for block in blocks:
+                block.valid = False
+                if self.translator.blocks.get(block.start) is block:
+                    del self.translator.blocks[block.start]
+        return blocks
+
+class Translator(object):
+    """Translates straight-line runs of code into lists of closures, with
+    operand access specialized at translation time. Executing a block is
+    equivalent to running Machine.execute_next on each of its insns."""
+
+    max_block_size = 64
+
+    def __init__(self, machine):
+        self.m = machine
+        self.registers = machine.registers
+        self.regs = machine.registers.regs
+        self.mem = machine.mem
+        self.blocks = {}
+        self.covered = self.mem.code_cache(self, lambda: BlockMap(self))
+
+    def flush(self):
+        for blocks in self.covered.values():
+            for block in blocks:
+                block.valid = False
+        self.covered.clear()
+        self.blocks.clear()
+
+    def lookup(self, pc):
+        try:
+            return self.blocks[pc]
+        except KeyError:
+            return self.translate(pc)
+
+    def translate(self, pc):
+        # the callgate and functions replaced in Python (see
+        # Machine.register_function) only run through execute_next
+        hooks = self.m.decoder.hooks
+        if pc in hooks:
+            return None
+        block = self.current = Block(pc)
+        while len(block.ops) < self.max_block_size:
+            handler, is_byte_insn, args, size = \
+                    self.m.decoder.decode(pc, self.mem)
+            if handler is None:
+                break
+            name = handler.__name__[3:]
+            compile_insn = getattr(self, 'compile_' + name, None)
+            if compile_insn is None:
+                break
+            nbytes = 1 if is_byte_insn else 2
+            op = compile_insn(pc, nbytes, args, pc + size)
+            self.cover(pc, size)
+            ends_block = self.ends_block(name, args)
+            if ends_block and name[0] != 'j' and name != 'call' and \
+                    not self.reads_pc(args):
+                op = self.with_pc(pc, args, op, force=True)
+            block.ops.append(op)
+            block.pcs.append(pc)
+            pc += size
+            block.end = pc
+            if ends_block:
+                block.branch_pc = block.pcs[-1]
+                block.is_jump = name[0] == 'j'
+                block.is_call = name == 'call'
+                block.is_ret = Disassembler.is_ret(name, args)
+                break
+            if pc in hooks:
+                break
+        if not block.ops:
+            return None
+        self.blocks[block.start] = block
+        return block
+
+    def cover(self, pc, size):
+        self.mem.mark_code(pc, size)
+        self.covered.setdefault(pc, []).append(self.current)
+
+    @staticmethod
+    def ends_block(name, args):
+        if name[0] == 'j' or name == 'call':
+            return True
+        if name in ('cmp', 'bit', 'push'):
+            return False
+        # anything that writes pc branches, and anything that writes sr may
+        # set CPUOFF, which has to be noticed before the next insn
+        dest = args[-1]
+        return dest.mode == 0 and dest.loc in (PC, SR)
+
+    @staticmethod
+    def reads_pc(args):
+        for arg in args:
+            if isinstance(arg, Address) and arg.loc == PC and arg.mode != 3:
+                return True
+        return False
+
+    # Operand access. These mirror Machine.get_addr and Machine.set_addr.
+
+    def getter(self, addr, nbytes, inc=True):
+        regs = self.regs
+        mode, loc, data = addr
+        mask = (1 << 8 * nbytes) - 1
+        read = self.mem.get_byte if nbytes == 1 else self.mem.get_word
+
+        if loc == SR and mode == 1:
+            return lambda: read(data)
+        elif loc == SR and mode >= 2:
+            const = 1 << mode
+            return lambda: const
+        elif loc == CG:
+            const = mask if mode == 3 else mode
+            return lambda: const
+        elif loc == PC and mode == 3:
+            return lambda: data
+
+        if mode == 0 and loc == SR:
+            R = self.registers
+            def get_sr():
+                if R.pending is not None:
+                    R.flush()
+                return regs[SR] & mask
+            return get_sr
+        elif mode == 0:
+            return lambda: regs[loc] & mask
+        elif mode == 1:
+            return lambda: read(regs[loc] + data)
+        elif mode == 2 or not inc:
+            return lambda: read(regs[loc])
+        def get():
+            v = read(regs[loc])
+            regs[loc] += 2
+            return v
+        return get
+
+    def setter(self, addr, nbytes):
+        regs = self.regs
+        mode, loc, data = addr
+        mask = (1 << 8 * nbytes) - 1
+        write = self.mem.set_byte if nbytes == 1 else self.mem.set_word
+
+        if mode == 0 and loc == SR:
+            R = self.registers
+            def set_sr(v):
+                regs[SR] = v & mask
+                R.pending = None
+            return set_sr
+        elif mode == 0:
+            def set(v):
+                regs[loc] = v & mask
+            return set
+        elif loc == SR and mode == 1:
+            return lambda v: write(data, v)
+        elif mode == 1:
+            return lambda v: write(regs[loc] + data, v)
+        return lambda v: write(regs[loc], v)
+
+    def with_pc(self, pc, args, op, force=False):
+        """Wraps `op` so that reads of pc see the address of the following
+        word, as they do in the interpreter."""
+        if not force and not self.reads_pc(args):
+            return op
+        regs = self.regs
+        pc += 2
+        def with_pc():
+            regs[PC] = pc
+            op()
+        return with_pc
+
+    @staticmethod
+    def result_mask(nbytes):
+        """The bits of a result that Registers.pending keeps; see
+        Machine.set_status_result_bits."""
+        return 0x100ff if nbytes == 1 else 0x1ffff
+
+    # Format two
+
+    def compile_mov(self, pc, nbytes, args, next_pc):
+        src = self.getter(args[0], nbytes)
+        set = self.setter(args[1], nbytes)
+        def mov():
+            set(src())
+        return self.with_pc(pc, args, mov)
+
+    def compile_add(self, pc, nbytes, args, next_pc):
+        src = self.getter(args[0], nbytes)
+        dest = self.getter(args[1], nbytes)
+        set = self.setter(args[1], nbytes)
+        R = self.registers
+        keep = self.result_mask(nbytes)
+        def add():
+            v = dest() + src()
+            R.pending = v & keep
+            set(v)
+        return self.with_pc(pc, args, add)
+
+    def compile_addc(self, pc, nbytes, args, next_pc):
+        R = self.registers
+        src = self.getter(args[0], nbytes)
+        dest = self.getter(args[1], nbytes)
+        set = self.setter(args[1], nbytes)
+        keep = self.result_mask(nbytes)
+        def addc():
+            v = dest() + src()
+            v += R.flush() & 1
+            R.pending = v & keep
+            set(v)
+        return self.with_pc(pc, args, addc)
+
+    def compile_sub(self, pc, nbytes, args, next_pc):
+        src = self.getter(args[0], nbytes)
+        dest = self.getter(args[1], nbytes)
+        set = self.setter(args[1], nbytes)
+        R = self.registers
+        keep = self.result_mask(nbytes)
+        def sub():
+            v = dest() + (~src() & 0xffff) + 1
+            R.pending = v & keep
+            set(v)
+        return self.with_pc(pc, args, sub)
+
+    def compile_cmp(self, pc, nbytes, args, next_pc):
+        src = self.getter(args[0], nbytes)
+        dest = self.getter(args[1], nbytes)
+        R = self.registers
+        keep = self.result_mask(nbytes)
+        def cmp():
+            R.pending = dest() + (~src() & 0xffff) + 1 & keep
+        return self.with_pc(pc, args, cmp)
+
+    def compile_bit(self, pc, nbytes, args, next_pc):
+        src = self.getter(args[0], nbytes)
+        dest = self.getter(args[1], nbytes)
+        R = self.registers
+        keep = self.result_mask(nbytes)
+        def bit():
+            R.pending = dest() & src() & keep
+        return self.with_pc(pc, args, bit)
+
+    def compile_bic(self, pc, nbytes, args, next_pc):
+        src = self.getter(args[0], nbytes)
+        dest = self.getter(args[1], nbytes)
+        set = self.setter(args[1], nbytes)
+        def bic():
+            set(dest() & ~src())
+        return self.with_pc(pc, args, bic)
+
+    def compile_bis(self, pc, nbytes, args, next_pc):
+        src = self.getter(args[0], nbytes)
+        dest = self.getter(args[1], nbytes)
+        set = self.setter(args[1], nbytes)
+        def bis():
+            set(dest() | src())
+        return self.with_pc(pc, args, bis)
+
+    def compile_xor(self, pc, nbytes, args, next_pc):
+        R = self.registers
+        src = self.getter(args[0], nbytes)
+        dest = self.getter(args[1], nbytes)
+        set = self.setter(args[1], nbytes)
+        mask = (1 << 8 * nbytes) - 1
+        def xor():
+            v = dest() ^ src()
+            r = v & mask
+            R.pending = r | (r != 0) << 16
+            set(v)
+        return self.with_pc(pc, args, xor)
+
+    def compile_and(self, pc, nbytes, args, next_pc):
+        R = self.registers
+        src = self.getter(args[0], nbytes)
+        dest = self.getter(args[1], nbytes)
+        set = self.setter(args[1], nbytes)
+        mask = (1 << 8 * nbytes) - 1
+        def and_():
+            v = dest() & src()
+            r = v & mask
+            R.pending = r | (r != 0) << 16
+            set(v)
+        return self.with_pc(pc, args, and_)
+
+    def compile_dadd(self, pc, nbytes, args, next_pc):
+        R = self.registers
+        regs = self.regs
+        src = self.getter(args[0], nbytes)
+        dest = self.getter(args[1], nbytes)
+        set = self.setter(args[1], nbytes)
+        nibbles = nbytes * 2
+        def dadd():
+            s = src()
+            d = dest()
+            carry = 0
+            negative = 0
+            v = 0
+            for i in xrange(0, nibbles):
+                n = (s >> i * 4 & 0xf) + (d >> i * 4 & 0xf) + carry
+                negative = n >> 3 & 1
+                if n >= 10:
+                    n -= 10
+                    carry = 1
+                else:
+                    carry = 0
+                v |= (n & 0xf) << i * 4
+            regs[SR] = R.flush() & 0xfffe | carry
+            if negative:
+                regs[SR] |= 4
+            set(v)
+        return self.with_pc(pc, args, dadd)
+
+    # Format one
+
+    def compile_push(self, pc, nbytes, args, next_pc):
+        regs = self.regs
+        set_word = self.mem.set_word
+        src = self.getter(args[0], nbytes)
+        def push():
+            regs[SP] -= 2
+            v = src()
+            set_word(regs[SP], v)
+        return self.with_pc(pc, args, push)
+
+    def compile_call(self, pc, nbytes, args, next_pc):
+        regs = self.regs
+        set_word = self.mem.set_word
+        dest = self.getter(args[0], nbytes)
+        pc += 2
+        def call():
+            regs[PC] = pc
+            regs[SP] -= 2
+            set_word(regs[SP], next_pc)
+            regs[PC] = dest() & 0xffff
+        return call
+
+    def compile_swpb(self, pc, nbytes, args, next_pc):
+        dest = self.getter(args[0], nbytes)
+        set = self.setter(args[0], nbytes)
+        def swpb():
+            v = dest()
+            set(v >> 8 | (v << 8 & 0xff00))
+        return self.with_pc(pc, args, swpb)
+
+    def compile_sxt(self, pc, nbytes, args, next_pc):
+        R = self.registers
+        dest = self.getter(args[0], nbytes)
+        set = self.setter(args[0], nbytes)
+        mask = (1 << 8 * nbytes) - 1
+        def sxt():
+            v = as_signed(dest(), 8)
+            r = v & mask
+            R.pending = r | (r != 0) << 16
+            set(v)
+        return self.with_pc(pc, args, sxt)
+
+    def compile_rrc(self, pc, nbytes, args, next_pc):
+        R = self.registers
+        regs = self.regs
+        dest = self.getter(args[0], nbytes)
+        set = self.setter(args[0], nbytes)
+        bit_count = nbytes * 8
+        mask = (1 << bit_count) - 1
+        def rrc():
+            v = dest()
+            new_carry = v & 1
+            v = (v >> 1 | (R.flush() & 1) << bit_count - 1) & mask
+            if v & 0x8000:
+                regs[SR] |= 4
+            if v != 0:
+                regs[SR] &= 0xfffd
+            regs[SR] = regs[SR] & 0xfffe | new_carry
+            set(v)
+        return self.with_pc(pc, args, rrc)
+
+    def compile_rra(self, pc, nbytes, args, next_pc):
+        R = self.registers
+        regs = self.regs
+        dest = self.getter(args[0], nbytes)
+        set = self.setter(args[0], nbytes)
+        bit_count = nbytes * 8
+        mask = (1 << bit_count) - 1
+        def rra():
+            v = as_signed(dest(), bit_count) >> 1 & mask
+            regs[SR] = R.flush() & 0xfffd
+            if v & 0x8000:
+                regs[SR] |= 4
+            set(v)
+        return self.with_pc(pc, args, rra)
+
+    # Jumps
+
+    def jump(self, pc, offset, taken):
+        """Builds a conditional jump; `taken` maps the sr value to whether
+        the jump is taken."""
+        R = self.registers
+        regs = self.regs
+        target = pc + offset & 0xffff
+        fallthrough = pc + 2
+        def jump():
+            regs[PC] = target if taken(R.flush()) else fallthrough
+        return jump
+
+    def compile_jnz(self, pc, nbytes, args, next_pc):
+        peephole = self.compile_delay_loop(pc, args)
+        if peephole is not None:
+            return peephole
+        return self.jump(pc, args[0], lambda sr: not sr & 2)
+
+    def compile_jeq(self, pc, nbytes, args, next_pc):
+        return self.jump(pc, args[0], lambda sr: sr & 2)
+
+    def compile_jnc(self, pc, nbytes, args, next_pc):
+        return self.jump(pc, args[0], lambda sr: not sr & 1)
+
+    def compile_jc(self, pc, nbytes, args, next_pc):
+        return self.jump(pc, args[0], lambda sr: sr & 1)
+
+    def compile_jge(self, pc, nbytes, args, next_pc):
+        return self.jump(pc, args[0],
+                lambda sr: (sr >> 2 & 1) ^ (sr >> 8 & 1) == 0)
+
+    def compile_jl(self, pc, nbytes, args, next_pc):
+        return self.jump(pc, args[0], lambda sr: (sr >> 2 & 1) ^ (sr >> 8 & 1))
+
+    def compile_jmp(self, pc, nbytes, args, next_pc):
+        regs = self.regs
+        target = pc + args[0] & 0xffff
+        def jmp():
+            regs[PC] = target
+        return jmp
+
+    def compile_delay_loop(self, pc, args):
+        """Translates the `add #-1, x; jnz $-2` loop the way
+        Machine.peephole_execute runs it."""
+        if args[0] != -2:
+            return None
+        prev_handler, prev_is_byte_insn, prev_args, prev_size = \
+                self.m.decoder.decode(pc - 2, self.mem)
+        if not (prev_handler is not None and
+                prev_handler.__name__[3:] == 'add' and
+                prev_args[0] == Address(3, 3, None) and
+                isinstance(prev_args[1], Address) and
+                not prev_args[1].loc == 0):
+            return None
+        self.cover(pc - 2, prev_size)
+        R = self.registers
+        regs = self.regs
+        set = self.setter(prev_args[1], 1 if prev_is_byte_insn else 2)
+        fallthrough = pc + 2
+        def delay_loop():
+            regs[PC] = fallthrough
+            set(0)
+            regs[SR] = R.flush() & 0xfff8 | 3
+        return delay_loop